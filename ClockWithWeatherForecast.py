@@ -1,35 +1,62 @@
 #! /usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import time
+
+# Reference point of the time-to-first-frame measurement.
+_startTime = time.perf_counter()
+
 from PyQt5 import QtCore
-from PyQt5.QtCore import QTimer
-from PyQt5.QtGui import QFont
+from PyQt5.QtCore import QEvent, QObject, QThread, QTimer, pyqtSignal, pyqtSlot
+from PyQt5.QtGui import QColor, QFont, QPainter, QPen, QPixmap
 from PyQt5.QtWidgets import QApplication, QWidget, QPushButton, QGridLayout, QLabel, QPushButton, QSizePolicy
-from pytz import timezone
-from subprocess import Popen, PIPE
 
 import datetime
+import metrics
 import os
-import psutil
 import sys
+import telemetry
 import threading
-import weatherinfo
-
-USE_CPUTEMP = True
-USE_SPDTST = True
-USE_BME = True
 
-if os.name != 'nt':
-    import pwd
-else:
-    USE_CPUTEMP = False
-    USE_SPDTST = False
-    USE_BME = False
-
-if USE_BME == True:
-    from bme280 import bme280
+# Reads .env before the other modules pick up their settings. collector,
+# pubsub and forecastservice (sqlite3, asyncio, requests) are only
+# imported after the first frame.
+from settings import TIMEZONE, HALF_HOUR_MINUTES, SCHEDULE_JITTER
+from powermode import PowerPolicy, POWER_CHECK_INTERVAL, POWER_SAVE_INTERVAL
+from ringbuffer import RingBuffer
+from scheduler import Scheduler
+from snapshot import Snapshot
+from telemetry import TelemetryBus
+
+# The first frame (showing the snapshot) should be up within this many seconds.
+FIRST_FRAME_BUDGET = float(os.environ.get('FIRST_FRAME_BUDGET', 1.0))
+# Seconds each location's forecast is shown when there are several.
+FORECAST_ROTATE = float(os.environ.get('FORECAST_ROTATE', 10))
+# Hours shown by the sparklines under the room readings, 0 hides them.
+SPARKLINE_HOURS = float(os.environ.get('SPARKLINE_HOURS', 12))
+SPARKLINE_INTERVAL = 10     # seconds between room samples, sizes the ring buffers
+SPARKLINE_COLOR = '#6E7C64'
+PRESSURE_TREND_MARKS = {'rising': '↑', 'falling': '↓', 'steady': '→'}
+# Another process owns the sensors, see pubsub.py.
+PUBSUB_CONNECT = os.environ.get('PUBSUB_CONNECT', '')
+# Seconds before a failed collector start is retried, doubled up to COLLECTOR_RETRY_MAX.
+COLLECTOR_RETRY = 10
+COLLECTOR_RETRY_MAX = 600
+
+_tickProbe = metrics.probe('gui_tick', 'GUI timer tick')
+_weatherFetchProbe = metrics.probe('weather_fetch', 'Forecast fetch and parse')
+_weatherApplyProbe = metrics.probe('weather_apply', 'Forecast applied to the labels')
+# How late the GUI timer fires against its deadline.
+_loopLag = metrics.REGISTRY.histogram('gui_loop_lag_seconds', 'GUI timer wake-up delay')
 
 class QCustomLabel(QLabel):
+    # Pixel sizes by (width, height, text length, font scale, family), shared by all labels.
+    _pixelSizeCache = {}
+    # setText calls that were skipped because the text did not change.
+    skippedTexts = 0
+    # Font updates skipped because the fitted pixel size did not change.
+    skippedFonts = 0
+
     def __init__(self, text):
         super(QCustomLabel, self).__init__(text)
         self.font = QFont('Source Han Code JP Medium', 11)
@@ -40,49 +67,297 @@ class QCustomLabel(QLabel):
         self.setContentsMargins(-3, -1, -3, -1)
         self.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
         self.fontScale = 1.0
+        self._pixelSize = 0
+        self._stale = False
 
     def setFontFamily(self, face):
         self.font.setFamily(face)
+        self._pixelSize = 0
 
     def setFontScale(self, scale):
         self.fontScale = scale
+        self._pixelSize = 0
+
+    def setText(self, text):
+        # QLabel repaints on every setText, even for the same text.
+        oldText = self.text()
+        if text == oldText:
+            QCustomLabel.skippedTexts += 1
+            return
+        super(QCustomLabel, self).setText(text)
+        if len(text) != len(oldText):
+            self.__fitFont()
+
+    def setStale(self, stale):
+        # Stale labels show the snapshot of the previous run (QLabel[stale="true"]).
+        if stale == self._stale:
+            return
+        self._stale = stale
+        self.setProperty('stale', stale)
+        self.style().unpolish(self)
+        self.style().polish(self)
 
     def resizeEvent(self, evt):
-        width = self.size().width() / len(self.text())
+        self.__fitFont()
+
+    def __fitFont(self):
+        width = self.size().width()
         height = self.size().height()
-        baseSize = 0
-        if width > height:
-            baseSize = height
+        key = (width, height, len(self.text()), self.fontScale, self.font.family())
+        pixelSize = QCustomLabel._pixelSizeCache.get(key)
+        if pixelSize is None:
+            width = width / max(1, len(self.text()))
+            baseSize = 0
+            if width > height:
+                baseSize = height
+            else:
+                baseSize = width
+            pixelSize = max(1, int(baseSize * self.fontScale))
+            if len(QCustomLabel._pixelSizeCache) >= 4096:
+                # Only grows while the window is resized, start over then.
+                QCustomLabel._pixelSizeCache.clear()
+            QCustomLabel._pixelSizeCache[key] = pixelSize
+
+        if pixelSize == self._pixelSize:
+            QCustomLabel.skippedFonts += 1
+            return
+        self._pixelSize = pixelSize
+        self.font.setPixelSize(pixelSize)
+        self.setFont(self.font)
+
+    @staticmethod
+    def renderStats():
+        return {
+            'skippedTexts': QCustomLabel.skippedTexts,
+            'skippedFonts': QCustomLabel.skippedFonts,
+            'pixelSizeCache': len(QCustomLabel._pixelSizeCache),
+        }
+
+
+class QSparkline(QWidget):
+    # Line of one metric over the last `hours`, drawn under its reading.
+    # The pixmap is kept between samples: a new pixel column scrolls it left
+    # and only the newest column is drawn, so a sample costs the same for any
+    # window length. The whole line is drawn again from the ring buffer only
+    # on resize or when a value leaves the vertical range.
+    columnDraws = 0
+    fullDraws = 0
+
+    def __init__(self, hours=SPARKLINE_HOURS, interval=SPARKLINE_INTERVAL):
+        super(QSparkline, self).__init__()
+        self.window = hours * 60 * 60
+        self._samples = RingBuffer(self.window / interval + 1)
+        self._pixmap = None
+        self._columnSeconds = 0.0
+        self._column = 0            # time // _columnSeconds of the rightmost pixel column
+        self._columnLow = 0.0
+        self._columnHigh = 0.0
+        self._previous = None       # last value of the column before, joins the columns
+        self._lastValue = None
+        self._low = None
+        self._high = None
+        self._pen = QPen(QColor(SPARKLINE_COLOR))
+        self.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents)
+        self.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
+
+    def append(self, t, value):
+        self._samples.append(t, value)
+        previous = self._lastValue
+        self._lastValue = value
+        if self._pixmap is None:
+            return
+        column = int(t // self._columnSeconds)
+        if self._low is None or value < self._low or value > self._high or column < self._column:
+            self.__redraw()
+            return
+
+        width = self._pixmap.width()
+        height = self._pixmap.height()
+        shift = min(column - self._column, width)
+        if shift > 0:
+            # Not allowed while a painter is active on the pixmap.
+            self._pixmap.scroll(-shift, 0, self._pixmap.rect())
+        painter = QPainter(self._pixmap)
+        if shift > 0:
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            painter.fillRect(width - shift, 0, shift, height, QtCore.Qt.transparent)
+            painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+            self._column = column
+            self._previous = previous
+            self._columnLow = value
+            self._columnHigh = value
+        else:
+            self._columnLow = min(self._columnLow, value)
+            self._columnHigh = max(self._columnHigh, value)
+        painter.setPen(self._pen)
+        self.__drawColumn(painter, width - 1, self._columnLow, self._columnHigh, self._previous)
+        painter.end()
+        QSparkline.columnDraws += 1
+        if shift > 0:
+            self.update()
         else:
-            baseSize = width
+            self.update(width - 1, 0, 1, height)
 
-        self.font.setPixelSize(baseSize * self.fontScale)
-        self.setFont(self.font)
+    def extend(self, samples):
+        # [(time, value)] oldest first, e.g. the history of the previous run.
+        for t, value in samples:
+            self._samples.append(t, value)
+            self._lastValue = value
+        if self._pixmap is not None:
+            self.__redraw()
+
+    def resizeEvent(self, evt):
+        if self.width() <= 0 or self.height() <= 0:
+            return
+        self._pixmap = QPixmap(self.size())
+        self._columnSeconds = self.window / self.width()
+        self.__redraw()
+
+    def paintEvent(self, evt):
+        if self._pixmap is None:
+            return
+        painter = QPainter(self)
+        painter.drawPixmap(evt.rect(), self._pixmap, evt.rect())
+        painter.end()
+
+    def __y(self, value):
+        return int(round((self._high - value) / (self._high - self._low) * (self._pixmap.height() - 1)))
+
+    def __drawColumn(self, painter, x, low, high, previous):
+        if previous is not None:
+            low = min(low, previous)
+            high = max(high, previous)
+        painter.drawLine(x, self.__y(high), x, self.__y(low))
+
+    def __redraw(self):
+        QSparkline.fullDraws += 1
+        self._pixmap.fill(QtCore.Qt.transparent)
+        self._low = None
+        last = self._samples.last()
+        if last is None:
+            self.update()
+            return
+        width = self._pixmap.width()
+        self._column = int(last[0] // self._columnSeconds)
+        since = (self._column - width + 1) * self._columnSeconds
+        low, high = self._samples.minMax(since) or (last[1], last[1])
+        # Headroom so that the next samples rarely force another full draw.
+        margin = max(high - low, 1.0) * 0.25
+        self._low = low - margin
+        self._high = high + margin
+
+        painter = QPainter(self._pixmap)
+        painter.setPen(self._pen)
+        column = None
+        lastValue = None
+        for t, value in self._samples.items(since):
+            c = int(t // self._columnSeconds)
+            if c != column:
+                if column is not None:
+                    self.__drawColumn(painter, width - 1 - (self._column - column),
+                                      self._columnLow, self._columnHigh, self._previous)
+                column = c
+                self._previous = lastValue
+                self._columnLow = value
+                self._columnHigh = value
+            else:
+                self._columnLow = min(self._columnLow, value)
+                self._columnHigh = max(self._columnHigh, value)
+            lastValue = value
+        if column is not None:
+            self.__drawColumn(painter, width - 1 - (self._column - column),
+                              self._columnLow, self._columnHigh, self._previous)
+        painter.end()
+        self.update()
+
+    @staticmethod
+    def renderStats():
+        return {'columnDraws': QSparkline.columnDraws, 'fullDraws': QSparkline.fullDraws}
+
+
+class TelemetryPump(QObject):
+    # Carries the bus notification to the GUI thread as one queued signal.
+    ready = pyqtSignal()
+    # Emitted by the start thread with (collector, {metric: recent samples}) once the collectors are built.
+    collectorReady = pyqtSignal(object)
+    # Emitted by the start thread with the error when building them failed.
+    collectorFailed = pyqtSignal(str)
+
+
+class FirstFrameProbe(QObject):
+    # Calls fn once, right after the first paint of the watched widget.
+    def __init__(self, widget, fn):
+        super(FirstFrameProbe, self).__init__()
+        self._widget = widget
+        self._fn = fn
+        widget.installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        if obj is self._widget and event.type() == QEvent.Paint:
+            self._widget.removeEventFilter(self)
+            # Let the children finish painting this frame first.
+            QTimer.singleShot(0, self._fn)
+        return False
+
+
+class ForecastWorker(QObject):
+    # Fetches and parses the forecasts of every location on its own thread
+    # and publishes them as {name: Forecast} on the telemetry bus.
+    _requested = pyqtSignal()
+
+    def __init__(self, bus):
+        super(ForecastWorker, self).__init__()
+        self._bus = bus
+        self._busy = False
+        self._service = None
+        self._lock = threading.Lock()
+        self._thread = QThread()
+        self._thread.setObjectName('forecastWorkerThread')
+        self.moveToThread(self._thread)
+        self._requested.connect(self._fetch)
+        self._thread.start()
+
+    def request(self):
+        # Returns False when a fetch is already running.
+        with self._lock:
+            if self._busy == True:
+                return False
+            self._busy = True
+        self._requested.emit()
+        return True
+
+    def stop(self):
+        self._thread.quit()
+        self._thread.wait()
+        if self._service is not None:
+            self._service.close()
+
+    @pyqtSlot()
+    def _fetch(self):
+        start = time.perf_counter()
+        try:
+            if self._service is None:
+                # Imported here, requests is slow to load and not needed for the first frame.
+                from forecastservice import ForecastService
+                self._service = ForecastService()
+            forecasts = self._service.fetch()
+            _weatherFetchProbe.record(start, all([len(forecast) > 0 for forecast in forecasts.values()]))
+        except Exception as e:
+            _weatherFetchProbe.record(start, False)
+            print('Forecast fetch failed: {0}'.format(e))
+            forecasts = {}
+        finally:
+            with self._lock:
+                self._busy = False
+        self._bus.publish(telemetry.WEATHER_FORECAST, forecasts, source='openweathermap')
 
 
 class ClockDisplay:
-    # Convert from OpenWetherMap weather ID to Meteocons weather icon.
-    WEATHER_ICON = {
-        2: 'P',
-        3: 'X',
-        5: 'R',
-        6: 'W',
-        800: 'B',
-        801: 'B',
-        802: 'H',
-        803: 'N',
-        804: 'Y',
-    }
-
-    WEATHER_ICON_MOON = {
-        800: 'C',
-        801: 'C',
-        802: 'I',
-    }
-
-    def __init__(self, app, window):
+    def __init__(self, app, window, clock=time.time):
+        # clock drives the scheduler, benchmarks pass a virtual one.
         self._app = app
         self._window = window
+        self._clock = clock
         self._labelDate = QCustomLabel('initializing')
         self._labelTimes = []
         self._labelForecastTimes = []
@@ -107,12 +382,12 @@ class ClockDisplay:
         self._labelDownloadUnit = QCustomLabel('Mbps')
         self._labelPingUnit = QCustomLabel('ms')
 
-        self._1SecCount = 1
-        self._10SecCount = 1
-        self._60SecCount = 1
-        self._halfHourCount1 = 0
+        self._scheduler = Scheduler(TIMEZONE, clock)
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self._timer.timeout.connect(self.onTimer)
         self._fullMode = False
-        self._bme = object
 
         self._valDateTime = 0
         self._valTemperature = 0
@@ -123,15 +398,68 @@ class ClockDisplay:
         self._valPing = 0
         self._valCpuUsage = 0
         self._valCpuTemp = 0
-
-        if USE_BME == True:
-            self._bme = bme280()
+        self._valNetTest = None
+        self._valCpuCores = []
+        self._valCpuFrequencies = []
+        self._weatherApplyTime = 0.0
+        self._firstFrameTime = None
+        self.__registerMetrics()
+        self._timerTarget = None
+        self._collector = None
+        self._forecastWorker = None
+        self._subscriber = None
+        # {location name: Forecast} and the one on display.
+        self._forecasts = {}
+        self._forecastIndex = 0
+        # Night or blanked screen: minutes only, one wake-up per minute.
+        self._power = None
+        self._powerSave = False
+        # Room metrics whose label shows the smoothed value of telemetry.ROOM_STATS.
+        self._smoothedMetrics = set()
+        self._temperatureRange = ''
+
+        # Workers only publish samples, the GUI applies them in __applyTelemetry.
+        self._telemetry = TelemetryBus(clock)
+        if telemetry.TELEMETRY_LOG == True:
+            self._telemetry.addTap(telemetry.logTap)
+        self._telemetryPump = TelemetryPump()
+        self._telemetryPump.ready.connect(self.__applyTelemetry, QtCore.Qt.QueuedConnection)
+        self._telemetry.setNotify(self._telemetryPump.ready.emit)
+        self._telemetryPump.collectorReady.connect(self.__onCollectorReady, QtCore.Qt.QueuedConnection)
+        self._telemetryPump.collectorFailed.connect(self.__onCollectorFailed, QtCore.Qt.QueuedConnection)
+        # Recent room readings under the values, fed from the same samples.
+        self._sparklines = {}
+        if SPARKLINE_HOURS > 0:
+            for metric in (telemetry.ROOM_TEMPERATURE, telemetry.ROOM_HUMIDITY, telemetry.ROOM_PRESSURE):
+                self._sparklines[metric] = QSparkline()
+        # metric: (attribute, label, format)
+        self._telemetryFields = {
+            telemetry.ROOM_TEMPERATURE: ('_valTemperature', self._labelTemperature, '{:4.1f}'),
+            telemetry.ROOM_HUMIDITY: ('_valHumidity', self._labelHumidity, '{:2.0f}'),
+            telemetry.ROOM_PRESSURE: ('_valPressure', self._labelPressure, '{:3.0f}'),
+            telemetry.CPU_USAGE: ('_valCpuUsage', None, None),
+            telemetry.CPU_TEMPERATURE: ('_valCpuTemp', None, None),
+            telemetry.CPU_CORES: ('_valCpuCores', None, None),
+            telemetry.CPU_FREQUENCIES: ('_valCpuFrequencies', None, None),
+            telemetry.NET_UPLOAD: ('_valUpload', self._labelUpload, '{:.1f}'),
+            telemetry.NET_DOWNLOAD: ('_valDownload', self._labelDownload, '{:.1f}'),
+            telemetry.NET_PING: ('_valPing', self._labelPing, '{:.1f}'),
+            telemetry.NET_RESULT: ('_valNetTest', None, None),
+        }
+
+        # Collectors and the forecast worker start after the first frame.
+        self._snapshot = Snapshot()
+        self._firstFrame = FirstFrameProbe(self._window, self.__onFirstFrame)
+        self._app.aboutToQuit.connect(self.__onQuit)
 
         self.setNightMode()
         self.__initializeDisplayItems()
         self.__initializeDisplayItemsScale()
         self.__initializeDisplayLayout(layout)
 
+        # Show what the previous run displayed until live values arrive.
+        self.__applySnapshot()
+
     def __initializeDisplayItems(self):
         initTimes = ['  ', ':', '  ', '  ']
         for i in range(0, 4):
@@ -197,6 +525,11 @@ class ClockDisplay:
         layout.addWidget(self._labelPressure, 5, 8, 2, 2)
         layout.addWidget(self._labelPressureUnit, 5, 10, 2, 1)
 
+        # Over the lower half of each reading.
+        for metric, row in ((telemetry.ROOM_TEMPERATURE, 2), (telemetry.ROOM_HUMIDITY, 4), (telemetry.ROOM_PRESSURE, 6)):
+            if metric in self._sparklines:
+                layout.addWidget(self._sparklines[metric], row, 8, 1, 3)
+
         layout.addWidget(self._labelUpload, 7, 8, 1, 2)
         layout.addWidget(self._labelUploadUnit, 7, 10, 1, 1)
         layout.addWidget(self._labelDownload, 8, 8, 1, 2)
@@ -212,6 +545,15 @@ class ClockDisplay:
         # Fill empty grid
         # layout.addWidget(QLabel(), 7, 8, 3, 3)
 
+    @property
+    def scheduler(self):
+        return self._scheduler
+
+    @property
+    def collector(self):
+        # None until the collector thread has opened the sensors, or when subscribed.
+        return self._collector
+
     def __changeScreenMode(self):
         if self._fullMode == True:
             self._fullMode = False
@@ -221,175 +563,282 @@ class ClockDisplay:
             self._window.showFullScreen()
 
     def __updateClock(self, now):
-        self._labelDate.setText(now.strftime('%Y/%m/%d %a'))
+        self._labelDate.setText(now.strftime('%Y/%m/%d %a') + self._temperatureRange)
         self._labelTimes[0].setText(now.strftime('%H'))
         self._labelTimes[2].setText(now.strftime('%M'))
-        self._labelTimes[3].setText(now.strftime('%S'))
-
-    def __updateRoomInfo(self):
-        if USE_BME == True:
-            bmeStatuses = self._bme.getStatus()
-            self._valTemperature = bmeStatuses[0]
-            self._valHumidity = bmeStatuses[1]
-            self._valPressure = bmeStatuses[2]
-            self._labelTemperature.setText(self._valTemperature)
-            self._labelHumidity.setText(self._valHumidity)
-            self._labelPressure.setText(self._valPressure)
+        if self._powerSave == True:
+            self._labelTimes[3].setText('  ')
+        else:
+            self._labelTimes[3].setText(now.strftime('%S'))
+
+    def __applyTelemetry(self):
+        # Runs on the GUI thread, once per batch of published samples.
+        samples = self._telemetry.drain()
+        for metric, sample in samples.items():
+            if metric == telemetry.WEATHER_FORECAST:
+                self.__setForecasts(sample.value)
+                continue
+            if metric == telemetry.ROOM_STATS:
+                self.__applyRoomStats(sample.value)
+                continue
+            field = self._telemetryFields.get(metric)
+            if field is None:
+                continue
+            attribute, label, format = field
+            setattr(self, attribute, sample.value)
+            if label is not None and metric not in self._smoothedMetrics:
+                label.setText(format.format(sample.value))
+                label.setStale(False)
+                self._snapshot.update(metric, sample.value)
+            sparkline = self._sparklines.get(metric)
+            if sparkline is not None:
+                sparkline.append(sample.timestamp, sample.value)
+        self._snapshot.flush()
+
+    def __applyRoomStats(self, stats):
+        # Smoothed readings, today's temperature range by the date and the pressure tendency.
+        for metric in (telemetry.ROOM_TEMPERATURE, telemetry.ROOM_HUMIDITY, telemetry.ROOM_PRESSURE):
+            summary = stats.get(metric)
+            if summary is None or summary['smooth'] is None:
+                continue
+            attribute, label, format = self._telemetryFields[metric]
+            label.setText(format.format(summary['smooth']))
+            label.setStale(False)
+            self._snapshot.update(metric, summary['smooth'])
+            self._smoothedMetrics.add(metric)
+
+        temperature = stats.get(telemetry.ROOM_TEMPERATURE)
+        if temperature is not None and temperature['low'] is not None:
+            self._temperatureRange = ' {0:.1f}/{1:.1f}℃'.format(temperature['low'], temperature['high'])
+            self.__updateClock(datetime.datetime.fromtimestamp(self._scheduler.now(), TIMEZONE))
+        self._labelPressureUnit.setText('hPa' + PRESSURE_TREND_MARKS.get(stats.get('pressureTrend'), ''))
+
+    def __applySnapshot(self):
+        savedTime = self._snapshot.load()
+        if savedTime is None:
+            return
+        for metric, value in self._snapshot.values().items():
+            field = self._telemetryFields.get(metric)
+            if field is None or field[1] is None:
+                continue
+            attribute, label, format = field
+            setattr(self, attribute, value)
+            label.setText(format.format(value))
+            label.setStale(True)
+        self.__applyWeather(self._snapshot.forecast(TIMEZONE), stale=True)
 
     def __updateWeather(self):
-        weathers = weatherinfo.getWeatherForecast()
+        if self._forecastWorker is None:
+            # Subscribed, the collector process fetches the forecast.
+            return
+        if self._forecastWorker.request() == False:
+            print('Forecast fetch still running, skipped.')
+
+    def __setForecasts(self, forecasts):
+        # Keeps the previous forecast of a location that came back empty.
+        merged = {}
+        for name, forecast in forecasts.items():
+            if len(forecast) == 0 and name in self._forecasts:
+                forecast = self._forecasts[name]
+            merged[name] = forecast
+        if len(merged) == 0:
+            return
+        self._forecasts = merged
+        self._forecastIndex %= len(merged)
+        self.__showForecast()
+
+    def __showForecast(self):
+        name = list(self._forecasts)[self._forecastIndex]
+        forecast = self._forecasts[name]
+        if len(forecast) == 0:
+            return
+        self._labelForecastWeathersUnit.setText(name if name != '' and len(self._forecasts) > 1 else '天気')
+        self.__applyWeather(forecast)
+
+    def __applyWeather(self, forecast, stale=False):
+        # Runs on the GUI thread; only touches the 7 forecast slots.
+        start = time.perf_counter()
         for i in range(0, 7):
-            if len(weathers) <= i:
+            if len(forecast) <= i:
                 break
 
-            hour = weathers[i][0].hour
-            self._labelForecastTimes[i].setText("{0:1d}".format(hour))
+            for label in (self._labelForecastTimes[i], self._labelForecastWeathers[i],
+                          self._labelForecastTemps[i], self._labelForecastRains[i]):
+                label.setStale(stale)
 
-            weatherId = weathers[i][1]
-            weatherIdOther = int(weatherId / 100)
-            icons = ClockDisplay.WEATHER_ICON
-            if (hour < 6 or hour >= 18) and weatherId in ClockDisplay.WEATHER_ICON_MOON:
-                icons = ClockDisplay.WEATHER_ICON_MOON
-
-            if weatherId in icons:
-                self._labelForecastWeathers[i].setText(icons[weatherId])
-            elif weatherIdOther in icons:
-                self._labelForecastWeathers[i].setText(
-                    icons[weatherIdOther])
-            else:
-                self._labelForecastWeathers[i].setText('-')
-
-            self._labelForecastWeathers[i].resizeEvent(None)
-
-            self._labelForecastTemps[i].setText(
-                '{:.0f}'.format(weathers[i][2]))
-            self._labelForecastRains[i].setText(
-                '{:.0f}'.format(weathers[i][3]))
-
-    def __updateSpeedTest(self):
-        if USE_SPDTST == True:
-            thread = threading.Thread(target=self.__updateSpeedTestThread, name="updateSpeedTestThread")
-            thread.start()
-
-    def __updateSpeedTestThread(self):
-        for line in self.__executeCommand('speedtest'):
-            if line.find('Upload: ') >= 0:
-                self._valUpload = float(line.split(' ')[1])
-            if line.find('Download: ') >= 0:
-                self._valDownload = float(line.split(' ')[1])
-            if line.find(' ms') >= 0:
-                index1 = line.find(']: ') + 3
-                index2 = line.find(' ms')
-                self._valPing = float(line[index1: index2])
-            
-        print('upload:{0:.2f} download:{1:.2f} ping:{2:.2f}'.format(self._valUpload, self._valDownload, self._valPing))
-        self._labelUpload.setText('{:.1f}'.format(self._valUpload))
-        self._labelDownload.setText('{:.1f}'.format(self._valDownload))
-        self._labelPing.setText('{:.1f}'.format(self._valPing))
-
-        self.__writeCsvThread()
-
-    def __updateCpuInfo(self):
-        thread = threading.Thread(target=self.__updateCpuInfoThread, name="updateCpuInfoThread")
-        thread.start()
+            self._labelForecastTimes[i].setText("{0:1d}".format(forecast.hours[i]))
+            self._labelForecastWeathers[i].setText(forecast.icon(i))
+            self._labelForecastTemps[i].setText('{:.0f}'.format(forecast.temperatures[i]))
+            self._labelForecastRains[i].setText('{:.0f}'.format(forecast.rainfalls[i]))
 
-    def __updateCpuInfoThread(self):
-        self._valCpuUsage = psutil.cpu_percent()
-        if USE_CPUTEMP == True:
-            for line in self.__executeCommand('vcgencmd measure_temp'):
-                self._valCpuTemp = float(line.replace("temp=", "").replace("'C", ""))
-        #print('CPU usage:{0:.2f}% temp:{1:.2f}'.format(self._valCpuUsage, self._valCpuTemp))
-
-    # def __writeCsv(self):
-    #     thread = threading.Thread(target=self.__writeCsvThread, name="writeCsvThread")
-    #     thread.start()
-
-    def __writeCsvThread(self):
-        path = '/var/www/html/roominfo.csv'
-        if os.name == 'nt':
-            path = 'www/roominfo.csv'
-
-        fs = open(path, "at+")
-        fs.seek(0)
-        read = []
-        for line in fs.readlines():
-            read.append(line)
-        fs.close()
-
-        read.append(self.__getRoomInfoOneLine())
-
-        fs = open(path, "wt+")
-        fs.seek(0, 0)
-        for i, w in enumerate(read):
-            if len(read) > 24 * 2 * 7:
-                if i >= 1:
-                    fs.write(w)
-            else:
-                fs.write(w)
-        fs.close()
-
-        if os.name != 'nt':
-            mark = pwd.getpwnam('mark')
-            os.chown(path, mark.pw_uid, mark.pw_gid)
-            os.chmod(path, 0o766)
-
-    def __getRoomInfoOneLine(self):
-        return '{0}, {1}, {2}, {3}, {4}, {5}, {6}, {7}\n'.format(
-            self._valDateTime.strftime("%Y/%m/%d %H:%M:%S %z"),
-            self._valTemperature, self._valHumidity, self._valPressure,
-            self._valCpuTemp,
-            self._valUpload, self._valDownload, self._valPing)
-
-    def __executeCommand(self, cmd):
-        p = Popen(cmd.split(' '), stdout=PIPE, stderr=PIPE)
-        out, err = p.communicate()
-        out = out.decode('utf-8')
-        return [s for s in out.split('\n') if s]
+        self._weatherApplyTime = time.perf_counter() - start
+        _weatherApplyProbe.record(start)
+        if stale == False:
+            self._snapshot.setForecast(forecast)
 
     def setNightMode(self):
-        styleNight = 'QWidget{background-color:#407b8e72;} QLabel, QPushButton{color:#DCF7C9; background-color:#111111;}'
+        styleNight = 'QWidget{background-color:#407b8e72;} QLabel, QPushButton{color:#DCF7C9; background-color:#111111;} QLabel[stale="true"]{color:#6E7C64;}'
         self._app.setStyleSheet(styleNight)
 
     # def setDayMode(self):
     #     styleDay = 'QWidget{background-color:#7b8e72;} QLabel, QPushButton{color:#111111; background-color:#F3F9F1;}'
     #     self._app.setStyleSheet(styleDay)
 
-    def onTimer(self):
-        # now = datetime.datetime.today()
-        now = datetime.datetime.now(timezone('Asia/Tokyo'))
-        self._1SecCount -= 1
-        if self._1SecCount == 0:
-            self._1SecCount = 5     # 200ms timer / 5 count = 1sec
-            self._10SecCount -= 1
-            self._60SecCount -= 1
-
-            self.__updateClock(now)
-
-            if (now.minute == 25 or now.minute == 55) and self._60SecCount == 0:
-                self._halfHourCount1 -= 1
-
-            # if now.hour == 6 and now.minute == 0 and now.second == 0:
-            #     self.setDayMode()
-
-            # if now.hour == 18 and now.minute == 0 and now.second == 0:
-            #     self.setNightMode()
-
-            if self._10SecCount == 0:
-                self._10SecCount = 10
-                self.__updateRoomInfo()
-                self.__updateCpuInfo()
-
-            if self._60SecCount == 0:
-                self._60SecCount = 60
-                # update_ntp_status_thread()
+    def __initializeSchedule(self):
+        # Only the clock until the first frame is up, see __startLive.
+        self._scheduler.every('clock', 1, self.__onClockTask)
+
+    def __registerMetrics(self):
+        # Render and scheduler counters for /metrics and the metrics log line.
+        gauge = metrics.REGISTRY.gauge
+        gauge('gui_label_texts_skipped_total', 'setText calls skipped as unchanged', lambda: QCustomLabel.skippedTexts, 'counter')
+        gauge('gui_label_fonts_skipped_total', 'Font updates skipped as unchanged', lambda: QCustomLabel.skippedFonts, 'counter')
+        gauge('gui_sparkline_column_draws_total', 'Sparkline samples drawn as one column', lambda: QSparkline.columnDraws, 'counter')
+        gauge('gui_sparkline_full_draws_total', 'Sparklines drawn from scratch', lambda: QSparkline.fullDraws, 'counter')
+        gauge('gui_first_frame_seconds', 'Start to first frame', lambda: self._firstFrameTime or 0.0)
+        stats = lambda: self._scheduler.stats().values()
+        gauge('scheduler_missed_total', 'Deadlines folded into a catch-up run, all tasks',
+              lambda: sum([task['missed'] for task in stats()]), 'counter')
+        gauge('scheduler_overruns_total', 'Runs longer than their period, all tasks',
+              lambda: sum([task['overruns'] for task in stats()]), 'counter')
+        gauge('scheduler_max_lateness_seconds', 'Largest lateness of any task',
+              lambda: max([task['maxLateness'] for task in stats()] + [0.0]))
+
+    def __onFirstFrame(self):
+        self._firstFrameTime = time.perf_counter() - _startTime
+        print('First frame in {0:.0f}ms{1}'.format(
+            self._firstFrameTime * 1000, ' (over budget)' if self._firstFrameTime > FIRST_FRAME_BUDGET else ''))
+        self.__startLive()
+
+    def __startLive(self):
+        if PUBSUB_CONNECT:
+            # Thin display: another process owns the sensors, the forecast and the speedtest.
+            from pubsub import TelemetrySubscriber
+            self._subscriber = TelemetrySubscriber(self._telemetry, PUBSUB_CONNECT, TIMEZONE)
+            self._subscriber.start()
+        else:
+            self._forecastWorker = ForecastWorker(self._telemetry)
+        self._scheduler.cron('weather', HALF_HOUR_MINUTES, self.__onWeatherTask, jitter=SCHEDULE_JITTER)
+        self._scheduler.every('forecastRotate', FORECAST_ROTATE, self.__onForecastRotateTask, runAtStart=False)
+        self._power = PowerPolicy(TIMEZONE)
+        if self._power.configured() == True:
+            self._scheduler.every('powerMode', POWER_CHECK_INTERVAL, self.__onPowerModeTask)
+        self.onTimer()
+        if self._subscriber is not None:
+            return
+        # Opening the sensors and the history files blocks, keep it off the GUI thread.
+        thread = threading.Thread(target=self.__createCollector, name='collectorStart', daemon=True)
+        thread.start()
 
-            if self._halfHourCount1 <= 0:
-                self._halfHourCount1 = 1
-                self._valDateTime = now
-                print('{0} -----------'.format(now))
-                self.__updateWeather()
-                self.__updateSpeedTest()
-                print('------------------------')
+    def __createCollector(self):
+        # Runs on the start thread until the collector is up; the clock and
+        # the forecast keep running meanwhile.
+        try:
+            from collector import Collector, isTransient
+        except Exception as e:
+            self._telemetryPump.collectorFailed.emit('{0}: {1}'.format(type(e).__name__, e))
+            return
+        delay = COLLECTOR_RETRY
+        while True:
+            collector = None
+            try:
+                # A failed Collector() closes what it started itself.
+                collector = Collector(self._telemetry, self._clock)
+                # The history query reads the disk too, so the sparklines are filled from here.
+                samples = dict([(metric, collector.recentSamples(metric, sparkline.window))
+                                for metric, sparkline in self._sparklines.items()])
+                break
+            except Exception as e:
+                if collector is not None:
+                    collector.close()
+                if isTransient(e) == False:
+                    # A corrupt file or a bad setting, another try fails the same way.
+                    self._telemetryPump.collectorFailed.emit('{0}: {1} (not retried)'.format(type(e).__name__, e))
+                    return
+                self._telemetryPump.collectorFailed.emit('{0}: {1} (retry in {2}s)'.format(type(e).__name__, e, delay))
+                time.sleep(delay)
+                delay = min(delay * 2, COLLECTOR_RETRY_MAX)
+        self._telemetryPump.collectorReady.emit((collector, samples))
+
+    def __onCollectorFailed(self, message):
+        # No room or network values until a retry works, the snapshot ones are shown as old.
+        print('Collector start failed: {0}'.format(message))
+        for attribute, label, format in self._telemetryFields.values():
+            if label is not None:
+                label.setStale(True)
+
+    def __onCollectorReady(self, ready):
+        collector, samples = ready
+        self._collector = collector
+        for metric, sparkline in self._sparklines.items():
+            sparkline.extend(samples.get(metric, []))
+        self._collector.schedule(self._scheduler)
+        self._collector.setPowerSave(self._powerSave)
+        self.onTimer()
+
+    def __onQuit(self):
+        if self._forecastWorker is not None:
+            self._forecastWorker.stop()
+        if self._subscriber is not None:
+            self._subscriber.stop()
+        if self._collector is not None:
+            self._collector.close()
+        self._snapshot.flush(force=True)
+
+    def __onClockTask(self, now):
+        self.__updateClock(datetime.datetime.fromtimestamp(now, TIMEZONE))
+
+    def __onWeatherTask(self, now):
+        self._valDateTime = datetime.datetime.fromtimestamp(now, TIMEZONE)
+        self.__updateWeather()
+
+    def __onPowerModeTask(self, now):
+        reason = self._power.idle(now)
+        self._power.measure(self._scheduler)
+        if (reason is not None) != self._powerSave:
+            print('Power save {0}{1}: {2:.2f} wake-ups/s, CPU {3:.1f}%'.format(
+                'on' if reason is not None else 'off', ' (' + reason + ')' if reason is not None else '',
+                self._power.wakeupRate, self._power.cpuLoad * 100))
+            self.setPowerSave(reason is not None)
+
+    def setPowerSave(self, enabled):
+        # The clock ticks on the minute without seconds, the forecast stops
+        # rotating and the collector reads the room once a minute. Called from
+        # a scheduler task, onTimer picks up the new deadlines after it.
+        if enabled == self._powerSave:
+            return
+        self._powerSave = enabled
+        self._scheduler.setInterval('clock', POWER_SAVE_INTERVAL if enabled == True else 1)
+        if self._scheduler.task('forecastRotate') is not None:
+            self._scheduler.setEnabled('forecastRotate', not enabled)
+        if self._collector is not None:
+            self._collector.setPowerSave(enabled)
+        self.__updateClock(datetime.datetime.fromtimestamp(self._scheduler.now(), TIMEZONE))
+
+    def __onForecastRotateTask(self, now):
+        if len(self._forecasts) <= 1:
+            return
+        self._forecastIndex = (self._forecastIndex + 1) % len(self._forecasts)
+        self.__showForecast()
+
+    def start(self):
+        self.__initializeSchedule()
+        self.onTimer()
+
+    @_tickProbe
+    def onTimer(self):
+        # Runs what is due, then sleeps until the next deadline.
+        if self._timerTarget is not None:
+            _loopLag.observe(max(0.0, self._scheduler.now() - self._timerTarget))
+            self._timerTarget = None
+        self._scheduler.runDue()
+        deadline = self._scheduler.nextDeadline()
+        if deadline is None:
+            return
+        # A little past the boundary so the new second is already visible.
+        delay = (deadline - self._scheduler.now()) * 1000 + 2
+        self._timer.start(max(0, int(delay)))
+        self._timerTarget = deadline + 0.002
 
 
 if __name__ == '__main__':
@@ -402,10 +851,7 @@ if __name__ == '__main__':
     layout.setVerticalSpacing(2)
 
     dispItems = ClockDisplay(app, window)
-
-    timer = QTimer()
-    timer.timeout.connect(dispItems.onTimer)
-    timer.start(200)
+    dispItems.start()
 
     # now = datetime.datetime.today()
     # if now.hour >= 18:
@@ -0,0 +1,45 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Sensor reads per second and bus transactions per sample on the fake SMBus.
+# usage: python3 benchmark/bench_bme280.py
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bme280
+from fakesmbus import FakeSMBus
+
+SAMPLES = 2000
+BYTE_TIME_100KHZ = 9 / 100000.0     # 9 clocks per byte
+TRANSACTION_TIME_100KHZ = 30 / 100000.0
+
+
+def benchSensor(name, bus, samples=SAMPLES, **options):
+    sensor = bme280.bme280(bus=bus, **options)
+    bus.resetCounters()
+    start = time.perf_counter()
+    for i in range(samples):
+        sensor.getStatus()
+    elapsed = time.perf_counter() - start
+    print('{0:<24s} {1:9.0f} reads/s  {2:5.1f} transactions/sample  {3:5.1f} bytes/sample'.format(
+        name, samples / elapsed, bus.transactions / samples, (bus.bytesRead + bus.bytesWritten) / samples))
+
+
+def benchCalibration():
+    bus = FakeSMBus()
+    bme280.bme280(bus=bus)
+    print('{0:<24s} {1:5d} transactions'.format('init + calibration', bus.transactions))
+
+
+if __name__ == '__main__':
+    benchCalibration()
+    benchSensor('normal, no bus delay', FakeSMBus())
+    benchSensor('normal, 100kHz bus', FakeSMBus(byteTime=BYTE_TIME_100KHZ,
+                                                transactionTime=TRANSACTION_TIME_100KHZ), samples=200)
+    benchSensor('forced, 100kHz bus', FakeSMBus(byteTime=BYTE_TIME_100KHZ,
+                                                transactionTime=TRANSACTION_TIME_100KHZ), samples=100,
+                mode=bme280.MODE_FORCED)
@@ -0,0 +1,83 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Throughput of the BME280 compensation paths.
+# usage: python3 benchmark/bench_compensation.py
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bme280
+from fakesmbus import FakeSMBus
+
+SAMPLES = 100000
+
+
+def legacyCompensate(c, temp_raw, pres_raw, hum_raw):
+    # The module-global, string returning code that bme280.getStatus used before.
+    T, P, H = c.T, c.P, c.H
+    v1 = (temp_raw / 16384.0 - T[0] / 1024.0) * T[1]
+    v2 = (temp_raw / 131072.0 - T[0] / 8192.0) * (
+        temp_raw / 131072.0 - T[0] / 8192.0) * T[2]
+    fine = v1 + v2
+    temperature = str("%4.1f" % (fine / 5120.0))
+
+    var_h = fine - 76800.0
+    var_h = (hum_raw - (H[3] * 64.0 + H[4] / 16384.0 * var_h)) * (
+        H[1] / 65536.0 * (1.0 + H[5] / 67108864.0 * var_h * (1.0 + H[2] / 67108864.0 * var_h)))
+    var_h = var_h * (1.0 - H[0] * var_h / 524288.0)
+    humidity = str("%2.0f" % min(max(var_h, 0.0), 100.0))
+
+    v1 = (fine / 2.0) - 64000.0
+    v2 = (((v1 / 4.0) * (v1 / 4.0)) / 2048) * P[5]
+    v2 = v2 + ((v1 * P[4]) * 2.0)
+    v2 = (v2 / 4.0) + (P[3] * 65536.0)
+    v1 = (((P[2] * (((v1 / 4.0) * (v1 / 4.0)) / 8192)) / 8) + ((P[1] * v1) / 2.0)) / 262144
+    v1 = ((32768 + v1) * P[0]) / 32768
+    pressure = ((1048576 - pres_raw) - (v2 / 4096)) * 3125
+    if pressure < 0x80000000:
+        pressure = (pressure * 2.0) / v1
+    else:
+        pressure = (pressure / v1) * 2
+    v1 = (P[8] * (((pressure / 8.0) * (pressure / 8.0)) / 8192.0)) / 4096
+    v2 = ((pressure / 4.0) * P[7]) / 8192.0
+    pressure = pressure + ((v1 + v2 + P[6]) / 16.0)
+    return [temperature, humidity, str("%3.0f" % (pressure / 100))]
+
+
+def report(name, elapsed, samples):
+    print('{0:<28s} {1:12.0f} samples/s'.format(name, samples / elapsed))
+
+
+def bench(name, fn, c, raws):
+    start = time.perf_counter()
+    for r in raws:
+        fn(c, *r)
+    report(name, time.perf_counter() - start, len(raws))
+
+
+if __name__ == '__main__':
+    c = bme280.bme280(bus=FakeSMBus()).compensation
+    random.seed(1)
+    raws = [(random.randint(480000, 560000), random.randint(380000, 440000), random.randint(20000, 40000))
+            for i in range(SAMPLES)]
+
+    bench('legacy scalar (strings)', legacyCompensate, c, raws)
+    bench('compensate (float)', bme280.Compensation.compensate, c, raws)
+    bench('compensateInt (fixed point)', bme280.Compensation.compensateInt, c, raws)
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is not None:
+        temp, pres, hum = [numpy.array(v) for v in zip(*raws)]
+        start = time.perf_counter()
+        c.compensateArray(temp, pres, hum)
+        report('compensateArray (numpy)', time.perf_counter() - start, SAMPLES)
+    else:
+        print('compensateArray (numpy)      skipped, numpy is not installed')
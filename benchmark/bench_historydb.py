@@ -0,0 +1,63 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Batched write cost, range query latency and file size of the history
+# database, fed a week of 10 second samples for five metrics.
+# usage: python3 benchmark/bench_historydb.py [days]
+
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from historydb import HistoryDb, HISTORYDB_FLUSH
+
+METRICS = ['room.temperature', 'room.humidity', 'room.pressure', 'cpu.usage', 'cpu.temperature']
+INTERVAL = 10
+
+
+def benchHistoryDb(days=7):
+    # Returns (us per written sample, raw day query ms, hour week query ms, bytes per sample).
+    tz = datetime.timezone(datetime.timedelta(hours=9))
+    end = time.time() // 3600 * 3600
+    start = end - days * 86400
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.sqlite3')
+        db = HistoryDb(path, tz)
+        samples = 0
+        writing = 0.0
+        nextFlush = start + HISTORYDB_FLUSH
+        t = start
+        while t < end:
+            for i, metric in enumerate(METRICS):
+                db.record(metric, 20.0 + i + (t % 3600) / 3600.0, t)
+                samples += 1
+            t += INTERVAL
+            if t >= nextFlush:
+                begin = time.perf_counter()
+                db.flush(t)
+                writing += time.perf_counter() - begin
+                nextFlush += HISTORYDB_FLUSH
+
+        queries = 20
+        begin = time.perf_counter()
+        for i in range(queries):
+            db.query(METRICS[i % len(METRICS)], end - 86400, end, 'raw')
+        rawQuery = (time.perf_counter() - begin) / queries
+        begin = time.perf_counter()
+        for i in range(queries):
+            db.query(METRICS[i % len(METRICS)], start, end, 'hour')
+        hourQuery = (time.perf_counter() - begin) / queries
+        db.close()
+        size = os.path.getsize(path)
+    return writing / samples, rawQuery, hourQuery, size / samples
+
+
+if __name__ == '__main__':
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+    write, rawQuery, hourQuery, size = benchHistoryDb(days)
+    print('{0} days: write {1:.2f} us/sample  raw day query {2:.2f} ms  hour query {3:.2f} ms  {4:.1f} bytes/sample'.format(
+        days, write * 1e6, rawQuery * 1000, hourQuery * 1000, size))
@@ -0,0 +1,61 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Per sample overhead of the metrics layer and cost of rendering it.
+# usage: python3 benchmark/bench_metrics.py
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import metrics
+
+CALLS = 200000
+
+
+def report(name, seconds, calls):
+    print('{0:<28} {1:8.3f} us/call'.format(name, seconds / calls * 1e6))
+
+
+def work():
+    return None
+
+
+if __name__ == '__main__':
+    registry = metrics.Registry()
+    probe = registry.probe('bench', 'Benchmark')
+    timed = probe(work)
+    histogram = registry.histogram('bench_values_seconds', 'Benchmark values')
+
+    start = time.perf_counter()
+    for i in range(CALLS):
+        work()
+    bare = time.perf_counter() - start
+    report('bare call', bare, CALLS)
+
+    start = time.perf_counter()
+    for i in range(CALLS):
+        timed()
+    wrapped = time.perf_counter() - start
+    report('probe decorated call', wrapped, CALLS)
+    report('  overhead', wrapped - bare, CALLS)
+
+    start = time.perf_counter()
+    for i in range(CALLS):
+        probe.record(start)
+    report('probe.record', time.perf_counter() - start, CALLS)
+
+    start = time.perf_counter()
+    for i in range(CALLS):
+        histogram.observe(0.0042)
+    report('histogram.observe', time.perf_counter() - start, CALLS)
+
+    for i in range(20):
+        registry.probe('path{0}'.format(i), 'Path {0}'.format(i)).record(time.perf_counter())
+    start = time.perf_counter()
+    for i in range(1000):
+        text = registry.exposition()
+    report('exposition (21 probes)', time.perf_counter() - start, 1000)
+    print('exposition size {0} bytes'.format(len(text)))
@@ -0,0 +1,70 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Publisher cost and delivery latency of the telemetry socket with one and
+# with many subscribed displays, all in this process over a Unix socket.
+# usage: python3 benchmark/bench_pubsub.py
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pubsub import TelemetryPublisher, TelemetrySubscriber, PUBSUB_BATCH
+from telemetry import TelemetryBus
+
+CLIENTS = [1, 50]
+SAMPLES = 100
+# Longer than a batch, so every sample travels in its own delta frame.
+INTERVAL = PUBSUB_BATCH * 1.2
+
+
+def benchPubSub(clients):
+    # Returns (us per publish on the collector side, median delivery ms, bytes per sample sent).
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        bus = TelemetryBus()
+        publisher = TelemetryPublisher(bus, 'unix:' + os.path.join(tmp, 'telemetry.sock'))
+        publisher.start()
+        latencies = []
+
+        def onSample(sample):
+            if sample.metric == 'bench.sent':
+                latencies.append(time.time() - sample.value)
+
+        subscribers = []
+        for i in range(clients):
+            local = TelemetryBus()
+            local.addTap(onSample)
+            subscriber = TelemetrySubscriber(local, 'unix:' + os.path.join(tmp, 'telemetry.sock'))
+            subscriber.start()
+            subscribers.append(subscriber)
+        deadline = time.monotonic() + 10
+        while publisher.clients() < clients and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        publishing = 0.0
+        for i in range(SAMPLES):
+            start = time.perf_counter()
+            bus.publish('room.temperature', 20.0 + i * 0.01)
+            bus.publish('bench.sent', time.time())
+            publishing += time.perf_counter() - start
+            time.sleep(INTERVAL)
+        time.sleep(0.5)
+        sent = publisher.bytes
+        for subscriber in subscribers:
+            subscriber.stop()
+        publisher.stop()
+    latencies.sort()
+    # The delivery time includes waiting for the end of the batch.
+    return publishing / (SAMPLES * 2), latencies[len(latencies) // 2], sent / (SAMPLES * 2)
+
+
+if __name__ == '__main__':
+    for clients in CLIENTS:
+        publish, latency, size = benchPubSub(clients)
+        print('{0:>3} clients: publish {1:6.2f} us  delivery {2:6.2f} ms  {3:5.1f} bytes/sample'.format(
+            clients, publish * 1e6, latency * 1000, size))
@@ -0,0 +1,89 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Replay speed of the headless collector over a made up trace: a BME280
+# read every 10 seconds and a forecast every half hour for a week, recorded
+# through the same wrappers as a live run.
+# usage: python3 benchmark/bench_replay.py [days]
+
+import contextlib
+import io
+import math
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import fakesmbus
+
+INTERVAL = 10
+FORECAST_INTERVAL = 30 * 60
+FORECAST_URL = 'http://replay.invalid/forecast?zip={zip}&units=metric&appid={key}'
+ZIP = '100-0001,JP'
+
+
+def makeTrace(path, days):
+    # Returns the number of records written.
+    import bme280
+    import replay
+    from fakeowm import PAYLOAD_PATH
+    with open(PAYLOAD_PATH, 'rt', encoding='utf-8') as fs:
+        payload = fs.read()
+    start = time.time() // 3600 * 3600 - days * 86400
+    clock = replay.VirtualClock(start)
+    recorder = replay.Recorder(path, clock)
+    regs = fakesmbus.bme280Registers()
+    bus = replay.RecordingSMBus(fakesmbus.FakeSMBus(1, {0x76: regs}), 1, recorder)
+    bus.read_byte_data(0x76, bme280.REG_CHIP_ID)
+    sensor = bme280.bme280(bus=bus, address=0x76)
+    session = replay.RecordingSession(_PayloadSession(payload), recorder)
+    for i in range(int(days * 86400 / INTERVAL)):
+        clock.now = start + i * INTERVAL
+        day = 2 * math.pi * i * INTERVAL / 86400
+        fakesmbus.setRaw(regs, 519888 + int(8000 * math.sin(day)), 415148 + i % 50, 30000 + int(2000 * math.cos(day)))
+        sensor.getValues()
+        if i * INTERVAL % FORECAST_INTERVAL == 0:
+            session.get(FORECAST_URL.format(zip=ZIP, key='x'))
+    recorder.close()
+    return recorder.records
+
+
+class _PayloadSession:
+    # Live session stand-in for makeTrace.
+    def __init__(self, payload):
+        self._payload = payload
+
+    def get(self, url, **kwargs):
+        import requests
+        response = requests.Response()
+        response.status_code = 200
+        response.encoding = 'utf-8'
+        response._content = self._payload.encode('utf-8')
+        return response
+
+
+def benchReplay(days=7):
+    # Returns (wall seconds, virtual seconds per wall second, trace bytes per record).
+    os.environ['FORECAST_URL'] = FORECAST_URL
+    os.environ['ZIP'] = ZIP
+    os.environ['FORECAST_TTL'] = '0'
+    os.environ['FORECAST_RATE_LIMIT'] = '0'
+    fakesmbus.install()
+    import replay
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['FORECAST_CACHE'] = os.path.join(tmp, 'forecast.json')
+        path = os.path.join(tmp, 'week.jsonl.gz')
+        records = makeTrace(path, days)
+        size = os.path.getsize(path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            span, wall = replay.play(path, directory=tmp)
+    return wall, span / wall, size / records
+
+
+if __name__ == '__main__':
+    days = float(sys.argv[1]) if len(sys.argv) > 1 else 7
+    wall, speedup, size = benchReplay(days)
+    print('{0:g} days replayed in {1:.1f}s ({2:.0f}x), {3:.1f} trace bytes per record'.format(days, wall, speedup, size))
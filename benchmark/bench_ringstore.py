@@ -0,0 +1,41 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Append cost of the history ring file at several retention sizes, with the
+# per append flush the store does by default and without it.
+# usage: python3 benchmark/bench_ringstore.py
+
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ringstore import RingStore
+
+RETENTIONS = [24 * 2 * 7, 10000, 100000, 1000000]
+APPENDS = 20000
+SYNC_APPENDS = 2000         # each one waits for the disk
+
+
+def benchAppend(capacity, sync=True):
+    tz = datetime.timezone(datetime.timedelta(hours=9))
+    with tempfile.TemporaryDirectory() as tmp:
+        store = RingStore(os.path.join(tmp, 'bench.ring'), capacity, 7, sync)
+        now = datetime.datetime.now(tz)
+        values = [24.5, 45.0, 1013.0, 48.3, 12.3, 95.1, 9.8]
+        start = time.perf_counter()
+        appends = SYNC_APPENDS if sync == True else APPENDS
+        for i in range(appends):
+            store.append(now, values)
+        elapsed = time.perf_counter() - start
+        store.close()
+    return elapsed / appends
+
+
+if __name__ == '__main__':
+    for capacity in RETENTIONS:
+        print('retention {0:>8d}: append {1:7.2f} us, without sync {2:7.2f} us'.format(
+            capacity, benchAppend(capacity) * 1e6, benchAppend(capacity, False) * 1e6))
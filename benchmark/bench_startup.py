@@ -0,0 +1,96 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Startup time and peak memory of the headless collector against the GUI.
+# Each mode runs in a fresh interpreter; the GUI uses the offscreen platform.
+# usage: python3 benchmark/bench_startup.py [runs]
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+HEADLESS = '''
+import time
+start = time.perf_counter()
+import collector, scheduler, sys, telemetry
+c = collector.Collector(telemetry.TelemetryBus())
+c.schedule(scheduler.Scheduler(collector.TIMEZONE))
+print(time.perf_counter() - start, 'PyQt5' in sys.modules)
+'''
+
+GUI = '''
+import time
+start = time.perf_counter()
+import sys
+from PyQt5.QtWidgets import QApplication, QGridLayout, QWidget
+import ClockWithWeatherForecast as gui
+app = QApplication(sys.argv)
+window = QWidget()
+gui.layout = QGridLayout()
+display = gui.ClockDisplay(app, window)
+display.start()
+window.setLayout(gui.layout)
+window.show()
+app.processEvents()
+print(time.perf_counter() - start, 'PyQt5' in sys.modules)
+'''
+
+MODES = [('headless', HEADLESS), ('gui', GUI)]
+
+
+def runOnce(code, env):
+    # Returns (seconds to ready, wall seconds, max RSS in MB, Qt loaded) or None.
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out = proc.stdout.read()
+    err = proc.stderr.read()
+    pid, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    if status != 0:
+        print(err.decode('utf-8', 'replace').strip().splitlines()[-1])
+        return None
+    ready, qt = out.decode('utf-8').strip().splitlines()[-1].split()
+    return float(ready), wall, usage.ru_maxrss / 1024.0, qt == 'True'
+
+
+def isolatedEnv(tmp):
+    # Keeps the runs away from the real history, snapshot and dashboard port.
+    env = dict(os.environ)
+    env['HISTORY_PATH'] = os.path.join(tmp, 'roominfo.ring')
+    env['SNAPSHOT_PATH'] = os.path.join(tmp, 'snapshot.json')
+    env['FORECAST_CACHE'] = os.path.join(tmp, 'forecast.json')
+    env['HISTORYDB_PATH'] = os.path.join(tmp, 'history.sqlite3')
+    env['DASHBOARD_PORT'] = '0'
+    env['QT_QPA_PLATFORM'] = 'offscreen'
+    return env
+
+
+def measure(code, env, runs):
+    # Median ready and process time, max RSS and whether Qt was loaded; None when every run failed.
+    results = [runOnce(code, env) for i in range(runs)]
+    results = [r for r in results if r is not None]
+    if len(results) == 0:
+        return None
+    ready = sorted([r[0] for r in results])[len(results) // 2]
+    wall = sorted([r[1] for r in results])[len(results) // 2]
+    rss = max([r[2] for r in results])
+    return ready, wall, rss, results[0][3]
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as tmp:
+        env = isolatedEnv(tmp)
+        for name, code in MODES:
+            result = measure(code, env, runs)
+            if result is None:
+                print('{0:>8}: failed'.format(name))
+                continue
+            ready, wall, rss, qt = result
+            print('{0:>8}: ready {1:7.1f} ms  process {2:7.1f} ms  max rss {3:6.1f} MB  PyQt5 loaded: {4}'.format(
+                name, ready * 1000, wall * 1000, rss, qt))
@@ -0,0 +1,42 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Update throughput of the room statistics (1 minute, 1 hour and 24 hour
+# windows, EWMA, spike filter, daily range) at sensor rates far above the
+# 0.1 Hz the display polls at, and the buckets a full 24 hour window holds.
+# usage: python3 benchmark/bench_streamstats.py [samples]
+
+import datetime
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import telemetry
+
+from streamstats import RoomStats
+
+RATES = [0.1, 100, 1000]    # samples per second
+SAMPLES = 200000
+
+
+def benchStreamStats(rate, samples=SAMPLES):
+    # Returns (samples per second, buckets in the longest window).
+    stats = RoomStats(datetime.timezone(datetime.timedelta(hours=9)))
+    start = time.time() - samples / rate
+    values = [20.0 + 3.0 * math.sin(i / 5000.0) + (5.0 if i % 997 == 0 else 0.0) for i in range(samples)]
+    add = stats.add
+    begin = time.perf_counter()
+    for i in range(samples):
+        add(telemetry.ROOM_TEMPERATURE, start + i / rate, values[i])
+    elapsed = time.perf_counter() - begin
+    return samples / elapsed, stats.metrics[telemetry.ROOM_TEMPERATURE].windows[-1].buckets
+
+
+if __name__ == '__main__':
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else SAMPLES
+    for rate in RATES:
+        throughput, buckets = benchStreamStats(rate, samples)
+        print('{0:g} Hz: {1:.0f} samples/s, {2} buckets in the longest window'.format(rate, throughput, buckets))
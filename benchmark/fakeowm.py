@@ -0,0 +1,77 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Local stand-in for the OpenWeatherMap /forecast endpoint.
+# Serves a recorded payload (benchmark/data/forecast.json) with an ETag, so
+# weatherinfo can be measured without network access or an API key:
+#   FORECAST_URL=http://127.0.0.1:8766/data/2.5/forecast?zip={zip}&units=metric&APPID={key}
+# usage: python3 benchmark/fakeowm.py [port]
+
+import hashlib
+import http.server
+import os
+import sys
+import threading
+import time
+
+PAYLOAD_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'forecast.json')
+
+
+class FakeForecastHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.delay > 0:
+            # Stands in for the round trip to the real API.
+            time.sleep(server.delay)
+        if not self.path.startswith('/data/2.5/forecast'):
+            self.send_error(404)
+            return
+        if self.headers.get('If-None-Match') == server.etag:
+            server.notModified += 1
+            self.send_response(304)
+            self.send_header('ETag', server.etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(server.payload)))
+        self.send_header('ETag', server.etag)
+        self.end_headers()
+        self.wfile.write(server.payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeForecastServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, payloadPath=PAYLOAD_PATH, delay=0.0):
+        super(FakeForecastServer, self).__init__(('127.0.0.1', port), FakeForecastHandler)
+        with open(payloadPath, 'rb') as fs:
+            self.payload = fs.read()
+        self.etag = '"{0}"'.format(hashlib.sha1(self.payload).hexdigest()[:16])
+        self.delay = delay
+        self.requests = 0
+        self.notModified = 0
+
+    @property
+    def url(self):
+        # In the format of weatherinfo.API_URL.
+        return 'http://127.0.0.1:{0}/data/2.5/forecast?zip={{zip}}&units=metric&APPID={{key}}'.format(
+            self.server_address[1])
+
+    def startThread(self):
+        thread = threading.Thread(target=self.serve_forever, name='fakeOwm', daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == '__main__':
+    server = FakeForecastServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8766)
+    print('FORECAST_URL={0}'.format(server.url))
+    server.serve_forever()
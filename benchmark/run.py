@@ -0,0 +1,530 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Benchmark suite with a stored baseline.
+# Every group runs in a fresh interpreter on a plain Linux box: BME280s on
+# the fake smbus, the forecast from a local OpenWeatherMap stand-in and the
+# display on the offscreen Qt platform. Groups whose dependencies are not
+# installed are reported as skipped.
+# usage:
+#   python3 benchmark/run.py [group ...]          compare with the baseline
+#   python3 benchmark/run.py --save [group ...]   store the results as the new baseline
+#   python3 benchmark/run.py --check              exit 1 when a result regressed (or there is no baseline)
+# Each group runs REPEATS times and the best value of a result is kept, with
+# the spread of the runs. Sizes and counts (STABLE_UNITS) regress beyond
+# THRESHOLD; timings beyond TIMING_THRESHOLD, since on a shared box they move
+# by a third or more between runs of the same code. Either limit grows to
+# twice the spread of the baseline and of this run together, as three runs
+# understate how far a noisy result wanders. A group with a regressed result
+# runs REPEATS times more and is compared again with all its runs, so a
+# passing slow spell of the machine is not reported. The committed baseline.json
+# names the machine and Python it was saved on; save a new one (of the whole
+# suite, the groups run slower after each other than alone) before comparing
+# on other hardware.
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+THRESHOLD = 10.0        # percent, sizes and counts
+TIMING_THRESHOLD = 50.0 # percent, everything measured in time
+STABLE_UNITS = ('bytes', 'MB', 'wakeups/s')
+REPEATS = 3             # runs of each group, in a fresh interpreter each
+RETENTIONS = [24 * 2 * 7, 10000, 100000]
+TICKS = 300
+SPARKLINE_HOURS = [1, 12, 48]
+SPARKLINE_SAMPLES = 2000
+LOCATIONS = [1, 2, 4, 8]
+POWER_SECONDS = 60 * 60     # simulated time per power mode
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _result(value, unit, better='lower'):
+    return {'value': value, 'unit': unit, 'better': better}
+
+
+def _best(runs):
+    # Best value of every result over the runs of a group, with the spread
+    # (max - min) of the runs in percent of the best.
+    results = {}
+    for name in runs[0]:
+        values = [run[name]['value'] for run in runs if name in run]
+        best = min(values) if runs[0][name]['better'] == 'lower' else max(values)
+        result = dict(runs[0][name])
+        result['value'] = best
+        result['spread'] = (max(values) - min(values)) / abs(best) * 100 if best != 0 else 0.0
+        results[name] = result
+    return results
+
+
+class _Skip(Exception):
+    pass
+
+
+def _require(*modules):
+    for name in modules:
+        try:
+            __import__(name)
+        except ImportError as e:
+            raise _Skip(str(e))
+
+
+def benchParse(tmp):
+    # Forecast parse throughput and a full fetch against the local stand-in.
+    _require('requests')
+    from fakeowm import FakeForecastServer, PAYLOAD_PATH
+    server = FakeForecastServer()
+    server.startThread()
+    os.environ['FORECAST_URL'] = server.url
+    os.environ['FORECAST_CACHE'] = os.path.join(tmp, 'forecast.json')
+    os.environ['FORECAST_TTL'] = '0'
+    # The fetches below would otherwise wait for the 60 per minute limit.
+    os.environ['FORECAST_RATE_LIMIT'] = '0'
+    import weatherinfo
+
+    with open(PAYLOAD_PATH, 'rt', encoding='utf-8') as fs:
+        payload = json.load(fs)
+    rounds = 50
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for i in range(rounds):
+            weatherinfo._parseForecast(payload)
+        parse = time.perf_counter() - start
+
+        fetches = []
+        for i in range(20):
+            start = time.perf_counter()
+            weatherinfo.getWeatherForecast()
+            fetches.append(time.perf_counter() - start)
+    server.shutdown()
+    return {
+        'forecast_parse_items_per_s': _result(rounds * len(payload['list']) / parse, 'items/s', 'higher'),
+        'forecast_fetch_ms': _result(_median(fetches) * 1000, 'ms'),
+    }
+
+
+def benchLocations(tmp):
+    # Wall time of one forecast round for 1 to 8 locations against a stand-in with 50ms latency.
+    _require('requests')
+    from fakeowm import FakeForecastServer
+    server = FakeForecastServer(delay=0.05)
+    server.startThread()
+    os.environ['FORECAST_URL'] = server.url
+    os.environ['FORECAST_TTL'] = '0'
+    os.environ['FORECAST_RATE_LIMIT'] = '0'
+    os.environ['FORECAST_POOL_SIZE'] = '8'
+    from forecastservice import ForecastService
+
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for count in LOCATIONS:
+            service = ForecastService([(str(i), '{0:03d}-0000,JP'.format(i)) for i in range(count)])
+            rounds = []
+            for i in range(5):
+                service.fetch()
+                rounds.append(service.lastDuration)
+            service.close()
+            results['forecast_{0}_locations_ms'.format(count)] = _result(_median(rounds) * 1000, 'ms')
+    server.shutdown()
+    return results
+
+
+def benchSensor(tmp):
+    # Compensated samples per second, one sensor and two buses with two sensors each.
+    import fakesmbus
+    fakesmbus.install()
+    import bme280
+    from sensormanager import SensorManager
+
+    sensor = bme280.bme280(bus=fakesmbus.FakeSMBus())
+    samples = 5000
+    start = time.perf_counter()
+    for i in range(samples):
+        sensor.getValues()
+    single = samples / (time.perf_counter() - start)
+
+    def openBus(busNumber):
+        return fakesmbus.FakeSMBus(busNumber, {0x76: fakesmbus.bme280Registers(), 0x77: fakesmbus.bme280Registers()})
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        manager = SensorManager([1, 3], [0x76, 0x77], openBus)
+    polls = 500
+    start = time.perf_counter()
+    for i in range(polls):
+        manager.pollWait()
+    managed = polls * len(manager) / (time.perf_counter() - start)
+    return {
+        'sensor_samples_per_s': _result(single, 'samples/s', 'higher'),
+        'sensor_manager_samples_per_s': _result(managed, 'samples/s', 'higher'),
+    }
+
+
+def benchStreamStats(tmp):
+    import bench_streamstats
+    results = {}
+    for rate in bench_streamstats.RATES:
+        throughput, buckets = bench_streamstats.benchStreamStats(rate)
+        results['stats_{0:g}hz_samples_per_s'.format(rate)] = _result(throughput, 'samples/s', 'higher')
+    return results
+
+
+def benchHistory(tmp):
+    import bench_ringstore
+    # The synced appends wait for the disk, so the writes of the groups before go out first.
+    os.sync()
+    results = {}
+    for capacity in RETENTIONS:
+        # Best of three, the default synced append, then the bare cost without the flush.
+        best = min([bench_ringstore.benchAppend(capacity) for i in range(3)])
+        results['history_append_{0}_us'.format(capacity)] = _result(best * 1e6, 'us')
+        best = min([bench_ringstore.benchAppend(capacity, False) for i in range(3)])
+        results['history_append_{0}_nosync_us'.format(capacity)] = _result(best * 1e6, 'us')
+    return results
+
+
+def benchHistoryDb(tmp):
+    import bench_historydb
+    write, rawQuery, hourQuery, size = bench_historydb.benchHistoryDb()
+    return {
+        'historydb_write_us': _result(write * 1e6, 'us'),
+        'historydb_raw_day_query_ms': _result(rawQuery * 1000, 'ms'),
+        'historydb_hour_week_query_ms': _result(hourQuery * 1000, 'ms'),
+        'historydb_bytes_per_sample': _result(size, 'bytes'),
+    }
+
+
+def benchPubSub(tmp):
+    import bench_pubsub
+    results = {}
+    for clients in bench_pubsub.CLIENTS:
+        publish, latency, size = bench_pubsub.benchPubSub(clients)
+        results['pubsub_publish_{0}_clients_us'.format(clients)] = _result(publish * 1e6, 'us')
+        results['pubsub_delivery_{0}_clients_ms'.format(clients)] = _result(latency * 1000, 'ms')
+    results['pubsub_bytes_per_sample'] = _result(size, 'bytes')
+    return results
+
+
+def benchReplay(tmp):
+    # A made up week of sensor reads and forecasts through the headless collector.
+    _require('requests')
+    import bench_replay
+    wall, speedup, size = bench_replay.benchReplay()
+    return {
+        'replay_week_s': _result(wall, 's'),
+        'replay_speedup': _result(speedup, 'x', 'higher'),
+        'replay_trace_bytes_per_record': _result(size, 'bytes'),
+    }
+
+
+def benchTick(tmp):
+    # ClockDisplay on the offscreen platform, driven by a virtual clock one second per tick.
+    _require('PyQt5', 'requests')
+    from fakeowm import FakeForecastServer
+    import fakesmbus
+    fakesmbus.install()
+    server = FakeForecastServer()
+    server.startThread()
+    os.environ['FORECAST_URL'] = server.url
+    os.environ['SENSOR_BUSES'] = '1'
+
+    from PyQt5.QtWidgets import QApplication, QGridLayout, QWidget
+    import ClockWithWeatherForecast as gui
+
+    class VirtualClock:
+        def __init__(self):
+            self.now = time.time()
+
+        def __call__(self):
+            return self.now
+
+    clock = VirtualClock()
+    with contextlib.redirect_stdout(io.StringIO()):
+        app = QApplication(['bench'])
+        window = QWidget()
+        gui.layout = QGridLayout()
+        display = gui.ClockDisplay(app, window, clock)
+        window.setLayout(gui.layout)
+        window.resize(480, 320)
+        display.start()
+        window.show()
+        deadline = time.monotonic() + 10
+        while display._collector is None and time.monotonic() < deadline:
+            app.processEvents()
+            time.sleep(0.01)
+
+        ticks = []
+        frames = []
+        for i in range(TICKS):
+            clock.now += 1
+            start = time.perf_counter()
+            display.onTimer()
+            ticks.append(time.perf_counter() - start)
+            app.processEvents()
+            frames.append(time.perf_counter() - start)
+
+        # Per-sample sparkline cost with a full window, should not depend on its length.
+        sparklines = {}
+        for hours in SPARKLINE_HOURS:
+            sparkline = gui.QSparkline(hours)
+            sparkline.resize(160, 40)
+            sparkline.show()
+            app.processEvents()
+            t = clock.now - hours * 3600
+            sparkline.extend([(t + i * 10, 20.0 + math.sin(i / 100.0)) for i in range(int(hours * 360))])
+            t += hours * 3600
+            start = time.perf_counter()
+            for i in range(SPARKLINE_SAMPLES):
+                sparkline.append(t + i * 10, 20.0 + math.sin(i / 100.0))
+            sparklines[hours] = (time.perf_counter() - start) / SPARKLINE_SAMPLES
+    server.shutdown()
+    results = {
+        'tick_ms': _result(_median(ticks) * 1000, 'ms'),
+        'tick_p95_ms': _result(sorted(ticks)[int(len(ticks) * 0.95)] * 1000, 'ms'),
+        'frame_ms': _result(_median(frames) * 1000, 'ms'),
+    }
+    for hours, cost in sparklines.items():
+        results['sparkline_append_{0}h_us'.format(hours)] = _result(cost * 1e6, 'us')
+    return results
+
+
+def benchPower(tmp):
+    # Wake-ups and CPU time of the display, one simulated hour active and one in power save.
+    _require('PyQt5', 'requests')
+    from fakeowm import FakeForecastServer
+    import fakesmbus
+    fakesmbus.install()
+    server = FakeForecastServer()
+    server.startThread()
+    os.environ['FORECAST_URL'] = server.url
+    os.environ['SENSOR_BUSES'] = '1'
+
+    from PyQt5.QtWidgets import QApplication, QGridLayout, QWidget
+    import ClockWithWeatherForecast as gui
+
+    class VirtualClock:
+        def __init__(self):
+            self.now = time.time()
+
+        def __call__(self):
+            return self.now
+
+    clock = VirtualClock()
+    with contextlib.redirect_stdout(io.StringIO()):
+        app = QApplication(['bench'])
+        window = QWidget()
+        gui.layout = QGridLayout()
+        display = gui.ClockDisplay(app, window, clock)
+        window.setLayout(gui.layout)
+        window.resize(480, 320)
+        display.start()
+        window.show()
+        deadline = time.monotonic() + 10
+        while display._collector is None and time.monotonic() < deadline:
+            app.processEvents()
+            time.sleep(0.01)
+        scheduler = display._scheduler
+        # Only the periodic work, no network round trips in the simulated hours.
+        scheduler.setEnabled('speedTest', False)
+        scheduler.setEnabled('weather', False)
+
+        def simulate(seconds):
+            # Jumps the clock from deadline to deadline like the timer would sleep.
+            end = clock.now + seconds
+            wakeups = scheduler.wakeups
+            cpu = time.process_time()
+            while scheduler.nextDeadline() <= end:
+                clock.now = scheduler.nextDeadline() + 0.002
+                display.onTimer()
+                app.processEvents()
+            clock.now = end
+            return (scheduler.wakeups - wakeups) / seconds, (time.process_time() - cpu) / seconds
+
+        active = simulate(POWER_SECONDS)
+        display.setPowerSave(True)
+        saving = simulate(POWER_SECONDS)
+    server.shutdown()
+    return {
+        'power_active_wakeups_per_s': _result(active[0], 'wakeups/s'),
+        'power_active_cpu_ms_per_min': _result(active[1] * 60000, 'ms'),
+        'power_save_wakeups_per_s': _result(saving[0], 'wakeups/s'),
+        'power_save_cpu_ms_per_min': _result(saving[1] * 60000, 'ms'),
+    }
+
+
+def benchStartup(tmp):
+    import bench_startup
+    env = bench_startup.isolatedEnv(tmp)
+    results = {}
+    for name, code in bench_startup.MODES:
+        measured = bench_startup.measure(code, env, 3)
+        if measured is None:
+            continue
+        ready, wall, rss, qt = measured
+        results['startup_{0}_ms'.format(name)] = _result(ready * 1000, 'ms')
+        results['startup_{0}_rss_mb'.format(name)] = _result(rss, 'MB')
+    if len(results) == 0:
+        raise _Skip('neither mode could start')
+    return results
+
+
+GROUPS = {
+    'parse': benchParse,
+    'locations': benchLocations,
+    'sensor': benchSensor,
+    'stats': benchStreamStats,
+    'history': benchHistory,
+    'historydb': benchHistoryDb,
+    'pubsub': benchPubSub,
+    'replay': benchReplay,
+    'tick': benchTick,
+    'power': benchPower,
+    'startup': benchStartup,
+}
+
+
+def runGroup(name):
+    # Runs one group in a child interpreter; returns (results, skip reason).
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--one', name],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    lines = proc.stdout.decode('utf-8', 'replace').strip().splitlines()
+    if proc.returncode != 0 or len(lines) == 0:
+        error = proc.stderr.decode('utf-8', 'replace').strip().splitlines()
+        return {}, error[-1] if len(error) > 0 else 'exit status {0}'.format(proc.returncode)
+    reply = json.loads(lines[-1])
+    return reply.get('results', {}), reply.get('skipped')
+
+
+def compare(results, baseline, threshold, timingThreshold):
+    # Prints every result against the baseline; returns the regressed names.
+    regressed = []
+    for name in sorted(results):
+        result = results[name]
+        line = '{0:<34} {1:>12.3f} {2:<10}'.format(name, result['value'], result['unit'])
+        base = baseline.get(name)
+        if base is not None and base['value'] != 0:
+            change = (result['value'] - base['value']) / base['value'] * 100
+            worse = change if result['better'] == 'lower' else -change
+            tolerance = max(threshold if result['unit'] in STABLE_UNITS else timingThreshold,
+                            2 * (result.get('spread', 0.0) + base.get('spread', 0.0)))
+            line += ' baseline {0:>12.3f} {1:+7.1f}% (limit {2:.0f}%)'.format(base['value'], change, tolerance)
+            if worse > tolerance:
+                line += '  REGRESSION'
+                regressed.append(name)
+        print(line)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark suite')
+    parser.add_argument('groups', nargs='*', help='any of: ' + ', '.join(GROUPS))
+    parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--check', action='store_true', help='exit 1 when a result regressed')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='percent, sizes and counts')
+    parser.add_argument('--timing-threshold', type=float, default=TIMING_THRESHOLD, help='percent, timings')
+    parser.add_argument('--repeat', type=int, default=REPEATS, help='runs of each group, the best is kept')
+    parser.add_argument('--one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one is not None:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.environ['HISTORY_PATH'] = os.path.join(tmp, 'roominfo.ring')
+            os.environ['SNAPSHOT_PATH'] = os.path.join(tmp, 'snapshot.json')
+            os.environ['FORECAST_CACHE'] = os.path.join(tmp, 'forecast.json')
+            os.environ['HISTORYDB_PATH'] = os.path.join(tmp, 'history.sqlite3')
+            os.environ['DASHBOARD_PORT'] = '0'
+            os.environ['QT_QPA_PLATFORM'] = 'offscreen'
+            try:
+                reply = {'results': GROUPS[args.one](tmp)}
+            except _Skip as e:
+                reply = {'skipped': str(e)}
+        print(json.dumps(reply))
+        return 0
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'rt') as fs:
+            saved = json.load(fs)
+        baseline = saved.get('results', {})
+        if saved.get('machine') != platform.machine() or saved.get('python') != platform.python_version():
+            print('WARNING: baseline was saved on {0} / Python {1}, this is {2} / Python {3}'.format(
+                saved.get('machine'), saved.get('python'), platform.machine(), platform.python_version()))
+    elif args.save == False:
+        print('WARNING: no baseline at {0}, nothing to compare with (run with --save)'.format(args.baseline))
+        if args.check == True:
+            return 1
+
+    results = {}
+    skippedGroups = {}
+    groupRuns = {}
+    for name in args.groups or list(GROUPS):
+        runs = []
+        for i in range(max(1, args.repeat)):
+            groupResults, skipped = runGroup(name)
+            if skipped:
+                print('{0:<34} skipped: {1}'.format(name, skipped))
+                skippedGroups[name] = skipped
+                break
+            runs.append(groupResults)
+        if len(runs) > 0 and len(runs[0]) > 0:
+            groupRuns[name] = runs
+            results.update(_best(runs))
+    regressed = compare(results, baseline, args.threshold, args.timing_threshold)
+    if len(regressed) > 0 and args.save == False:
+        # Confirms on more runs; what is left regressed is not a slow moment of the machine.
+        again = sorted([name for name, runs in groupRuns.items() if any([result in runs[0] for result in regressed])])
+        print('Running {0} again to confirm'.format(', '.join(again)))
+        confirm = {}
+        for name in again:
+            for i in range(max(1, args.repeat)):
+                groupResults, skipped = runGroup(name)
+                if not skipped:
+                    groupRuns[name].append(groupResults)
+            confirm.update(_best(groupRuns[name]))
+        results.update(confirm)
+        regressed = compare(dict([(name, confirm[name]) for name in regressed if name in confirm]),
+                            baseline, args.threshold, args.timing_threshold)
+    if args.check == True and len(args.groups) == 0:
+        missing = sorted([name for name in baseline if name not in results])
+        if len(missing) > 0:
+            print('WARNING: {0} baseline results were not measured: {1}'.format(len(missing), ', '.join(missing)))
+
+    if args.save == True:
+        if os.path.exists(args.baseline):
+            # Keep the groups that were not run this time.
+            for name, result in baseline.items():
+                results.setdefault(name, result)
+        with open(args.baseline, 'wt') as fs:
+            json.dump({
+                'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                'machine': platform.machine(),
+                'python': platform.python_version(),
+                'results': results,
+                'skipped': skippedGroups,
+            }, fs, indent=1, sort_keys=True)
+        print('baseline saved to {0}'.format(args.baseline))
+
+    if args.check == True and len(regressed) > 0:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,13 @@
 #! /usr/bin/python3
 # -*- coding: utf-8 -*-
 
-import smbus
+import struct
+import time
+
+try:
+    import smbus
+except ImportError:
+    smbus = None
 
 # ***************************
 # I2C (BME280) Settings
@@ -10,147 +16,290 @@ import smbus
 
 I2cBusNumber = 1    # Maybe differeced by environment(0 or 1)
 I2cAddress = 0x76   # Maybe differeced by each devices
-I2cBusInstance = smbus.SMBus(I2cBusNumber)
-I2cCaribTemp = []
-I2cCaribPress = []
-I2cCaribHumi = []
-I2cCaribFine = 0.0
+I2cBuses = {}       # Opened buses by number, shared by all sensors on a bus
+
+# Register values of ctrl_meas / config / ctrl_hum
+OSRS_SKIP = 0       # Oversampling skipped
+OSRS_X1 = 1
+OSRS_X2 = 2
+OSRS_X4 = 3
+OSRS_X8 = 4
+OSRS_X16 = 5
+MODE_SLEEP = 0
+MODE_FORCED = 1
+MODE_NORMAL = 3
+FILTER_OFF = 0
+FILTER_2 = 1
+FILTER_4 = 2
+FILTER_8 = 3
+FILTER_16 = 4
+T_SB_0_5MS = 0
+T_SB_62_5MS = 1
+T_SB_125MS = 2
+T_SB_250MS = 3
+T_SB_500MS = 4
+T_SB_1000MS = 5
+T_SB_10MS = 6
+T_SB_20MS = 7
+
+REG_CHIP_ID = 0xD0
+REG_DATA = 0xF7
+REG_STATUS = 0xF3
+REG_CTRL_MEAS = 0xF4
+REG_CONFIG = 0xF5
+REG_CTRL_HUM = 0xF2
+BME280_CHIP_ID = 0x60
+
+
+def openBus(busNumber=I2cBusNumber):
+    if busNumber not in I2cBuses:
+        if smbus is None:
+            raise IOError('python3-smbus is not installed')
+        I2cBuses[busNumber] = smbus.SMBus(busNumber)
+    return I2cBuses[busNumber]
+
+
+class Compensation:
+    # Calibration of one sensor and the datasheet compensation formulas.
+    # All results are floats: temperature in C, humidity in %, pressure in hPa.
+    def __init__(self, calib):
+        # calib: 0x88-0x9F (24 bytes), 0xA1, 0xE1-0xE7 (7 bytes)
+        calib = bytes(calib)
+        self.T = struct.unpack_from('<Hhh', calib, 0)
+        self.P = struct.unpack_from('<Hhhhhhhhh', calib, 6)
+        e4, e5, e6 = calib[28], calib[29], calib[30]
+        self.H = (
+            calib[24],
+            struct.unpack_from('<h', calib, 25)[0],
+            calib[27],
+            (struct.unpack('b', bytes([e4]))[0] << 4) | (e5 & 0x0F),
+            (struct.unpack('b', bytes([e6]))[0] << 4) | (e5 >> 4),
+            struct.unpack_from('<b', calib, 31)[0],
+        )
+
+    def tFine(self, temp_raw):
+        T1, T2, T3 = self.T
+        v1 = (temp_raw / 16384.0 - T1 / 1024.0) * T2
+        v2 = (temp_raw / 131072.0 - T1 / 8192.0) * (temp_raw / 131072.0 - T1 / 8192.0) * T3
+        return v1 + v2
+
+    def pressure(self, pres_raw, t_fine):
+        P1, P2, P3, P4, P5, P6, P7, P8, P9 = self.P
+        v1 = t_fine / 2.0 - 64000.0
+        v2 = v1 * v1 * P6 / 32768.0
+        v2 = v2 + v1 * P5 * 2.0
+        v2 = v2 / 4.0 + P4 * 65536.0
+        v1 = (P3 * v1 * v1 / 524288.0 + P2 * v1) / 524288.0
+        v1 = (1.0 + v1 / 32768.0) * P1
+        if v1 == 0:
+            return 0.0
+        pressure = 1048576.0 - pres_raw
+        pressure = (pressure - v2 / 4096.0) * 6250.0 / v1
+        v1 = P9 * pressure * pressure / 2147483648.0
+        v2 = pressure * P8 / 32768.0
+        pressure = pressure + (v1 + v2 + P7) / 16.0
+        return pressure / 100.0
+
+    def humidity(self, hum_raw, t_fine):
+        H1, H2, H3, H4, H5, H6 = self.H
+        var_h = t_fine - 76800.0
+        var_h = (hum_raw - (H4 * 64.0 + H5 / 16384.0 * var_h)) * (
+            H2 / 65536.0 * (1.0 + H6 / 67108864.0 * var_h * (1.0 + H3 / 67108864.0 * var_h)))
+        var_h = var_h * (1.0 - H1 * var_h / 524288.0)
+        if var_h > 100.0:
+            var_h = 100.0
+        elif var_h < 0.0:
+            var_h = 0.0
+        return var_h
+
+    def compensate(self, temp_raw, pres_raw, hum_raw):
+        # Returns [temperature, humidity, pressure] like getStatus.
+        t_fine = self.tFine(temp_raw)
+        return [t_fine / 5120.0, self.humidity(hum_raw, t_fine), self.pressure(pres_raw, t_fine)]
+
+    def compensateInt(self, temp_raw, pres_raw, hum_raw):
+        # Fixed point version of the datasheet (4.2.3), bit exact with the Bosch driver.
+        T1, T2, T3 = self.T
+        P1, P2, P3, P4, P5, P6, P7, P8, P9 = self.P
+        H1, H2, H3, H4, H5, H6 = self.H
+
+        v1 = (((temp_raw >> 3) - (T1 << 1)) * T2) >> 11
+        v2 = (((((temp_raw >> 4) - T1) * ((temp_raw >> 4) - T1)) >> 12) * T3) >> 14
+        t_fine = v1 + v2
+        temperature = (t_fine * 5 + 128) >> 8
+
+        v1 = t_fine - 128000
+        v2 = v1 * v1 * P6
+        v2 = v2 + ((v1 * P5) << 17)
+        v2 = v2 + (P4 << 35)
+        v1 = ((v1 * v1 * P3) >> 8) + ((v1 * P2) << 12)
+        v1 = (((1 << 47) + v1) * P1) >> 33
+        if v1 == 0:
+            pressure = 0
+        else:
+            pressure = 1048576 - pres_raw
+            pressure = _truncDiv(((pressure << 31) - v2) * 3125, v1)
+            v1 = (P9 * (pressure >> 13) * (pressure >> 13)) >> 25
+            v2 = (P8 * pressure) >> 19
+            pressure = ((pressure + v1 + v2) >> 8) + (P7 << 4)
+
+        v = t_fine - 76800
+        v = ((((hum_raw << 14) - (H4 << 20) - (H5 * v)) + 16384) >> 15) * (
+            ((((((v * H6) >> 10) * (((v * H3) >> 11) + 32768)) >> 10) + 2097152) * H2 + 8192) >> 14)
+        v = v - (((((v >> 15) * (v >> 15)) >> 7) * H1) >> 4)
+        v = min(max(v, 0), 419430400)
+        humidity = v >> 12
+
+        return [temperature / 100.0, humidity / 1024.0, pressure / 25600.0]
+
+    def compensateArray(self, temp_raw, pres_raw, hum_raw):
+        # Vectorized float path for arrays of logged raw samples (needs numpy).
+        # Returns (temperature, humidity, pressure) arrays. numpy is imported
+        # here so that the sensor path does not pay for it at startup.
+        try:
+            import numpy
+        except ImportError:
+            raise RuntimeError('compensateArray requires numpy')
+        T1, T2, T3 = self.T
+        P1, P2, P3, P4, P5, P6, P7, P8, P9 = self.P
+        H1, H2, H3, H4, H5, H6 = self.H
+        temp_raw = numpy.asarray(temp_raw, dtype=numpy.float64)
+        pres_raw = numpy.asarray(pres_raw, dtype=numpy.float64)
+        hum_raw = numpy.asarray(hum_raw, dtype=numpy.float64)
+
+        d = temp_raw / 131072.0 - T1 / 8192.0
+        t_fine = (temp_raw / 16384.0 - T1 / 1024.0) * T2 + d * d * T3
+        temperature = t_fine / 5120.0
+
+        v1 = t_fine / 2.0 - 64000.0
+        v2 = v1 * v1 * P6 / 32768.0
+        v2 = v2 + v1 * P5 * 2.0
+        v2 = v2 / 4.0 + P4 * 65536.0
+        v1 = (P3 * v1 * v1 / 524288.0 + P2 * v1) / 524288.0
+        v1 = (1.0 + v1 / 32768.0) * P1
+        valid = v1 != 0
+        safe = numpy.where(valid, v1, 1.0)
+        pressure = (1048576.0 - pres_raw - v2 / 4096.0) * 6250.0 / safe
+        pressure = pressure + (P9 * pressure * pressure / 2147483648.0 + pressure * P8 / 32768.0 + P7) / 16.0
+        pressure = numpy.where(valid, pressure / 100.0, 0.0)
+
+        var_h = t_fine - 76800.0
+        var_h = (hum_raw - (H4 * 64.0 + H5 / 16384.0 * var_h)) * (
+            H2 / 65536.0 * (1.0 + H6 / 67108864.0 * var_h * (1.0 + H3 / 67108864.0 * var_h)))
+        var_h = var_h * (1.0 - H1 * var_h / 524288.0)
+        humidity = numpy.clip(var_h, 0.0, 100.0)
+
+        return temperature, humidity, pressure
+
+
+def _truncDiv(a, b):
+    # C style integer division (rounds toward zero).
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
 
 class bme280:
-    def __init__(self):
+    def __init__(self, bus=None, address=I2cAddress,
+                 osrs_t=OSRS_X1, osrs_p=OSRS_X1, osrs_h=OSRS_X1,
+                 mode=MODE_NORMAL, t_sb=T_SB_1000MS, filter=FILTER_OFF):
+        if bus is None:
+            bus = openBus(I2cBusNumber)
+        self._bus = bus
+        self._address = address
+        self._osrs_t = osrs_t
+        self._osrs_p = osrs_p
+        self._osrs_h = osrs_h
+        self._mode = mode
+        self._t_sb = t_sb
+        self._filter = filter
         self.__initialize()
         self.__calibration()
 
-    def __initialize(self):
-        osrs_t = 1  # Temperature oversampling x 1
-        osrs_p = 1  # Pressure oversampling x 1
-        osrs_h = 1  # Humidity oversampling x 1
-        mode = 3  # Normal mode
-        t_sb = 5  # Tstandby 1000ms
-        filter = 0  # Filter off
-        spi3w_en = 0  # 3-wire SPI Disable
-
-        ctrl_meas_reg = (osrs_t << 5) | (osrs_p << 2) | mode
-        config_reg = (t_sb << 5) | (filter << 2) | spi3w_en
-        ctrl_hum_reg = osrs_h
 
-        self.__writeDataI2C(0xF2, ctrl_hum_reg)
-        self.__writeDataI2C(0xF4, ctrl_meas_reg)
-        self.__writeDataI2C(0xF5, config_reg)
+    @property
+    def address(self):
+        return self._address
 
 
-    def __calibration(self):
-        calib = []
+    @property
+    def mode(self):
+        return self._mode
 
-        for i in range(0x88, 0x88 + 24):
-            calib.append(I2cBusInstance.read_byte_data(I2cAddress, i))
-
-        calib.append(I2cBusInstance.read_byte_data(I2cAddress, 0xA1))
-
-        for i in range(0xE1, 0xE1 + 7):
-            calib.append(I2cBusInstance.read_byte_data(I2cAddress, i))
-
-        I2cCaribTemp.append((calib[1] << 8) | calib[0])
-        I2cCaribTemp.append((calib[3] << 8) | calib[2])
-        I2cCaribTemp.append((calib[5] << 8) | calib[4])
-        I2cCaribPress.append((calib[7] << 8) | calib[6])
-        I2cCaribPress.append((calib[9] << 8) | calib[8])
-        I2cCaribPress.append((calib[11] << 8) | calib[10])
-        I2cCaribPress.append((calib[13] << 8) | calib[12])
-        I2cCaribPress.append((calib[15] << 8) | calib[14])
-        I2cCaribPress.append((calib[17] << 8) | calib[16])
-        I2cCaribPress.append((calib[19] << 8) | calib[18])
-        I2cCaribPress.append((calib[21] << 8) | calib[20])
-        I2cCaribPress.append((calib[23] << 8) | calib[22])
-        I2cCaribHumi.append(calib[24])
-        I2cCaribHumi.append((calib[26] << 8) | calib[25])
-        I2cCaribHumi.append(calib[27])
-        I2cCaribHumi.append((calib[28] << 4) | (0x0F & calib[29]))
-        I2cCaribHumi.append((calib[30] << 4) | ((calib[29] >> 4) & 0x0F))
-        I2cCaribHumi.append(calib[31])
-
-        for i in range(1, 2):
-            if I2cCaribTemp[i] & 0x8000:
-                I2cCaribTemp[i] = (-I2cCaribTemp[i] ^ 0xFFFF) + 1
-
-        for i in range(1, 8):
-            if I2cCaribPress[i] & 0x8000:
-                I2cCaribPress[i] = (-I2cCaribPress[i] ^ 0xFFFF) + 1
-
-        for i in range(0, 6):
-            if I2cCaribHumi[i] & 0x8000:
-                I2cCaribHumi[i] = (-I2cCaribHumi[i] ^ 0xFFFF) + 1
 
+    def setMode(self, mode):
+        # MODE_FORCED lets the sensor sleep between reads, for slow polling.
+        if mode == self._mode:
+            return
+        self._mode = mode
+        self.__initialize()
 
-    def getStatus(self):
-        data = []
-        for i in range(0xF7, 0xF7 + 8):
-            data.append(I2cBusInstance.read_byte_data(I2cAddress, i))
 
-        pres_raw = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
-        temp_raw = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
-        hum_raw = (data[6] << 8) | data[7]
+    def __initialize(self):
+        spi3w_en = 0  # 3-wire SPI Disable
 
-        return [self.__getTemperature(temp_raw), self.__getHumidity(hum_raw), self.__getPressure(pres_raw)]
+        # In forced mode the sensor sleeps until getStatus triggers a conversion.
+        mode = self._mode
+        if mode == MODE_FORCED:
+            mode = MODE_SLEEP
 
+        ctrl_meas_reg = (self._osrs_t << 5) | (self._osrs_p << 2) | mode
+        config_reg = (self._t_sb << 5) | (self._filter << 2) | spi3w_en
+        ctrl_hum_reg = self._osrs_h
 
-    def __writeDataI2C(self, reg_address, data):
-        I2cBusInstance.write_byte_data(I2cAddress, reg_address, data)
+        self.__writeDataI2C(REG_CTRL_HUM, ctrl_hum_reg)
+        self.__writeDataI2C(REG_CTRL_MEAS, ctrl_meas_reg)
+        self.__writeDataI2C(REG_CONFIG, config_reg)
 
 
-    def __getPressure(self, data):
-        global I2cCaribFine
+    def __calibration(self):
+        # 3 block transfers instead of 32 single byte reads.
+        calib = []
+        calib.extend(self._bus.read_i2c_block_data(self._address, 0x88, 24))
+        calib.append(self._bus.read_byte_data(self._address, 0xA1))
+        calib.extend(self._bus.read_i2c_block_data(self._address, 0xE1, 7))
+        self.compensation = Compensation(calib)
 
-        v1 = (I2cCaribFine / 2.0) - 64000.0
-        v2 = (((v1 / 4.0) * (v1 / 4.0)) / 2048) * I2cCaribPress[5]
-        v2 = v2 + ((v1 * I2cCaribPress[4]) * 2.0)
-        v2 = (v2 / 4.0) + (I2cCaribPress[3] * 65536.0)
-        v1 = (((I2cCaribPress[2] * (((v1 / 4.0) * (v1 / 4.0)) / 8192)
-                ) / 8) + ((I2cCaribPress[1] * v1) / 2.0)) / 262144
-        v1 = ((32768 + v1) * I2cCaribPress[0]) / 32768
 
-        if v1 == 0:
-            return 0
+    def __measureForced(self):
+        ctrl_meas_reg = (self._osrs_t << 5) | (self._osrs_p << 2) | MODE_FORCED
+        self.__writeDataI2C(REG_CTRL_MEAS, ctrl_meas_reg)
 
-        pressure = ((1048576 - data) - (v2 / 4096)) * 3125
+        # Maximum measurement time from the datasheet (9.1).
+        wait = 1.25
+        for osrs in (self._osrs_t, self._osrs_p, self._osrs_h):
+            if osrs != OSRS_SKIP:
+                wait += 2.3 * (1 << (osrs - 1)) + 0.575
+        time.sleep(wait / 1000.0)
+        for i in range(0, 10):
+            if self._bus.read_byte_data(self._address, REG_STATUS) & 0x08 == 0:
+                break
+            time.sleep(0.001)
 
-        if pressure < 0x80000000:
-            pressure = (pressure * 2.0) / v1
-        else:
-            pressure = (pressure / v1) * 2
 
-        v1 = (I2cCaribPress[8] * (((pressure / 8.0)
-                                * (pressure / 8.0)) / 8192.0)) / 4096
-        v2 = ((pressure / 4.0) * I2cCaribPress[7]) / 8192.0
-        pressure = pressure + ((v1 + v2 + I2cCaribPress[6]) / 16.0)
+    def getRaw(self):
+        # Returns (temp_raw, pres_raw, hum_raw) ADC values.
+        if self._mode == MODE_FORCED:
+            self.__measureForced()
 
-        return str("%3.0f" % (pressure / 100))
+        # One burst read, so all values come from the same measurement.
+        data = self._bus.read_i2c_block_data(self._address, REG_DATA, 8)
 
+        pres_raw = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
+        temp_raw = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
+        hum_raw = (data[6] << 8) | data[7]
+        return temp_raw, pres_raw, hum_raw
 
-    def __getTemperature(self, data):
-        global I2cCaribFine
-        v1 = (data / 16384.0 - I2cCaribTemp[0] / 1024.0) * I2cCaribTemp[1]
-        v2 = (data / 131072.0 - I2cCaribTemp[0] / 8192.0) * (
-            data / 131072.0 - I2cCaribTemp[0] / 8192.0) * I2cCaribTemp[2]
-        I2cCaribFine = v1 + v2
-        temperature = I2cCaribFine / 5120.0
-        return str("%4.1f" % temperature)
 
+    def getValues(self):
+        # Returns [temperature(C), humidity(%), pressure(hPa)] as floats.
+        return self.compensation.compensate(*self.getRaw())
 
-    def __getHumidity(self, data):
-        global I2cCaribFine
-        var_h = I2cCaribFine - 76800.0
-        if var_h != 0:
-            var_h = (data - (I2cCaribHumi[3] * 64.0 + I2cCaribHumi[4] / 16384.0 * var_h)) * (
-                I2cCaribHumi[1] / 65536.0 * (1.0 + I2cCaribHumi[5] / 67108864.0 * var_h * (1.0 + I2cCaribHumi[2] / 67108864.0 * var_h)))
-        else:
-            return 0
 
-        var_h = var_h * (1.0 - I2cCaribHumi[0] * var_h / 524288.0)
+    def getStatus(self):
+        # Same as getValues, formatted for display.
+        temperature, humidity, pressure = self.getValues()
+        return [str("%4.1f" % temperature), str("%2.0f" % humidity), str("%3.0f" % pressure)]
 
-        if var_h > 100.0:
-            var_h = 100.0
-        elif var_h < 0.0:
-            var_h = 0.0
 
-        return str("%2.0f" % var_h)
+    def __writeDataI2C(self, reg_address, data):
+        self._bus.write_byte_data(self._address, reg_address, data)
@@ -0,0 +1,368 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import os
+import sqlite3
+import time
+
+# Reads .env before the other modules pick up their settings.
+from settings import TIMEZONE, HALF_HOUR_MINUTES, SCHEDULE_JITTER
+
+import metrics
+import telemetry
+
+from cpuinfo import CpuMonitor, executeCommand
+from dashboard import DashboardServer, DASHBOARD_PORT
+from historydb import HistoryDb, HISTORYDB_PATH, HISTORYDB_FLUSH
+from powermode import PowerPolicy, POWER_CHECK_INTERVAL, POWER_SAVE_INTERVAL
+from pubsub import TelemetryPublisher, PUBSUB_LISTEN
+from ringstore import RingStore
+from rollup import Rollup
+from scheduler import Scheduler
+from streamstats import RoomStats
+from telemetry import TelemetryBus
+from workerpool import WorkerPool
+
+# ***************************
+# Collectors and history writer without any Qt dependency
+# ClockDisplay drives a Collector for its room, CPU and network values.
+# `python3 collector.py` runs the same collectors and writes the same
+# history files on a node without a screen; PyQt5 is never imported.
+# Headless it also fetches the forecast, and with PUBSUB_LISTEN serves
+# everything to displays started with PUBSUB_CONNECT (see pubsub.py).
+# In power save (see powermode.py) the room is read once a minute with the
+# sensors sleeping in between, and the speedtest only writes the history row.
+# Room readings pass a spike filter and feed the streaming statistics
+# (smoothed values, daily high/low, pressure tendency, see streamstats.py).
+
+USE_CPUTEMP = True
+USE_SPDTST = True
+USE_BME = True
+
+if os.name != 'nt':
+    import pwd
+else:
+    USE_CPUTEMP = False
+    USE_SPDTST = False
+    USE_BME = False
+
+if USE_BME == True:
+    from bme280 import MODE_FORCED, MODE_NORMAL
+    from sensormanager import SensorManager, SENSOR_SELECT
+
+# History of the half hourly room info (roominfo.csv columns).
+HISTORY_PATH = os.environ.get('HISTORY_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'roominfo.ring'))
+HISTORY_RETENTION = int(os.environ.get('HISTORY_RETENTION', 24 * 2 * 7))
+CSV_EXPORT_ROWS = int(os.environ.get('CSV_EXPORT_ROWS', 24 * 2 * 7))
+CSV_PATH = '/var/www/html/roominfo.csv'
+if os.name == 'nt':
+    CSV_PATH = 'www/roominfo.csv'
+HISTORY_FIELDS = ['temperature', 'humidity', 'pressure', 'cpuTemp', 'upload', 'download', 'ping']
+# User that should own the exported csv (e.g. the web server user); unset keeps the file as written.
+CSV_OWNER = os.environ.get('CSV_OWNER')
+# Static files of the dashboard that are not in the publish directory.
+WWW_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'www')
+
+ROOM_INFO_INTERVAL = 10     # seconds
+SENSOR_MAX_AGE = 60         # seconds a reading is used without a newer one
+
+
+_cpuInfoProbe = metrics.probe('cpu_info', 'CPU telemetry sample')
+_speedTestProbe = metrics.probe('speedtest', 'Speedtest run')
+_historyProbe = metrics.probe('history_write', 'History append, csv export and rollup')
+
+
+def isTransient(error):
+    # True for errors a later start may not hit again: I/O (a busy bus, a
+    # full or slow disk) and a locked database. A corrupt ring or database
+    # file or a bad setting fails the same way every time.
+    return isinstance(error, (OSError, sqlite3.OperationalError))
+
+
+class Collector:
+    def __init__(self, bus, clock=time.time):
+        # clock should be the one of the bus and the scheduler, see replay.py.
+        self._telemetry = bus
+        self._clock = clock
+        self._bme = None
+        self._forecasts = None
+        self._scheduler = None
+        self._power = None
+        self._powerSave = False
+        self._pool = None
+        self._history = None
+        self._rollup = None
+        self._historyDb = None
+        self._server = None
+        self._publisher = None
+        try:
+            self.__start()
+        except BaseException:
+            # Nothing of a failed start stays behind: threads, bus taps, open files.
+            self.close()
+            raise
+
+    def __start(self):
+        bus = self._telemetry
+        clock = self._clock
+
+        # Long lived workers for the jobs that must not block the caller.
+        self._pool = WorkerPool(3, 'collectorWorker')
+        self._cpu = CpuMonitor(USE_CPUTEMP)
+
+        if USE_BME == True:
+            self._bme = SensorManager(maxAge=SENSOR_MAX_AGE)
+        self._roomStats = RoomStats(TIMEZONE)
+
+        self._history = RingStore(HISTORY_PATH, HISTORY_RETENTION, len(HISTORY_FIELDS))
+        if len(self._history) == 0 and os.path.exists(CSV_PATH):
+            self._history.importCsv(CSV_PATH)
+        self._rollup = Rollup(self._history, HISTORY_FIELDS,
+                              os.path.dirname(HISTORY_PATH), os.path.dirname(CSV_PATH))
+
+        # Every numeric sample and forecast on the bus, kept for years.
+        if HISTORYDB_PATH:
+            self._historyDb = HistoryDb(HISTORYDB_PATH, TIMEZONE, clock)
+            bus.addTap(self._historyDb.tap)
+            metrics.REGISTRY.gauge('historydb_pending_rows', 'Rows waiting for the next batched write', lambda: self._historyDb.pending)
+            metrics.REGISTRY.gauge('historydb_written_total', 'Rows written to the history database', lambda: self._historyDb.written, 'counter')
+            metrics.REGISTRY.gauge('historydb_dropped_total', 'Buffered rows dropped while writes failed', lambda: self._historyDb.dropped, 'counter')
+            # Today's high/low and the pressure tendency carry over a restart.
+            now = self._clock()
+            start = self._roomStats.seedStart(now)
+            for metric in self._roomStats.metrics:
+                tier, rows = self._historyDb.query(metric, start, now + 1, 'raw')
+                self._roomStats.seed(metric, rows)
+
+        metrics.REGISTRY.gauge('telemetry_published_total', 'Samples published on the bus', lambda: bus.published, 'counter')
+        metrics.REGISTRY.gauge('telemetry_coalesced_total', 'Samples replaced before being drained', lambda: bus.coalesced, 'counter')
+
+        if DASHBOARD_PORT > 0:
+            self._server = DashboardServer(bus, self._rollup, HISTORY_FIELDS, [os.path.dirname(CSV_PATH), WWW_DIR],
+                                           historyDb=self._historyDb)
+            self._server.start()
+
+        # Displays that subscribe instead of running their own collectors.
+        if PUBSUB_LISTEN:
+            self._publisher = TelemetryPublisher(bus)
+            self._publisher.start()
+
+    def schedule(self, scheduler, weather=False, power=False):
+        # weather: fetch the forecast here as well, for a collector without its own display.
+        # power: follow the power save policy here, a display does that itself.
+        self._scheduler = scheduler
+        scheduler.every('roomInfo', ROOM_INFO_INTERVAL, self.__onRoomInfoTask)
+        scheduler.cron('speedTest', HALF_HOUR_MINUTES, self.__onSpeedTestTask, jitter=SCHEDULE_JITTER)
+        if weather == True:
+            scheduler.cron('weather', HALF_HOUR_MINUTES, self.__onWeatherTask, jitter=SCHEDULE_JITTER)
+        metrics.REGISTRY.gauge('scheduler_wakeups_total', 'Scheduler wake-ups', lambda: scheduler.wakeups, 'counter')
+        if self._historyDb is not None:
+            scheduler.every('historyFlush', HISTORYDB_FLUSH, self.__onHistoryFlushTask, runAtStart=False)
+        if metrics.METRICS_LOG_INTERVAL > 0:
+            scheduler.every('metricsLog', metrics.METRICS_LOG_INTERVAL, self.__onMetricsLogTask, runAtStart=False)
+        if power == True:
+            self._power = PowerPolicy(TIMEZONE)
+            if self._power.configured() == True:
+                scheduler.every('powerMode', POWER_CHECK_INTERVAL, self.__onPowerModeTask)
+
+    def setPowerSave(self, enabled):
+        # Slower room readings with the sensors in forced mode, no speedtest.
+        if enabled == self._powerSave:
+            return
+        self._powerSave = enabled
+        if self._scheduler is not None:
+            self._scheduler.setInterval('roomInfo', POWER_SAVE_INTERVAL if enabled == True else ROOM_INFO_INTERVAL)
+        if self._bme is not None:
+            if enabled == True:
+                self._bme.setMode(MODE_FORCED, 2 * POWER_SAVE_INTERVAL)
+            else:
+                self._bme.setMode(MODE_NORMAL, SENSOR_MAX_AGE)
+
+    def __onPowerModeTask(self, now):
+        reason = self._power.idle(now)
+        self._power.measure(self._scheduler)
+        if (reason is not None) != self._powerSave:
+            print('Power save {0}{1}: {2:.2f} wake-ups/s, CPU {3:.1f}%'.format(
+                'on' if reason is not None else 'off', ' (' + reason + ')' if reason is not None else '',
+                self._power.wakeupRate, self._power.cpuLoad * 100))
+            self.setPowerSave(reason is not None)
+
+    def __onMetricsLogTask(self, now):
+        print('metrics {0}'.format(metrics.REGISTRY.summary()))
+
+    def __onHistoryFlushTask(self, now):
+        if self._pool.submit('historyFlush', self._historyDb.flush, now) == False:
+            print('History flush still running, skipped.')
+
+    def __onRoomInfoTask(self, now):
+        self.updateRoomInfo()
+        self.updateCpuInfo()
+
+    def __onSpeedTestTask(self, now):
+        now = datetime.datetime.fromtimestamp(now, TIMEZONE)
+        if self._powerSave == True:
+            # Paused, the half hourly history row is still written with the last results.
+            self._pool.submit('speedTest', self.__writeCsvThread, now)
+            return
+        self.updateSpeedTest(now)
+
+    def __onWeatherTask(self, now):
+        self.updateWeather()
+
+    def updateRoomInfo(self):
+        if self._bme is not None:
+            # Publishes what the previous poll read, the bus workers never block the caller.
+            bmeValues = self._bme.select(SENSOR_SELECT)
+            self._bme.poll()
+            if bmeValues is None:
+                return
+            now = self._clock()
+            for metric, value in zip((telemetry.ROOM_TEMPERATURE, telemetry.ROOM_HUMIDITY, telemetry.ROOM_PRESSURE), bmeValues):
+                if self._roomStats.add(metric, now, value) == False:
+                    print('Dropped {0} reading {1:.2f} as a spike.'.format(metric, value))
+                    continue
+                self._telemetry.publish(metric, value, now, source='bme280')
+            self._telemetry.publish(telemetry.ROOM_STATS, self._roomStats.summary(now), now, source='streamstats')
+
+    def updateSpeedTest(self, now):
+        if USE_SPDTST == True:
+            if self._pool.submit('speedTest', self.__updateSpeedTestThread, now) == False:
+                print('Speedtest still running, skipped.')
+
+    @_speedTestProbe
+    def __updateSpeedTestThread(self, now):
+        # Imported on first use, http.server is slow to load.
+        from nettest import NetTest, SPEEDTEST_URL
+        if SPEEDTEST_URL:
+            result = NetTest(SPEEDTEST_URL).run()
+            for error in result.errors:
+                print('Speedtest: {0}'.format(error))
+            upload, download, ping = result.upload, result.download, result.ping
+            self._telemetry.publish(telemetry.NET_RESULT, result, source='nettest')
+        else:
+            upload, download, ping = self.__runSpeedTestCommand()
+
+        print('upload:{0:.2f} download:{1:.2f} ping:{2:.2f}'.format(upload, download, ping))
+        self._telemetry.publish(telemetry.NET_UPLOAD, upload, source='speedtest')
+        self._telemetry.publish(telemetry.NET_DOWNLOAD, download, source='speedtest')
+        self._telemetry.publish(telemetry.NET_PING, ping, source='speedtest')
+
+        self.__writeCsvThread(now)
+
+    def __runSpeedTestCommand(self):
+        # Used when no SPEEDTEST_URL is configured.
+        upload = self._telemetry.latest(telemetry.NET_UPLOAD, 0.0)
+        download = self._telemetry.latest(telemetry.NET_DOWNLOAD, 0.0)
+        ping = self._telemetry.latest(telemetry.NET_PING, 0.0)
+        for line in executeCommand('speedtest'):
+            if line.find('Upload: ') >= 0:
+                upload = float(line.split(' ')[1])
+            if line.find('Download: ') >= 0:
+                download = float(line.split(' ')[1])
+            if line.find(' ms') >= 0:
+                index1 = line.find(']: ') + 3
+                index2 = line.find(' ms')
+                ping = float(line[index1: index2])
+        return upload, download, ping
+
+    def updateWeather(self):
+        if self._pool.submit('weather', self.__updateWeatherThread) == False:
+            print('Forecast fetch still running, skipped.')
+
+    def __updateWeatherThread(self):
+        if self._forecasts is None:
+            # Imported on first use like in the display, requests is slow to load.
+            from forecastservice import ForecastService
+            self._forecasts = ForecastService()
+        self._telemetry.publish(telemetry.WEATHER_FORECAST, self._forecasts.fetch(), source='openweathermap')
+
+    def updateCpuInfo(self):
+        self._pool.submit('cpuInfo', self.__updateCpuInfoThread)
+
+    @_cpuInfoProbe
+    def __updateCpuInfoThread(self):
+        sample = self._cpu.sample()
+        self._telemetry.publish(telemetry.CPU_USAGE, sample['usage'], source='proc')
+        self._telemetry.publish(telemetry.CPU_CORES, sample['cores'], source='proc')
+        self._telemetry.publish(telemetry.CPU_FREQUENCIES, sample['frequencies'], source='cpufreq')
+        if sample['temperature'] is not None:
+            self._telemetry.publish(telemetry.CPU_TEMPERATURE, sample['temperature'], source='thermal')
+
+    @_historyProbe
+    def __writeCsvThread(self, now):
+        path = CSV_PATH
+
+        # O(1) append into the ring file, then publish the recent rows as csv.
+        values = self.__getRoomInfoValues()
+        self._history.append(now, values)
+        self._history.exportCsv(path, CSV_EXPORT_ROWS)
+        self._rollup.add(now, values)
+        self._telemetry.publish(telemetry.HISTORY_ROW, (int(now.timestamp() * 1000), values), source='history')
+
+        if os.name != 'nt':
+            if CSV_OWNER:
+                owner = pwd.getpwnam(CSV_OWNER)
+                os.chown(path, owner.pw_uid, owner.pw_gid)
+            os.chmod(path, 0o766)
+
+    def recentSamples(self, metric, seconds):
+        # [(time, value)] of the last `seconds` from the history database and its buffer, oldest first.
+        if self._historyDb is None:
+            return []
+        now = self._clock()
+        tier, rows = self._historyDb.query(metric, now - seconds, now + 1, 'raw')
+        return rows
+
+    def settle(self, timeout=10.0):
+        # Waits until the sensor reads and worker jobs started so far are done,
+        # so a replay on a virtual clock sees the same order as a live run.
+        done = self._pool.wait(timeout)
+        if self._bme is not None:
+            done = self._bme.wait(timeout) and done
+        return done
+
+    def close(self):
+        # Writes what the history database still buffers and stops what was
+        # started; also called with a half started collector.
+        if self._publisher is not None:
+            self._publisher.stop()
+        if self._server is not None:
+            self._server.stop()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+        if self._bme is not None:
+            self._bme.close()
+        if self._historyDb is not None:
+            self._telemetry.removeTap(self._historyDb.tap)
+            self._historyDb.close()
+        if self._rollup is not None:
+            self._rollup.close()
+        if self._history is not None:
+            self._history.close()
+
+    def __getRoomInfoValues(self):
+        # Read from the bus, this runs on a worker thread.
+        latest = self._telemetry.latest
+        return [latest(telemetry.ROOM_TEMPERATURE, 0.0), latest(telemetry.ROOM_HUMIDITY, 0.0),
+                latest(telemetry.ROOM_PRESSURE, 0.0),
+                latest(telemetry.CPU_TEMPERATURE, 0.0),
+                latest(telemetry.NET_UPLOAD, 0.0), latest(telemetry.NET_DOWNLOAD, 0.0),
+                latest(telemetry.NET_PING, 0.0)]
+
+
+if __name__ == '__main__':
+    bus = TelemetryBus()
+    if telemetry.TELEMETRY_LOG == True:
+        bus.addTap(telemetry.logTap)
+    scheduler = Scheduler(TIMEZONE)
+    collector = Collector(bus)
+    # The forecast is fetched for the history and the csv output like in the
+    # display; only serving it to displays depends on PUBSUB_LISTEN.
+    collector.schedule(scheduler, weather=True, power=True)
+    print('Headless collector started.')
+    try:
+        scheduler.runForever()
+    except KeyboardInterrupt:
+        pass
+    collector.close()
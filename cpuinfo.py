@@ -0,0 +1,136 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import glob
+import os
+
+from subprocess import Popen, PIPE
+
+# ***************************
+# CPU telemetry without forking
+# Temperature comes from the sysfs thermal zones, usage from /proc/stat
+# deltas and frequency from cpufreq. `vcgencmd measure_temp` is only run
+# when no thermal zone can be read.
+
+THERMAL_ZONES = '/sys/class/thermal/thermal_zone*'
+CPU_FREQ = '/sys/devices/system/cpu/cpu{0}/cpufreq/scaling_cur_freq'
+PROC_STAT = '/proc/stat'
+
+# hook(cmd, run) -> lines, set by the record and replay harness (replay.py).
+_commandHook = None
+
+
+def _readText(path):
+    with open(path, 'rt') as fs:
+        return fs.read().strip()
+
+
+def findThermalZone():
+    # Prefers the zone whose type names the CPU (cpu-thermal on a Pi).
+    zones = sorted(glob.glob(THERMAL_ZONES))
+    for zone in zones:
+        try:
+            if 'cpu' in _readText(os.path.join(zone, 'type')).lower():
+                return os.path.join(zone, 'temp')
+        except OSError:
+            continue
+    for zone in zones:
+        if os.path.exists(os.path.join(zone, 'temp')):
+            return os.path.join(zone, 'temp')
+    return None
+
+
+def setCommandHook(hook):
+    global _commandHook
+    _commandHook = hook
+
+
+def executeCommand(cmd):
+    if _commandHook is not None:
+        return _commandHook(cmd, _runCommand)
+    return _runCommand(cmd)
+
+
+def _runCommand(cmd):
+    p = Popen(cmd.split(' '), stdout=PIPE, stderr=PIPE)
+    out, err = p.communicate()
+    out = out.decode('utf-8')
+    return [s for s in out.split('\n') if s]
+
+
+class CpuMonitor:
+    def __init__(self, useVcgencmd=True):
+        self._thermalPath = findThermalZone()
+        self._useVcgencmd = useVcgencmd
+        self._previous = None
+
+    def temperature(self):
+        if self._thermalPath is not None:
+            try:
+                return int(_readText(self._thermalPath)) / 1000.0
+            except (OSError, ValueError):
+                pass
+        if self._useVcgencmd == True:
+            try:
+                for line in executeCommand('vcgencmd measure_temp'):
+                    return float(line.replace("temp=", "").replace("'C", ""))
+            except (OSError, ValueError):
+                self._useVcgencmd = False
+        return None
+
+    def __readStat(self):
+        # [(busy, total)] for the whole cpu followed by every core.
+        result = []
+        with open(PROC_STAT, 'rt') as fs:
+            for line in fs:
+                if not line.startswith('cpu'):
+                    break
+                values = [int(v) for v in line.split()[1:]]
+                idle = values[3] + (values[4] if len(values) > 4 else 0)
+                total = sum(values[:8])
+                result.append((total - idle, total))
+        return result
+
+    def usage(self):
+        # Percent busy since the previous call: (total, [per core]).
+        try:
+            current = self.__readStat()
+        except OSError:
+            return self.__psutilUsage()
+
+        previous = self._previous
+        self._previous = current
+        if previous is None or len(previous) != len(current):
+            return 0.0, [0.0] * (len(current) - 1)
+
+        percents = []
+        for (busy0, total0), (busy1, total1) in zip(previous, current):
+            if total1 - total0 <= 0:
+                percents.append(0.0)
+            else:
+                percents.append(100.0 * (busy1 - busy0) / (total1 - total0))
+        return percents[0], percents[1:]
+
+    def __psutilUsage(self):
+        import psutil
+        cores = psutil.cpu_percent(percpu=True)
+        return sum(cores) / max(1, len(cores)), cores
+
+    def frequencies(self, cores):
+        # Current frequency of every core in MHz (None when unknown).
+        result = []
+        for i in range(0, cores):
+            try:
+                result.append(int(_readText(CPU_FREQ.format(i))) / 1000.0)
+            except (OSError, ValueError):
+                result.append(None)
+        return result
+
+    def sample(self):
+        total, cores = self.usage()
+        return {
+            'usage': total,
+            'cores': cores,
+            'frequencies': self.frequencies(len(cores)),
+            'temperature': self.temperature(),
+        }
@@ -0,0 +1,302 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import mimetypes
+import os
+import threading
+import time
+import urllib.parse
+
+import metrics
+import telemetry
+
+from rollup import RESOLUTIONS
+
+# ***************************
+# Embedded dashboard server
+# A small asyncio HTTP/1.1 server on its own thread:
+#   /api/current                        newest value of every numeric metric
+#   /api/history?resolution=&since=     history rows newer than since (epoch ms)
+#   /api/events                         Server-Sent Events (new samples and history rows)
+#   /api/range?metric=&from=&to=&tier=  any metric from the history database (epoch ms)
+#   /metrics                            metrics.REGISTRY in the Prometheus text format
+# plus the static files of the web page. Publishers only hand an encoded
+# event to the loop. Every event is encoded once for all clients, and a
+# client that cannot keep up is dropped instead of being buffered without
+# bound, so sampling and rendering never wait for the network.
+# Only this machine can connect by default; DASHBOARD_HOST=0.0.0.0 serves
+# the LAN, and DASHBOARD_CORS names the web origin allowed to read the API.
+
+DASHBOARD_HOST = os.environ.get('DASHBOARD_HOST', '127.0.0.1')
+DASHBOARD_PORT = int(os.environ.get('DASHBOARD_PORT', 8080))     # 0 disables the server
+DASHBOARD_CORS = os.environ.get('DASHBOARD_CORS', '')            # Access-Control-Allow-Origin, '' sends none
+
+RESOLUTION_NAMES = ['raw'] + [r[0] for r in RESOLUTIONS]
+SSE_QUEUE = 64          # events buffered per client
+SSE_KEEPALIVE = 15      # seconds
+SSE_RETRY = 5000        # ms, reconnect delay for EventSource
+IDLE_TIMEOUT = 30       # seconds a kept-alive connection may stay idle
+MAX_HEADER = 8192
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+
+def _isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _json(data):
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def _event(name, data, eventId=None):
+    head = 'event: {0}\n'.format(name)
+    if eventId is not None:
+        head += 'id: {0}\n'.format(eventId)
+    return head.encode('utf-8') + b'data: ' + _json(data) + b'\n\n'
+
+
+class DashboardServer:
+    def __init__(self, bus, rollup, names, roots, host=DASHBOARD_HOST, port=DASHBOARD_PORT, historyDb=None):
+        self._bus = bus
+        self._rollup = rollup
+        self._historyDb = historyDb
+        self._names = names
+        self._roots = [os.path.abspath(root) for root in roots]
+        self._host = host
+        self._port = port
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._clients = set()
+        self.requests = 0
+        self.events = 0
+        self.dropped = 0
+
+    def start(self):
+        # Returns False when the port could not be opened.
+        self._thread = threading.Thread(target=self.__run, name='dashboardServer', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._server is None:
+            return False
+        self._bus.addTap(self.__onSample)
+        metrics.REGISTRY.gauge('dashboard_clients', 'Connected event stream clients', self.clients)
+        metrics.REGISTRY.gauge('dashboard_requests_total', 'HTTP requests', lambda: self.requests, 'counter')
+        metrics.REGISTRY.gauge('dashboard_dropped_total', 'Event stream clients dropped as too slow', lambda: self.dropped, 'counter')
+        return True
+
+    def stop(self):
+        if self._server is not None:
+            self._bus.removeTap(self.__onSample)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(5)
+
+    @property
+    def port(self):
+        if self._server is None:
+            return None
+        return self._server.sockets[0].getsockname()[1]
+
+    def clients(self):
+        return len(self._clients)
+
+    def __run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self.__handle, self._host, self._port, limit=MAX_HEADER))
+        except OSError as e:
+            print('Dashboard server not started: {0}'.format(e))
+            self._ready.set()
+            return
+        print('Dashboard server on port {0}'.format(self.port))
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            self._loop.close()
+
+    def __onSample(self, sample):
+        # Telemetry tap, runs on the publishing thread.
+        if len(self._clients) == 0:
+            return
+        if sample.metric == telemetry.HISTORY_ROW:
+            t, values = sample.value
+            frame = _event('row', {'t': t, 'v': dict(zip(self._names, values))}, t)
+        elif _isNumber(sample.value):
+            frame = _event('sample', {'m': sample.metric, 'v': sample.value, 't': int(sample.timestamp * 1000)})
+        else:
+            return
+        self._loop.call_soon_threadsafe(self.__broadcast, frame)
+
+    def __broadcast(self, frame):
+        self.events += 1
+        for queue in list(self._clients):
+            try:
+                queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                # Too slow: forget the backlog and close, EventSource reconnects
+                # and catches up through Last-Event-ID.
+                self.dropped += 1
+                self._clients.discard(queue)
+                while queue.empty() == False:
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    async def __handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                request = lines[0].split(' ')
+                if len(request) != 3:
+                    await self.__reply(writer, 400, 'text/plain', b'', False)
+                    break
+                method, target, version = request
+                headers = {}
+                for line in lines[1:]:
+                    key, sep, value = line.partition(':')
+                    if sep:
+                        headers[key.strip().lower()] = value.strip()
+                keepAlive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                self.requests += 1
+
+                if method not in ('GET', 'HEAD'):
+                    await self.__reply(writer, 405, 'text/plain', b'', False)
+                    break
+                url = urllib.parse.urlsplit(target)
+                if url.path == '/api/events':
+                    await self.__events(writer, headers)
+                    break
+                status, contentType, body = await self.__route(url.path, urllib.parse.parse_qs(url.query))
+                await self.__reply(writer, status, contentType, body if method == 'GET' else b'', keepAlive,
+                                   len(body))
+                if keepAlive == False:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def __reply(self, writer, status, contentType, body, keepAlive, length=None):
+        head = [
+            'HTTP/1.1 {0} {1}'.format(status, STATUS[status]),
+            'Content-Type: {0}'.format(contentType),
+            'Content-Length: {0}'.format(len(body) if length is None else length),
+            'Cache-Control: no-cache',
+            'Connection: {0}'.format('keep-alive' if keepAlive == True else 'close'),
+        ]
+        if DASHBOARD_CORS:
+            head.append('Access-Control-Allow-Origin: {0}'.format(DASHBOARD_CORS))
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def __route(self, path, query):
+        if path == '/api/current':
+            data = {}
+            for metric, sample in self._bus.latestSamples().items():
+                if _isNumber(sample.value):
+                    data[metric] = {'v': sample.value, 't': int(sample.timestamp * 1000)}
+            return 200, 'application/json', _json(data)
+
+        if path == '/metrics':
+            return 200, 'text/plain; version=0.0.4', metrics.REGISTRY.exposition().encode('utf-8')
+
+        if path == '/api/history':
+            name = query.get('resolution', ['raw'])[0]
+            since = query.get('since', [None])[0]
+            try:
+                since = int(since) if since is not None else None
+            except ValueError:
+                return 400, 'text/plain', b'since must be epoch milliseconds'
+            if name not in RESOLUTION_NAMES:
+                return 400, 'text/plain', b'unknown resolution'
+            # Reading the ring files takes a lock the writer also holds.
+            data = await self._loop.run_in_executor(None, self._rollup.series, name, since)
+            return 200, 'application/json', _json(data)
+
+        if path == '/api/range' and self._historyDb is not None:
+            try:
+                metric = query['metric'][0]
+                start = int(query['from'][0]) / 1000.0
+                end = int(query['to'][0]) / 1000.0 if 'to' in query else time.time() + 1
+            except (KeyError, ValueError):
+                return 400, 'text/plain', b'metric and from (epoch ms) are required'
+            tier = query.get('tier', [None])[0]
+            try:
+                tier, rows = await self._loop.run_in_executor(None, self._historyDb.query, metric, start, end, tier)
+            except ValueError:
+                return 400, 'text/plain', b'unknown tier'
+            data = {'metric': metric, 'tier': tier, 't': [row[0] * 1000 for row in rows]}
+            if tier == 'raw':
+                data['v'] = [row[1] for row in rows]
+            else:
+                data['min'] = [row[2] for row in rows]
+                data['mean'] = [round(row[3], 2) for row in rows]
+                data['max'] = [row[4] for row in rows]
+            return 200, 'application/json', _json(data)
+
+        return await self._loop.run_in_executor(None, self.__readStatic, path)
+
+    def __readStatic(self, path):
+        if path == '/':
+            path = '/labtemp.html'
+        relative = urllib.parse.unquote(path).lstrip('/')
+        for root in self._roots:
+            fullPath = os.path.normpath(os.path.join(root, relative))
+            if fullPath.startswith(root + os.sep) == False or os.path.isfile(fullPath) == False:
+                continue
+            try:
+                with open(fullPath, 'rb') as fs:
+                    body = fs.read()
+            except OSError:
+                continue
+            contentType = mimetypes.guess_type(fullPath)[0] or 'application/octet-stream'
+            if contentType.startswith('text/'):
+                contentType += '; charset=utf-8'
+            return 200, contentType, body
+        return 404, 'text/plain', b'not found'
+
+    async def __events(self, writer, headers):
+        head = (b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: text/event-stream\r\n'
+                b'Cache-Control: no-cache\r\n')
+        if DASHBOARD_CORS:
+            head += 'Access-Control-Allow-Origin: {0}\r\n'.format(DASHBOARD_CORS).encode('latin-1')
+        writer.write(head + b'Connection: keep-alive\r\n\r\n')
+        writer.write('retry: {0}\n\n'.format(SSE_RETRY).encode('utf-8'))
+
+        queue = asyncio.Queue(SSE_QUEUE)
+        self._clients.add(queue)
+        try:
+            # A reconnecting client gets the rows it missed.
+            lastId = headers.get('last-event-id', '')
+            if lastId.isdigit():
+                data = await self._loop.run_in_executor(None, self._rollup.series, 'raw', int(lastId))
+                for i, t in enumerate(data['t']):
+                    values = {}
+                    for name in self._names:
+                        values[name] = data['series'][name]['v'][i]
+                    writer.write(_event('row', {'t': t, 'v': values}, t))
+            await writer.drain()
+
+            while True:
+                try:
+                    frame = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    frame = b': keepalive\n\n'
+                if frame is None:
+                    break
+                writer.write(frame)
+                await writer.drain()
+        finally:
+            self._clients.discard(queue)
@@ -0,0 +1,123 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import struct
+import sys
+import threading
+import time
+import types
+
+# ***************************
+# In-memory stand-in for smbus.SMBus
+# Holds a BME280 register map per address and counts bus transactions, so
+# the driver can be exercised and measured on a machine without the sensor.
+# install() puts it in place of the smbus module for whole-app runs.
+
+BME280_CHIP_ID = 0x60
+
+# Calibration of a real BME280 (dig_T1..T3, dig_P1..P9, dig_H1..H6).
+DEFAULT_CALIBRATION = {
+    'T': (27504, 26435, -1000),
+    'P': (36477, -10685, 3024, 2855, 140, -7, 15500, -14600, 6000),
+    'H': (75, 362, 0, 324, 0, 30),
+}
+# Raw ADC values giving about 25 C, 1006 hPa, 50 %.
+DEFAULT_RAW = (519888, 415148, 30000)
+
+
+def bme280Registers(calibration=DEFAULT_CALIBRATION, raw=DEFAULT_RAW):
+    regs = bytearray(256)
+    regs[0xD0] = BME280_CHIP_ID
+    struct.pack_into('<Hhh', regs, 0x88, *calibration['T'])
+    struct.pack_into('<Hhhhhhhhh', regs, 0x8E, *calibration['P'])
+    h1, h2, h3, h4, h5, h6 = calibration['H']
+    regs[0xA1] = h1
+    struct.pack_into('<hB', regs, 0xE1, h2, h3)
+    regs[0xE4] = (h4 >> 4) & 0xFF
+    regs[0xE5] = (h4 & 0x0F) | ((h5 & 0x0F) << 4)
+    regs[0xE6] = (h5 >> 4) & 0xFF
+    struct.pack_into('<b', regs, 0xE7, h6)
+    setRaw(regs, *raw)
+    return regs
+
+
+def setRaw(regs, temp_raw, pres_raw, hum_raw):
+    regs[0xF7] = (pres_raw >> 12) & 0xFF
+    regs[0xF8] = (pres_raw >> 4) & 0xFF
+    regs[0xF9] = (pres_raw << 4) & 0xF0
+    regs[0xFA] = (temp_raw >> 12) & 0xFF
+    regs[0xFB] = (temp_raw >> 4) & 0xFF
+    regs[0xFC] = (temp_raw << 4) & 0xF0
+    regs[0xFD] = (hum_raw >> 8) & 0xFF
+    regs[0xFE] = hum_raw & 0xFF
+
+
+class FakeSMBus:
+    # byteTime simulates the bus clock (about 90us per byte at 100kHz)
+    # and transactionTime the per transfer overhead (start, address, stop).
+    def __init__(self, bus=1, devices=None, byteTime=0.0, transactionTime=0.0):
+        self.bus = bus
+        self.devices = devices if devices is not None else {0x76: bme280Registers()}
+        self.byteTime = byteTime
+        self.transactionTime = transactionTime
+        self.transactions = 0
+        self.bytesRead = 0
+        self.bytesWritten = 0
+        self._lock = threading.Lock()
+
+    def __device(self, addr):
+        if addr not in self.devices:
+            # Same errno the kernel driver reports for a missing device.
+            raise OSError(121, 'Remote I/O error')
+        return self.devices[addr]
+
+    def __transfer(self, size):
+        self.transactions += 1
+        if self.byteTime > 0 or self.transactionTime > 0:
+            time.sleep(self.transactionTime + self.byteTime * size)
+
+    def read_byte_data(self, addr, cmd):
+        with self._lock:
+            regs = self.__device(addr)
+            self.__transfer(1)
+            self.bytesRead += 1
+            return regs[cmd]
+
+    def read_i2c_block_data(self, addr, cmd, length=32):
+        with self._lock:
+            regs = self.__device(addr)
+            self.__transfer(length)
+            self.bytesRead += length
+            return list(regs[cmd:cmd + length])
+
+    def write_byte_data(self, addr, cmd, val):
+        with self._lock:
+            regs = self.__device(addr)
+            self.__transfer(1)
+            self.bytesWritten += 1
+            if cmd == 0xF4 and val & 0x03 == 0x01:
+                # Forced conversion finishes at once and the sensor goes back to sleep.
+                val &= 0xFC
+            regs[cmd] = val & 0xFF
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+        for i, val in enumerate(vals):
+            self.write_byte_data(addr, cmd + i, val)
+
+    def resetCounters(self):
+        self.transactions = 0
+        self.bytesRead = 0
+        self.bytesWritten = 0
+
+    def close(self):
+        pass
+
+
+def install():
+    # Makes `import smbus` and bme280.openBus() hand out FakeSMBus instances.
+    module = types.ModuleType('smbus')
+    module.SMBus = FakeSMBus
+    sys.modules['smbus'] = module
+    if 'bme280' in sys.modules:
+        sys.modules['bme280'].smbus = module
+    return module
@@ -0,0 +1,196 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+
+from array import array
+
+# ***************************
+# Forecast data model
+# A forecast is held as columns (array module), one value per time slot,
+# so parsing 40 three-hourly or 48 hourly or 16 daily items allocates a
+# few arrays instead of a list and a datetime per item. The local hour is
+# derived from the epoch with a UTC offset resolved once per payload, and
+# the display icon comes from a dense table indexed by weather id and
+# day / night.
+
+logger = logging.getLogger('forecast')
+
+# Convert from OpenWeatherMap weather ID to Meteocons weather icon.
+# Ids are looked up directly first, then by group (id // 100).
+WEATHER_ICON = {
+    2: 'P',
+    3: 'X',
+    5: 'R',
+    6: 'W',
+    800: 'B',
+    801: 'B',
+    802: 'H',
+    803: 'N',
+    804: 'Y',
+}
+
+WEATHER_ICON_MOON = {
+    800: 'C',
+    801: 'C',
+    802: 'I',
+}
+
+UNKNOWN_ICON = '-'
+MAX_WEATHER_ID = 999
+# Hours shown with the moon icons.
+NIGHT_START = 18
+NIGHT_END = 6
+
+
+def _buildIconTable():
+    # ICON_TABLE[weatherId * 2 + night]
+    table = []
+    for weatherId in range(0, MAX_WEATHER_ID + 1):
+        for night in (0, 1):
+            icons = WEATHER_ICON
+            if night == 1 and weatherId in WEATHER_ICON_MOON:
+                icons = WEATHER_ICON_MOON
+            if weatherId in icons:
+                table.append(icons[weatherId])
+            elif weatherId // 100 in icons:
+                table.append(icons[weatherId // 100])
+            else:
+                table.append(UNKNOWN_ICON)
+    return ''.join(table)
+
+
+ICON_TABLE = _buildIconTable()
+
+
+def weatherIcon(weatherId, night):
+    if weatherId < 0 or weatherId > MAX_WEATHER_ID:
+        return UNKNOWN_ICON
+    return ICON_TABLE[weatherId * 2 + (1 if night else 0)]
+
+
+def _isNight(hour):
+    return hour < NIGHT_END or hour >= NIGHT_START
+
+
+class ForecastItem:
+    # One slot, only made when a caller indexes the forecast.
+    __slots__ = ('time', 'hour', 'weatherId', 'temperature', 'rainfall', 'night')
+
+    def __init__(self, time, hour, weatherId, temperature, rainfall, night):
+        self.time = time
+        self.hour = hour
+        self.weatherId = weatherId
+        self.temperature = temperature
+        self.rainfall = rainfall
+        self.night = night
+
+    @property
+    def icon(self):
+        return weatherIcon(self.weatherId, self.night)
+
+
+class Forecast:
+    __slots__ = ('step', 'tz', 'times', 'hours', 'weatherIds', 'temperatures', 'rainfalls')
+
+    def __init__(self, size=0, step=0, tz=None):
+        # step: seconds between slots (10800 for the 3 hour forecast, 0 when unknown).
+        self.step = step
+        self.tz = tz
+        self.times = array('d', bytes(8 * size))
+        self.hours = array('B', bytes(size))
+        self.weatherIds = array('H', bytes(2 * size))
+        self.temperatures = array('d', bytes(8 * size))
+        self.rainfalls = array('d', bytes(8 * size))
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, i):
+        hour = self.hours[i]
+        return ForecastItem(self.times[i], hour, self.weatherIds[i], self.temperatures[i],
+                            self.rainfalls[i], _isNight(hour))
+
+    def datetime(self, i):
+        return datetime.datetime.fromtimestamp(self.times[i], self.tz)
+
+    def icon(self, i):
+        return weatherIcon(self.weatherIds[i], _isNight(self.hours[i]))
+
+    def rows(self, limit=None):
+        # [[epoch, weather id, temperature, rainfall]], e.g. for the display snapshot.
+        count = len(self) if limit is None else min(limit, len(self))
+        return [[self.times[i], self.weatherIds[i], self.temperatures[i], self.rainfalls[i]]
+                for i in range(count)]
+
+    @staticmethod
+    def fromRows(rows, tz):
+        forecast = Forecast(len(rows), 0, tz)
+        for i, (t, weatherId, temperature, rainfall) in enumerate(rows):
+            forecast.times[i] = t
+            forecast.weatherIds[i] = weatherId
+            forecast.temperatures[i] = temperature
+            forecast.rainfalls[i] = rainfall
+        forecast.__localHours()
+        return forecast
+
+    @staticmethod
+    def fromPayload(data, tz, section=None):
+        # Accepts the 5 day / 3 hour and hourly forecasts ('list') and
+        # One Call style payloads ('hourly' or 'daily', pick one with section).
+        if section is None:
+            section = 'list' if 'list' in data else ('hourly' if 'hourly' in data else 'daily')
+        items = data.get(section) or []
+        forecast = Forecast(len(items), 0, tz)
+        for i, item in enumerate(items):
+            forecast.times[i] = item['dt']
+            forecast.weatherIds[i] = min(item['weather'][0]['id'], MAX_WEATHER_ID)
+            forecast.temperatures[i] = _temperature(item)
+            forecast.rainfalls[i] = _rainfall(item)
+        if len(items) > 1:
+            forecast.step = int(forecast.times[1] - forecast.times[0])
+        forecast.__localHours()
+
+        logger.info('forecast: %d items every %ds from %s', len(forecast), forecast.step,
+                    forecast.datetime(0) if len(forecast) > 0 else '-')
+        if logger.isEnabledFor(logging.DEBUG):
+            for i in range(len(forecast)):
+                logger.debug('%s id:%d %s temp:%.1f rain:%.2f', forecast.datetime(i), forecast.weatherIds[i],
+                             forecast.icon(i), forecast.temperatures[i], forecast.rainfalls[i])
+        return forecast
+
+    def __localHours(self):
+        # One offset for the whole forecast unless it spans a DST change.
+        count = len(self)
+        if count == 0:
+            return
+        first = self.__utcOffset(self.times[0])
+        if first == self.__utcOffset(self.times[count - 1]):
+            for i in range(count):
+                self.hours[i] = int((self.times[i] + first) // 3600 % 24)
+        else:
+            for i in range(count):
+                self.hours[i] = self.datetime(i).hour
+
+    def __utcOffset(self, t):
+        if self.tz is None:
+            return 0
+        return datetime.datetime.fromtimestamp(t, self.tz).utcoffset().total_seconds()
+
+
+def _temperature(item):
+    if 'main' in item:
+        return item['main']['temp']
+    temperature = item['temp']
+    if isinstance(temperature, dict):
+        # Daily forecasts give min / max / day / night...
+        return temperature['day']
+    return temperature
+
+
+def _rainfall(item):
+    rain = item.get('rain', 0)
+    if isinstance(rain, dict):
+        return rain.get('3h', rain.get('1h', 0))
+    return rain
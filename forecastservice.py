@@ -0,0 +1,78 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import weatherinfo
+
+# ***************************
+# Forecasts for several locations
+# FORECAST_LOCATIONS lists the places to show, 'name=zip' separated by ';':
+#   FORECAST_LOCATIONS='office=100-0001,JP;home=150-0002,JP'
+# Without it the single ZIP of .env is used. All locations are fetched at
+# the same time, one blocking weatherinfo request per location on a small
+# thread pool that shares weatherinfo's pooled session, cache and rate
+# limit. The wall time of a round is about the slowest location instead of
+# the sum of all of them.
+
+FORECAST_LOCATIONS = os.environ.get('FORECAST_LOCATIONS', '')
+# Locations fetched at the same time, also the connections kept per host.
+FETCH_CONCURRENCY = weatherinfo.POOL_SIZE
+
+
+def parseLocations(text, defaultZip=None):
+    # Returns [(name, zip)]; a bare zip is named after itself.
+    locations = []
+    for item in text.split(';'):
+        item = item.strip()
+        if item == '':
+            continue
+        name, sep, zipCode = item.partition('=')
+        if sep == '':
+            name, zipCode = item, item
+        locations.append((name.strip(), zipCode.strip()))
+    if len(locations) == 0 and defaultZip:
+        locations.append(('', defaultZip))
+    return locations
+
+
+class ForecastService:
+    def __init__(self, locations=None, concurrency=FETCH_CONCURRENCY):
+        if locations is None:
+            locations = parseLocations(FORECAST_LOCATIONS, weatherinfo.ZIP)
+        self._locations = locations
+        self._executor = ThreadPoolExecutor(max(1, min(concurrency, len(locations))), 'forecastFetch')
+        self._lastDuration = 0.0
+
+    def __len__(self):
+        return len(self._locations)
+
+    @property
+    def locations(self):
+        return list(self._locations)
+
+    @property
+    def lastDuration(self):
+        # Wall seconds of the last fetch() round.
+        return self._lastDuration
+
+    def fetch(self):
+        # {name: Forecast} in location order. Blocks, call it from a worker thread.
+        start = time.perf_counter()
+        pending = [self._executor.submit(weatherinfo.getWeatherForecast, zipCode) for name, zipCode in self._locations]
+        forecasts = {}
+        for (name, zipCode), future in zip(self._locations, pending):
+            try:
+                forecasts[name] = future.result()
+            except Exception as e:
+                # The last good forecast on disk, however old, beats an empty one.
+                print('Forecast fetch for {0} failed: {1}'.format(name or zipCode, e))
+                forecasts[name] = weatherinfo.getCachedForecast(zipCode)
+        self._lastDuration = time.perf_counter() - start
+        return forecasts
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,265 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+import telemetry
+
+# ***************************
+# Long term history database
+# Every numeric sample published on the telemetry bus (the 10 second room
+# and CPU readings included) and every forecast is kept in SQLite. Samples
+# are buffered in memory and written in one transaction per HISTORYDB_FLUSH
+# seconds, the database runs in WAL mode, so the SD card sees a few large
+# writes instead of one per sample. Closed hours are folded into an hour
+# tier and closed days (from the hours) into a day tier; every tier has its
+# own retention. Tables are keyed by (metric, time) without a rowid, so a
+# time range query is an index range scan and the key is the only index.
+
+HISTORYDB_PATH = os.environ.get('HISTORYDB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.sqlite3'))   # '' disables the database
+HISTORYDB_FLUSH = float(os.environ.get('HISTORYDB_FLUSH', 5 * 60))     # seconds between batched writes
+# Days kept per tier, 0 keeps everything.
+RAW_RETENTION_DAYS = int(os.environ.get('HISTORYDB_RAW_DAYS', 31))
+HOUR_RETENTION_DAYS = int(os.environ.get('HISTORYDB_HOUR_DAYS', 366 * 2))
+DAY_RETENTION_DAYS = int(os.environ.get('HISTORYDB_DAY_DAYS', 0))
+FORECAST_RETENTION_DAYS = int(os.environ.get('HISTORYDB_FORECAST_DAYS', 366))
+PRUNE_INTERVAL = 60 * 60    # seconds between retention passes
+# A bucket is rolled up this long after it closed, for samples published right at the boundary.
+ROLLUP_GRACE = 60
+# Rows kept in memory while the database cannot be written, the oldest are dropped beyond.
+MAX_PENDING = 100000
+
+TIERS = [
+    # name, bucket seconds, table, rolled up from
+    ('hour', 60 * 60, 'rollup_hour', 'samples'),
+    ('day', 24 * 60 * 60, 'rollup_day', 'rollup_hour'),
+]
+# Longest range answered from a finer tier when no tier is asked for.
+RAW_QUERY_SPAN = 2 * 24 * 60 * 60
+HOUR_QUERY_SPAN = 92 * 24 * 60 * 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS metrics (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS samples (
+    metric INTEGER NOT NULL, t INTEGER NOT NULL, value REAL NOT NULL,
+    PRIMARY KEY (metric, t)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_hour (
+    metric INTEGER NOT NULL, t INTEGER NOT NULL, count INTEGER NOT NULL, min REAL, mean REAL, max REAL,
+    PRIMARY KEY (metric, t)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_day (
+    metric INTEGER NOT NULL, t INTEGER NOT NULL, count INTEGER NOT NULL, min REAL, mean REAL, max REAL,
+    PRIMARY KEY (metric, t)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS forecasts (
+    location TEXT NOT NULL, fetched INTEGER NOT NULL, t INTEGER NOT NULL,
+    weather INTEGER, temperature REAL, rainfall REAL,
+    PRIMARY KEY (location, fetched, t)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+'''
+
+_flushProbe = metrics.probe('historydb_flush', 'History database batched write')
+
+
+class HistoryDb:
+    def __init__(self, path=HISTORYDB_PATH, tz=None, clock=time.time):
+        # Times are epoch seconds; hour and day buckets are aligned to tz.
+        self._tz = tz
+        self._clock = clock
+        # _lock only guards the buffers, so taps never wait for the disk;
+        # _dbLock serializes the connection.
+        self._lock = threading.Lock()
+        self._dbLock = threading.Lock()
+        self._pending = []
+        self._pendingForecasts = []
+        self._metricIds = {}
+        self._lastPrune = 0.0
+        self.written = 0
+        self.dropped = 0        # rows lost to MAX_PENDING while writes failed
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # Must come before the first table to take effect.
+        self._db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        for metricId, name in self._db.execute('SELECT id, name FROM metrics'):
+            self._metricIds[name] = metricId
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self._pending) + len(self._pendingForecasts)
+
+    def tap(self, sample):
+        # TelemetryBus tap, runs on the publishing thread and only buffers.
+        value = sample.value
+        if isinstance(value, bool):
+            return
+        if isinstance(value, (int, float)):
+            self.record(sample.metric, value, sample.timestamp)
+        elif sample.metric == telemetry.WEATHER_FORECAST:
+            for name, forecast in value.items():
+                self.recordForecast(name, forecast, sample.timestamp)
+
+    def record(self, metric, value, timestamp):
+        with self._lock:
+            self._pending.append((metric, int(timestamp), float(value)))
+
+    def recordForecast(self, location, forecast, timestamp):
+        # forecast is a forecastmodel.Forecast; empty ones (failed fetches) are not kept.
+        fetched = int(timestamp)
+        rows = [(location, fetched, int(t), weatherId, temperature, rainfall)
+                for t, weatherId, temperature, rainfall in forecast.rows()]
+        with self._lock:
+            self._pendingForecasts.extend(rows)
+
+    @_flushProbe
+    def flush(self, now=None):
+        # Writes the buffered rows and the closed buckets in one transaction.
+        if now is None:
+            now = self._clock()
+        with self._dbLock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                forecasts, self._pendingForecasts = self._pendingForecasts, []
+            try:
+                with self._db:
+                    rows = [(self.__metricId(metric), t, value) for metric, t, value in pending]
+                    self._db.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?, ?)', rows)
+                    self._db.executemany('INSERT OR REPLACE INTO forecasts VALUES (?, ?, ?, ?, ?, ?)', forecasts)
+                    self.__rollup(now - ROLLUP_GRACE)
+                    pruned = False
+                    if now - self._lastPrune >= PRUNE_INTERVAL:
+                        pruned = self.__prune(now)
+                        self._lastPrune = now
+            except sqlite3.Error:
+                # Rolled back, ids handed out in this transaction are gone too.
+                self._metricIds = dict([(name, metricId) for metricId, name in self._db.execute('SELECT id, name FROM metrics')])
+                # The batch goes back in front of what arrived meanwhile, for the next flush.
+                with self._lock:
+                    self._pending = pending + self._pending
+                    self._pendingForecasts = forecasts + self._pendingForecasts
+                    dropped = max(0, len(self._pending) - MAX_PENDING) + max(0, len(self._pendingForecasts) - MAX_PENDING)
+                    if dropped > 0:
+                        self._pending = self._pending[-MAX_PENDING:]
+                        self._pendingForecasts = self._pendingForecasts[-MAX_PENDING:]
+                        self.dropped += dropped
+                raise
+            if pruned == True:
+                # Gives the freed pages back to the file system, outside the transaction.
+                self._db.execute('PRAGMA incremental_vacuum').fetchall()
+            self.written += len(rows) + len(forecasts)
+
+    def __metricId(self, name):
+        metricId = self._metricIds.get(name)
+        if metricId is None:
+            metricId = self._db.execute('INSERT INTO metrics (name) VALUES (?)', (name,)).lastrowid
+            self._metricIds[name] = metricId
+        return metricId
+
+    def __utcOffset(self, t):
+        if self._tz is None:
+            return 0
+        return int(datetime.datetime.fromtimestamp(t, self._tz).utcoffset().total_seconds())
+
+    def __rollup(self, now):
+        offset = self.__utcOffset(now)
+        state = dict(self._db.execute('SELECT key, value FROM state'))
+        for name, seconds, table, source in TIERS:
+            done = state.get(name, 0)
+            # Only buckets that are closed; a finer tier is always rolled up first.
+            upto = (now + offset) // seconds * seconds - offset
+            if upto <= done:
+                continue
+            if source == 'samples':
+                select = 'SELECT metric, (t + :offset) / :seconds * :seconds - :offset AS b, COUNT(*), MIN(value), AVG(value), MAX(value)'
+            else:
+                select = 'SELECT metric, (t + :offset) / :seconds * :seconds - :offset AS b, SUM(count), MIN(min), SUM(mean * count) / SUM(count), MAX(max)'
+            self._db.execute(
+                'INSERT OR REPLACE INTO {0} {1} FROM {2} WHERE t >= :done AND t < :upto GROUP BY metric, b'.format(
+                    table, select, source),
+                {'offset': offset, 'seconds': seconds, 'done': done, 'upto': int(upto)})
+            self._db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (name, int(upto)))
+
+    def __prune(self, now):
+        # Per metric, so every delete is a range on the primary key.
+        deleted = 0
+        for table, days in (('samples', RAW_RETENTION_DAYS), ('rollup_hour', HOUR_RETENTION_DAYS),
+                            ('rollup_day', DAY_RETENTION_DAYS)):
+            if days <= 0:
+                continue
+            for metricId in self._metricIds.values():
+                deleted += self._db.execute('DELETE FROM {0} WHERE metric = ? AND t < ?'.format(table),
+                                            (metricId, int(now - days * 86400))).rowcount
+        if FORECAST_RETENTION_DAYS > 0:
+            locations = [row[0] for row in self._db.execute('SELECT DISTINCT location FROM forecasts')]
+            for location in locations:
+                deleted += self._db.execute('DELETE FROM forecasts WHERE location = ? AND fetched < ?',
+                                            (location, int(now - FORECAST_RETENTION_DAYS * 86400))).rowcount
+        return deleted > 0
+
+    def tierFor(self, start, end, now=None):
+        # Finest tier that still holds start and keeps the result small.
+        if now is None:
+            now = self._clock()
+        span = end - start
+        if span <= RAW_QUERY_SPAN and (RAW_RETENTION_DAYS <= 0 or start >= now - RAW_RETENTION_DAYS * 86400):
+            return 'raw'
+        if span <= HOUR_QUERY_SPAN and (HOUR_RETENTION_DAYS <= 0 or start >= now - HOUR_RETENTION_DAYS * 86400):
+            return 'hour'
+        return 'day'
+
+    def query(self, metric, start, end, tier=None):
+        # Returns (tier, rows) for start <= t < end: [(t, value)] from the raw
+        # samples, [(t, count, min, mean, max)] from the hour and day tiers.
+        # The raw tier includes the samples still buffered for the next flush.
+        if tier is None:
+            tier = self.tierFor(start, end)
+        tables = dict([(name, table) for name, seconds, table, source in TIERS])
+        if tier != 'raw' and tier not in tables:
+            raise ValueError('unknown tier {0}'.format(tier))
+        with self._dbLock:
+            metricId = self._metricIds.get(metric)
+            rows = []
+            if metricId is not None:
+                if tier == 'raw':
+                    sql = 'SELECT t, value FROM samples WHERE metric = ? AND t >= ? AND t < ? ORDER BY t'
+                else:
+                    sql = 'SELECT t, count, min, mean, max FROM {0} WHERE metric = ? AND t >= ? AND t < ? ORDER BY t'.format(tables[tier])
+                rows = self._db.execute(sql, (metricId, int(start), int(end))).fetchall()
+            if tier != 'raw':
+                return tier, rows
+            # Under _dbLock no flush is between taking the buffer and its commit.
+            with self._lock:
+                pending = [(t, value) for name, t, value in self._pending if name == metric and int(start) <= t < int(end)]
+        if len(pending) == 0:
+            return tier, rows
+        # Same (metric, t) replaces the stored row on flush, so the buffered one wins here too.
+        merged = dict(rows)
+        merged.update(pending)
+        return tier, sorted(merged.items())
+
+    def forecasts(self, location, start, end):
+        # {fetched: [(t, weather id, temperature, rainfall)]} of the forecasts fetched in the range.
+        result = {}
+        with self._dbLock:
+            rows = self._db.execute(
+                'SELECT fetched, t, weather, temperature, rainfall FROM forecasts '
+                'WHERE location = ? AND fetched >= ? AND fetched < ? ORDER BY fetched, t',
+                (location, int(start), int(end))).fetchall()
+        for fetched, t, weatherId, temperature, rainfall in rows:
+            result.setdefault(fetched, []).append((t, weatherId, temperature, rainfall))
+        return result
+
+    def metricNames(self):
+        with self._dbLock:
+            return sorted(self._metricIds)
+
+    def close(self):
+        self.flush()
+        with self._dbLock:
+            self._db.close()
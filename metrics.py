@@ -0,0 +1,233 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import functools
+import os
+import threading
+import time
+
+# ***************************
+# In-process metrics for the update paths
+# Every instrumented path owns a Probe: a latency histogram, an error
+# counter and the time of the last success. Recording a sample is a
+# bisect plus a few additions under a lock, with no allocation. The
+# registry renders everything in the Prometheus text format
+# (dashboard.py serves it on /metrics) and as a one line summary for the
+# log (METRICS_LOG_INTERVAL seconds, 0 disables).
+
+METRICS_LOG_INTERVAL = float(os.environ.get('METRICS_LOG_INTERVAL', 0))
+
+# Latency bucket upper bounds in seconds, 100 us .. 60 s.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Histogram:
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, name, help, bounds=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)     # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th sample (None when empty).
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        if count == 0:
+            return None
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= rank and n > 0:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return float('inf')
+
+    def exposition(self, lines):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+        lines.append('# HELP {0} {1}'.format(self.name, self.help))
+        lines.append('# TYPE {0} histogram'.format(self.name))
+        cumulative = 0
+        for bound, n in zip(self.bounds + (float('inf'),), counts):
+            cumulative += n
+            lines.append('{0}_bucket{{le="{1}"}} {2}'.format(self.name, _format(bound), cumulative))
+        lines.append('{0}_sum {1}'.format(self.name, repr(total)))
+        lines.append('{0}_count {1}'.format(self.name, count))
+
+
+class Counter:
+    __slots__ = ('name', 'help', 'value', '_lock')
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def exposition(self, lines):
+        lines.append('# HELP {0} {1}'.format(self.name, self.help))
+        lines.append('# TYPE {0} counter'.format(self.name))
+        lines.append('{0} {1}'.format(self.name, self.value))
+
+
+class Gauge:
+    # Either set() explicitly or read from fn() when rendered. kind is
+    # 'counter' for totals that an owner already counts (fn only).
+    __slots__ = ('name', 'help', 'value', 'fn', 'kind')
+
+    def __init__(self, name, help, fn=None, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.value = 0.0
+        self.fn = fn
+        self.kind = kind
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.fn is not None:
+            try:
+                return self.fn()
+            except Exception:
+                return float('nan')
+        return self.value
+
+    def exposition(self, lines):
+        lines.append('# HELP {0} {1}'.format(self.name, self.help))
+        lines.append('# TYPE {0} {1}'.format(self.name, self.kind))
+        lines.append('{0} {1}'.format(self.name, _format(self.get())))
+
+
+class Probe:
+    # Latency, errors and last success of one update path. Use as a
+    # decorator, or call record(start, ok) where the path catches its own errors.
+    __slots__ = ('name', 'latency', 'errors', 'lastSuccess')
+
+    def __init__(self, registry, name, help):
+        self.name = name
+        self.latency = registry.histogram(name + '_seconds', help + ' duration')
+        self.errors = registry.counter(name + '_errors_total', help + ' failures')
+        self.lastSuccess = registry.gauge(name + '_last_success_timestamp_seconds', help + ' last success')
+
+    def record(self, start, ok=True):
+        # start is a time.perf_counter() value.
+        self.latency.observe(time.perf_counter() - start)
+        if ok == True:
+            self.lastSuccess.value = time.time()
+        else:
+            self.errors.inc()
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException:
+                self.record(start, False)
+                raise
+            self.record(start, True)
+            return result
+        return wrapper
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._probes = {}
+
+    def __get(self, name, factory):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = factory()
+            return metric
+
+    def histogram(self, name, help, bounds=LATENCY_BUCKETS):
+        return self.__get(name, lambda: Histogram(name, help, bounds))
+
+    def counter(self, name, help):
+        return self.__get(name, lambda: Counter(name, help))
+
+    def gauge(self, name, help, fn=None, kind='gauge'):
+        gauge = self.__get(name, lambda: Gauge(name, help, fn, kind))
+        if fn is not None:
+            # The newest owner wins, e.g. a collector that was created again.
+            gauge.fn = fn
+        return gauge
+
+    def probe(self, name, help):
+        with self._lock:
+            probe = self._probes.get(name)
+        if probe is None:
+            probe = Probe(self, name, help)
+            with self._lock:
+                probe = self._probes.setdefault(name, probe)
+        return probe
+
+    def exposition(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            metric.exposition(lines)
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        # name:count/p50/p95/errors for every probe that ran.
+        with self._lock:
+            probes = sorted(self._probes.values(), key=lambda p: p.name)
+        items = []
+        for probe in probes:
+            if probe.latency.count == 0:
+                continue
+            items.append('{0}:n={1} p50={2}ms p95={3}ms err={4}'.format(
+                probe.name, probe.latency.count,
+                _milliseconds(probe.latency.quantile(0.5)), _milliseconds(probe.latency.quantile(0.95)),
+                probe.errors.value))
+        return ' '.join(items)
+
+
+def _milliseconds(value):
+    if value is None:
+        return '-'
+    if value == float('inf'):
+        return '>{0:g}'.format(LATENCY_BUCKETS[-1] * 1000)
+    return '{0:g}'.format(value * 1000)
+
+
+REGISTRY = Registry()
+REGISTRY.gauge('process_cpu_seconds_total', 'CPU time of this process', time.process_time, 'counter')
+
+
+def probe(name, help):
+    return REGISTRY.probe(name, help)
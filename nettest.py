@@ -0,0 +1,291 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import http.client
+import http.server
+import os
+import sys
+import threading
+import time
+import urllib.parse
+
+# ***************************
+# In-process network throughput / latency probe
+# Runs parallel HTTP streams against a target we control (for example a
+# server on the LAN running `python3 nettest.py --serve`). Throughput is
+# taken from the steady state window after warm-up, latency is reported as
+# a distribution, and every run is bounded in time and in bytes.
+
+SPEEDTEST_URL = os.environ.get('SPEEDTEST_URL')     # e.g. http://192.168.1.10:8765
+SPEEDTEST_STREAMS = int(os.environ.get('SPEEDTEST_STREAMS', 4))
+SPEEDTEST_DURATION = float(os.environ.get('SPEEDTEST_DURATION', 8))     # seconds per direction
+SPEEDTEST_WARMUP = float(os.environ.get('SPEEDTEST_WARMUP', 2))
+SPEEDTEST_MAX_BYTES = int(os.environ.get('SPEEDTEST_MAX_BYTES', 100 * 1024 * 1024))    # per direction
+SPEEDTEST_PINGS = int(os.environ.get('SPEEDTEST_PINGS', 20))
+
+CHUNK_SIZE = 64 * 1024
+REQUEST_SIZE = 4 * 1024 * 1024
+SAMPLE_INTERVAL = 0.05
+TIMEOUT = 5
+
+_payload = b'\0' * CHUNK_SIZE
+
+
+class NetTestResult:
+    __slots__ = ('download', 'upload', 'latency', 'bytesDown', 'bytesUp', 'duration', 'errors')
+
+    def __init__(self):
+        self.download = 0.0     # Mbps
+        self.upload = 0.0       # Mbps
+        self.latency = {}       # ms: min, p50, p95, max, jitter
+        self.bytesDown = 0
+        self.bytesUp = 0
+        self.duration = 0.0
+        self.errors = []
+
+    @property
+    def ping(self):
+        return self.latency.get('p50', 0.0)
+
+    def asDict(self):
+        return {
+            'download': self.download,
+            'upload': self.upload,
+            'latency': dict(self.latency),
+            'bytesDown': self.bytesDown,
+            'bytesUp': self.bytesUp,
+            'duration': self.duration,
+            'errors': list(self.errors),
+        }
+
+
+def _percentile(values, p):
+    index = min(len(values) - 1, max(0, int(round(p / 100.0 * (len(values) - 1)))))
+    return values[index]
+
+
+class _Meter:
+    # Byte counter and byte budget shared by the streams of one direction.
+    def __init__(self, budget):
+        self._lock = threading.Lock()
+        self.total = 0
+        self.reserved = 0
+        self.budget = budget
+        self.stop = threading.Event()
+
+    def reserve(self, size):
+        # Returns how many bytes a stream may move next (0 when the budget is used up).
+        with self._lock:
+            size = max(0, min(size, self.budget - self.reserved))
+            self.reserved += size
+            return size
+
+    def add(self, size):
+        with self._lock:
+            self.total += size
+
+
+class NetTest:
+    def __init__(self, url=SPEEDTEST_URL, streams=SPEEDTEST_STREAMS, duration=SPEEDTEST_DURATION,
+                 warmup=SPEEDTEST_WARMUP, maxBytes=SPEEDTEST_MAX_BYTES, pings=SPEEDTEST_PINGS):
+        target = urllib.parse.urlsplit(url)
+        self._https = target.scheme == 'https'
+        self._host = target.hostname
+        self._port = target.port
+        self._path = target.path.rstrip('/')
+        self._streams = streams
+        self._duration = duration
+        self._warmup = warmup
+        self._maxBytes = maxBytes
+        self._pings = pings
+
+    def __connect(self):
+        if self._https == True:
+            return http.client.HTTPSConnection(self._host, self._port, timeout=TIMEOUT)
+        return http.client.HTTPConnection(self._host, self._port, timeout=TIMEOUT)
+
+    def latency(self):
+        # Round trips of a tiny request on one kept-alive connection, in ms.
+        # Empty with SPEEDTEST_PINGS=0, like a run whose latency probe failed.
+        if self._pings < 1:
+            return {}
+        conn = self.__connect()
+        samples = []
+        try:
+            for i in range(0, self._pings + 1):
+                start = time.perf_counter()
+                conn.request('GET', self._path + '/ping')
+                conn.getresponse().read()
+                if i > 0:
+                    # The first round trip includes the TCP handshake.
+                    samples.append((time.perf_counter() - start) * 1000)
+        finally:
+            conn.close()
+
+        jitter = 0.0
+        if len(samples) > 1:
+            jitter = sum([abs(samples[i] - samples[i - 1]) for i in range(1, len(samples))]) / (len(samples) - 1)
+        ordered = sorted(samples)
+        return {
+            'min': ordered[0],
+            'p50': _percentile(ordered, 50),
+            'p95': _percentile(ordered, 95),
+            'max': ordered[-1],
+            'jitter': jitter,
+        }
+
+    def __downloadStream(self, meter, errors):
+        conn = self.__connect()
+        try:
+            while meter.stop.is_set() == False:
+                size = meter.reserve(REQUEST_SIZE)
+                if size == 0:
+                    break
+                conn.request('GET', '{0}/download?bytes={1}'.format(self._path, size))
+                response = conn.getresponse()
+                while meter.stop.is_set() == False:
+                    data = response.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    meter.add(len(data))
+                if meter.stop.is_set() == True:
+                    break
+        except (OSError, http.client.HTTPException) as e:
+            errors.append('download: {0}'.format(e))
+        finally:
+            conn.close()
+
+    def __uploadStream(self, meter, errors):
+        conn = self.__connect()
+        try:
+            while meter.stop.is_set() == False:
+                size = meter.reserve(REQUEST_SIZE)
+                if size == 0:
+                    break
+                conn.putrequest('POST', self._path + '/upload')
+                conn.putheader('Content-Length', str(size))
+                conn.endheaders()
+                sent = 0
+                while sent < size:
+                    if meter.stop.is_set() == True:
+                        # Abandon the request, the connection is closed below.
+                        return
+                    chunk = min(CHUNK_SIZE, size - sent)
+                    conn.send(_payload[:chunk])
+                    sent += chunk
+                    meter.add(chunk)
+                conn.getresponse().read()
+        except (OSError, http.client.HTTPException) as e:
+            errors.append('upload: {0}'.format(e))
+        finally:
+            conn.close()
+
+    def __measure(self, stream, errors):
+        # Returns (Mbps over the steady state window, bytes moved).
+        meter = _Meter(self._maxBytes)
+        threads = []
+        for i in range(0, self._streams):
+            thread = threading.Thread(target=stream, args=(meter, errors), name='nettest{0}'.format(i), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        start = time.perf_counter()
+        windowStart = None
+        end = None
+        while any([t.is_alive() for t in threads]) == True:
+            time.sleep(SAMPLE_INTERVAL)
+            now = time.perf_counter()
+            if windowStart is None and now - start >= self._warmup:
+                windowStart = (now, meter.total)
+            if now - start >= self._duration:
+                end = (now, meter.total)
+                break
+        meter.stop.set()
+        for thread in threads:
+            thread.join(TIMEOUT)
+        if end is None:
+            # Streams finished on their own (byte budget used up).
+            end = (time.perf_counter(), meter.total)
+
+        if windowStart is None or end[0] - windowStart[0] < SAMPLE_INTERVAL:
+            # Ended inside the warm-up (tiny budget or fast link): use the whole run.
+            windowStart = (start, 0)
+        seconds = end[0] - windowStart[0]
+        if seconds <= 0:
+            return 0.0, meter.total
+        return (end[1] - windowStart[1]) * 8 / seconds / 1000000, meter.total
+
+    def run(self):
+        result = NetTestResult()
+        start = time.perf_counter()
+        try:
+            result.latency = self.latency()
+        except (OSError, http.client.HTTPException) as e:
+            result.errors.append('latency: {0}'.format(e))
+        result.download, result.bytesDown = self.__measure(self.__downloadStream, result.errors)
+        result.upload, result.bytesUp = self.__measure(self.__uploadStream, result.errors)
+        result.duration = time.perf_counter() - start
+        return result
+
+
+class NetTestHandler(http.server.BaseHTTPRequestHandler):
+    # Counterpart of NetTest: /ping, /download?bytes=N and /upload.
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.endswith('/ping'):
+            self.__reply(0)
+        elif url.path.endswith('/download'):
+            query = urllib.parse.parse_qs(url.query)
+            size = int(query.get('bytes', [REQUEST_SIZE])[0])
+            self.__reply(size)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        size = int(self.headers.get('Content-Length', 0))
+        while size > 0:
+            data = self.rfile.read(min(CHUNK_SIZE, size))
+            if not data:
+                break
+            size -= len(data)
+        self.__reply(0)
+
+    def __reply(self, size):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        while size > 0:
+            chunk = min(CHUNK_SIZE, size)
+            self.wfile.write(_payload[:chunk])
+            size -= chunk
+
+    def log_message(self, format, *args):
+        pass
+
+
+class NetTestServer(http.server.ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients drop connections when a run ends, that is not an error.
+        if isinstance(sys.exc_info()[1], ConnectionError) == False:
+            super(NetTestServer, self).handle_error(request, client_address)
+
+
+def serve(host='0.0.0.0', port=8765):
+    server = NetTestServer((host, port), NetTestHandler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    # python3 nettest.py --serve [port]  /  python3 nettest.py [url]
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 8765
+        print('nettest server on port {0}'.format(port))
+        serve(port=port).serve_forever()
+    else:
+        url = sys.argv[1] if len(sys.argv) > 1 else SPEEDTEST_URL
+        print(NetTest(url).run().asDict())
@@ -0,0 +1,86 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import glob
+import os
+import time
+
+import metrics
+
+# ***************************
+# When to save power
+# The display and the collector drop to one wake-up per minute while
+# nobody is looking: during the POWER_SAVE_HOURS of the night (e.g. '23-6',
+# local time) and, with POWER_SAVE_BLANK, while the screen is blanked
+# (backlight bl_power or framebuffer blank in sysfs). The owner checks
+# idle() every POWER_CHECK_INTERVAL seconds and switches its tasks.
+
+POWER_SAVE_HOURS = os.environ.get('POWER_SAVE_HOURS', '')
+POWER_SAVE_BLANK = os.environ.get('POWER_SAVE_BLANK', '1') == '1'
+POWER_CHECK_INTERVAL = 60               # seconds, on the same minute wake-up as the saving tasks
+POWER_SAVE_INTERVAL = 60                # seconds between clock and sensor updates while saving
+BLANK_PATHS = ['/sys/class/backlight/*/bl_power', '/sys/class/graphics/fb*/blank']
+
+
+def parseHours(text):
+    # '23-6' -> (23, 6), '' -> None. The range may wrap around midnight.
+    text = text.strip()
+    if text == '':
+        return None
+    start, sep, end = text.partition('-')
+    if sep == '':
+        raise ValueError('POWER_SAVE_HOURS must look like 23-6: {0}'.format(text))
+    return int(start) % 24, int(end) % 24
+
+
+class PowerPolicy:
+    def __init__(self, tz=None, hours=POWER_SAVE_HOURS, followBlank=POWER_SAVE_BLANK):
+        self._tz = tz
+        self._hours = parseHours(hours)
+        self._blankPaths = []
+        if followBlank == True:
+            for pattern in BLANK_PATHS:
+                self._blankPaths.extend(glob.glob(pattern))
+        self._lastTime = None
+        self._lastWakeups = 0
+        self._lastCpu = 0.0
+        self.wakeupRate = 0.0       # scheduler wake-ups per second over the last check
+        self.cpuLoad = 0.0          # process CPU seconds per second over the last check
+        metrics.REGISTRY.gauge('scheduler_wakeups_per_second', 'Scheduler wake-ups per second, last power check', lambda: self.wakeupRate)
+        metrics.REGISTRY.gauge('process_cpu_load', 'Process CPU seconds per second, last power check', lambda: self.cpuLoad)
+
+    def configured(self):
+        return self._hours is not None or len(self._blankPaths) > 0
+
+    def idle(self, now):
+        # Returns the reason to save power ('night', 'blank') or None.
+        if self._hours is not None:
+            start, end = self._hours
+            hour = datetime.datetime.fromtimestamp(now, self._tz).hour
+            if (start <= hour < end) if start <= end else (hour >= start or hour < end):
+                return 'night'
+        if self.__blanked() == True:
+            return 'blank'
+        return None
+
+    def __blanked(self):
+        for path in self._blankPaths:
+            try:
+                with open(path, 'rt') as fs:
+                    if fs.read().strip() not in ('', '0'):
+                        return True
+            except OSError:
+                continue
+        return False
+
+    def measure(self, scheduler):
+        # Updates wakeupRate and cpuLoad since the previous call.
+        now = time.monotonic()
+        cpu = time.process_time()
+        if self._lastTime is not None and now > self._lastTime:
+            self.wakeupRate = (scheduler.wakeups - self._lastWakeups) / (now - self._lastTime)
+            self.cpuLoad = (cpu - self._lastCpu) / (now - self._lastTime)
+        self._lastTime = now
+        self._lastWakeups = scheduler.wakeups
+        self._lastCpu = cpu
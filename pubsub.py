@@ -0,0 +1,393 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import os
+import socket
+import struct
+import threading
+
+import metrics
+
+from forecastmodel import Forecast
+
+# ***************************
+# Telemetry over a local socket
+# One collector owns the sensors, the forecast and the speedtest and
+# publishes its telemetry bus; any number of displays subscribe and feed
+# what they receive into their own bus, so ClockDisplay does not care
+# where a sample came from.
+#   PUBSUB_LISTEN='unix:/run/clock/telemetry.sock'   (or 'tcp:0.0.0.0:8765')
+#   PUBSUB_CONNECT= the same address on the display side
+# A new client gets one snapshot frame with every current value, then
+# delta frames with only the metrics that changed, batched for
+# PUBSUB_BATCH seconds. A frame is encoded once for all clients; a client
+# that cannot keep up is dropped and gets a fresh snapshot when it
+# reconnects, which the subscriber does on its own.
+#
+# Frame: uint32 payload length, uint8 frame type, payload.
+# Payload: uint16 entry count, entries of
+#   uint16 metric id, uint8 kind, float64 timestamp, value
+# where value is a float64 (KIND_NUMBER), uint32 length + JSON
+# (KIND_JSON), uint16 length + metric name (KIND_NAME, defines the id) or
+# the forecasts (KIND_FORECAST): uint8 locations, then per location
+# uint16 length + name, uint16 rows and rows of float64 time, uint16
+# weather id, float64 temperature, float64 rainfall.
+
+PUBSUB_LISTEN = os.environ.get('PUBSUB_LISTEN', '')
+PUBSUB_CONNECT = os.environ.get('PUBSUB_CONNECT', '')
+PUBSUB_BATCH = float(os.environ.get('PUBSUB_BATCH', 0.05))   # seconds samples are collected into one delta
+PUBSUB_QUEUE = 64           # frames buffered per client
+PUBSUB_KEEPALIVE = 5        # seconds, a silent collector is considered gone after 3 of these
+RECONNECT_MIN = 0.5         # seconds
+RECONNECT_MAX = 10
+
+FRAME_SNAPSHOT = 1
+FRAME_DELTA = 2
+FRAME_PING = 3
+
+KIND_NAME = 0
+KIND_NUMBER = 1
+KIND_JSON = 2
+KIND_FORECAST = 3
+
+_HEADER = struct.Struct('!IB')
+_ENTRY = struct.Struct('!HBd')
+_COUNT = struct.Struct('!H')
+_NUMBER = struct.Struct('!d')
+_LENGTH = struct.Struct('!I')
+_FORECAST_ROW = struct.Struct('!dHdd')
+
+
+def parseAddress(address):
+    # 'unix:/path', '/path', 'tcp:host:port' or 'host:port' -> (family, address).
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[5:]
+    if address.startswith('/'):
+        return socket.AF_UNIX, address
+    if address.startswith('tcp:'):
+        address = address[4:]
+    host, sep, port = address.rpartition(':')
+    if sep == '':
+        raise ValueError('address needs a port: {0}'.format(address))
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+
+def _text(text, length=_COUNT):
+    data = text.encode('utf-8')
+    return length.pack(len(data)) + data
+
+
+def _encodeValue(value):
+    # (kind, bytes), None for values that stay local (e.g. NetTestResult).
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return KIND_NUMBER, _NUMBER.pack(value)
+    if isinstance(value, dict) and len(value) > 0 and all([isinstance(v, Forecast) for v in value.values()]):
+        parts = [struct.pack('!B', len(value))]
+        for name, forecast in value.items():
+            rows = forecast.rows()
+            parts.append(_text(name))
+            parts.append(_COUNT.pack(len(rows)))
+            for t, weatherId, temperature, rainfall in rows:
+                parts.append(_FORECAST_ROW.pack(t, weatherId, temperature, rainfall))
+        return KIND_FORECAST, b''.join(parts)
+    try:
+        return KIND_JSON, _text(json.dumps(value, separators=(',', ':')), _LENGTH)
+    except (TypeError, ValueError):
+        return None
+
+
+def encodeFrame(frameType, entries):
+    # entries: [(metric id, kind, timestamp, encoded value)]
+    payload = [_COUNT.pack(len(entries))]
+    for metricId, kind, timestamp, data in entries:
+        payload.append(_ENTRY.pack(metricId, kind, timestamp))
+        payload.append(data)
+    payload = b''.join(payload)
+    return _HEADER.pack(len(payload), frameType) + payload
+
+
+def decodeEntries(payload, tz=None):
+    # [(metric id, kind, timestamp, value)]; names stay str, forecasts become {name: Forecast}.
+    entries = []
+    count, = _COUNT.unpack_from(payload, 0)
+    offset = _COUNT.size
+    for i in range(count):
+        metricId, kind, timestamp = _ENTRY.unpack_from(payload, offset)
+        offset += _ENTRY.size
+        if kind == KIND_NUMBER:
+            value, = _NUMBER.unpack_from(payload, offset)
+            offset += _NUMBER.size
+        elif kind == KIND_NAME or kind == KIND_JSON:
+            length = _COUNT if kind == KIND_NAME else _LENGTH
+            size, = length.unpack_from(payload, offset)
+            offset += length.size
+            value = payload[offset:offset + size].decode('utf-8')
+            offset += size
+            if kind == KIND_JSON:
+                value = json.loads(value)
+        elif kind == KIND_FORECAST:
+            value = {}
+            locations = payload[offset]
+            offset += 1
+            for n in range(locations):
+                size, = _COUNT.unpack_from(payload, offset)
+                offset += _COUNT.size
+                name = payload[offset:offset + size].decode('utf-8')
+                offset += size
+                rows, = _COUNT.unpack_from(payload, offset)
+                offset += _COUNT.size
+                items = []
+                for r in range(rows):
+                    items.append(_FORECAST_ROW.unpack_from(payload, offset))
+                    offset += _FORECAST_ROW.size
+                value[name] = Forecast.fromRows(items, tz)
+        else:
+            raise ValueError('unknown entry kind {0}'.format(kind))
+        entries.append((metricId, kind, timestamp, value))
+    return entries
+
+
+_PING = encodeFrame(FRAME_PING, [])
+
+
+class TelemetryPublisher:
+    def __init__(self, bus, address=PUBSUB_LISTEN, batch=PUBSUB_BATCH):
+        self._bus = bus
+        self._family, self._address = parseAddress(address)
+        self._batch = batch
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._dirty = {}
+        self._scheduled = False
+        self._clients = set()
+        self._writers = set()
+        self._stopped = False
+        # Loop thread only: metric -> id, and metric -> (kind, timestamp, encoded value) last sent.
+        self._ids = {}
+        self._state = {}
+        self.frames = 0
+        self.bytes = 0
+        self.dropped = 0
+
+    def start(self):
+        # Returns False when the address could not be opened.
+        self._thread = threading.Thread(target=self.__run, name='telemetryPublisher', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._server is None:
+            return False
+        for sample in self._bus.latestSamples().values():
+            self.__onSample(sample)
+        self._bus.addTap(self.__onSample)
+        metrics.REGISTRY.gauge('pubsub_clients', 'Subscribed displays', self.clients)
+        metrics.REGISTRY.gauge('pubsub_frames_total', 'Delta frames sent', lambda: self.frames, 'counter')
+        metrics.REGISTRY.gauge('pubsub_bytes_total', 'Bytes of delta frames, once per frame', lambda: self.bytes, 'counter')
+        metrics.REGISTRY.gauge('pubsub_dropped_total', 'Subscribers dropped as too slow', lambda: self.dropped, 'counter')
+        return True
+
+    def stop(self):
+        if self._server is not None:
+            self._stopped = True
+            self._bus.removeTap(self.__onSample)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(5)
+
+    def clients(self):
+        return len(self._clients)
+
+    def __run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            if self._family == socket.AF_UNIX:
+                if os.path.exists(self._address):
+                    # Left behind by a previous run.
+                    os.unlink(self._address)
+                server = asyncio.start_unix_server(self.__handle, self._address)
+            else:
+                server = asyncio.start_server(self.__handle, self._address[0], self._address[1])
+            self._server = self._loop.run_until_complete(server)
+        except OSError as e:
+            print('Telemetry publisher not started: {0}'.format(e))
+            self._ready.set()
+            return
+        print('Telemetry publisher on {0}'.format(self._server.sockets[0].getsockname()))
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            # Subscribers see the end right away and start reconnecting.
+            for writer in list(self._writers):
+                writer.transport.abort()
+            for queue in list(self._clients):
+                while queue.empty() == False:
+                    queue.get_nowait()
+                queue.put_nowait(None)
+            tasks = asyncio.all_tasks(self._loop)
+            if len(tasks) > 0:
+                self._loop.run_until_complete(asyncio.wait(tasks, timeout=1))
+            self._loop.close()
+
+    @property
+    def address(self):
+        if self._server is None:
+            return None
+        return self._server.sockets[0].getsockname()
+
+    def __onSample(self, sample):
+        # Telemetry tap, runs on the publishing thread: only marks the metric.
+        if self._stopped == True:
+            return
+        with self._lock:
+            self._dirty[sample.metric] = sample
+            if self._scheduled == True:
+                return
+            self._scheduled = True
+        self._loop.call_soon_threadsafe(self._loop.call_later, self._batch, self.__flush)
+
+    def __flush(self):
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = {}
+            self._scheduled = False
+
+        entries = []
+        for metric, sample in dirty.items():
+            encoded = _encodeValue(sample.value)
+            if encoded is None:
+                continue
+            kind, data = encoded
+            last = self._state.get(metric)
+            if last is not None and last[0] == kind and last[2] == data:
+                # Same value again, the clients already have it.
+                continue
+            metricId = self._ids.get(metric)
+            if metricId is None:
+                metricId = self._ids[metric] = len(self._ids)
+                entries.append((metricId, KIND_NAME, 0.0, _text(metric)))
+            self._state[metric] = (kind, sample.timestamp, data)
+            entries.append((metricId, kind, sample.timestamp, data))
+        if len(entries) == 0 or len(self._clients) == 0:
+            return
+
+        frame = encodeFrame(FRAME_DELTA, entries)
+        self.frames += 1
+        self.bytes += len(frame)
+        for queue in list(self._clients):
+            try:
+                queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                # Too slow: close it, the subscriber reconnects and gets a snapshot.
+                self.dropped += 1
+                self._clients.discard(queue)
+                while queue.empty() == False:
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def __snapshot(self):
+        entries = []
+        for metric, (kind, timestamp, data) in self._state.items():
+            metricId = self._ids[metric]
+            entries.append((metricId, KIND_NAME, 0.0, _text(metric)))
+            entries.append((metricId, kind, timestamp, data))
+        return encodeFrame(FRAME_SNAPSHOT, entries)
+
+    async def __handle(self, reader, writer):
+        queue = asyncio.Queue(PUBSUB_QUEUE)
+        queue.put_nowait(self.__snapshot())
+        self._clients.add(queue)
+        self._writers.add(writer)
+        try:
+            while True:
+                try:
+                    frame = await asyncio.wait_for(queue.get(), PUBSUB_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    frame = _PING
+                if frame is None:
+                    break
+                writer.write(frame)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self._clients.discard(queue)
+            self._writers.discard(writer)
+            writer.close()
+
+
+class TelemetrySubscriber:
+    # Receives a publisher's telemetry on its own thread and publishes it on
+    # the local bus. Reconnects with backoff until stopped.
+    def __init__(self, bus, address=PUBSUB_CONNECT, tz=None):
+        self._bus = bus
+        self._family, self._address = parseAddress(address)
+        self._tz = tz
+        self._stop = threading.Event()
+        self._socket = None
+        self._thread = None
+        self.connected = False
+        self.connects = 0
+        self.frames = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self.__run, name='telemetrySubscriber', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        sock = self._socket
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def __run(self):
+        delay = RECONNECT_MIN
+        while self._stop.is_set() == False:
+            try:
+                self._socket = socket.socket(self._family, socket.SOCK_STREAM)
+                self._socket.settimeout(PUBSUB_KEEPALIVE * 3)
+                self._socket.connect(self._address)
+                self.connected = True
+                self.connects += 1
+                delay = RECONNECT_MIN
+                print('Telemetry subscriber connected to {0}'.format(self._address))
+                self.__receive(self._socket.makefile('rb'))
+            except (OSError, ValueError, struct.error) as e:
+                if self.connected == True:
+                    print('Telemetry subscriber disconnected: {0}'.format(e))
+            finally:
+                self.connected = False
+                self._socket.close()
+            self._stop.wait(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    def __receive(self, stream):
+        names = {}
+        while True:
+            header = stream.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                raise ConnectionError('closed by the publisher')
+            length, frameType = _HEADER.unpack(header)
+            payload = stream.read(length)
+            if len(payload) < length:
+                raise ConnectionError('closed by the publisher')
+            self.frames += 1
+            if frameType == FRAME_PING:
+                continue
+            for metricId, kind, timestamp, value in decodeEntries(payload, self._tz):
+                if kind == KIND_NAME:
+                    names[metricId] = value
+                    continue
+                metric = names.get(metricId)
+                if metric is not None:
+                    self._bus.publish(metric, value, timestamp, source='pubsub')
@@ -0,0 +1,431 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import gzip
+import json
+import os
+import platform
+import re
+import runpy
+import sys
+import tempfile
+import threading
+import time
+import types
+
+# ***************************
+# Record and replay of everything the app reads from the outside world
+# The recorder wraps the live sources and writes what they returned, with
+# the time, into a gzip JSON lines trace: raw I2C register reads of the
+# BME280s, the forecast HTTP responses and the output of external commands
+# (vcgencmd, speedtest). A read that returns the same as the previous one
+# of the same source is not written again, so a week of 10 second polls
+# stays small.
+# The replayer puts stand-ins for those sources in place that answer with
+# the newest recorded value at the virtual time, and runs the collector (or
+# the whole display) on a virtual clock that jumps from one scheduler
+# deadline to the next. Nothing is read from a sensor or the network.
+# usage:
+#   python3 replay.py record TRACE [SCRIPT]           run SCRIPT (collector.py) and record
+#   python3 replay.py play TRACE [--display] [--hours N] [--speed X] [--dir DIR]
+# /proc and sysfs (CPU usage, thermal zones) are not recorded and read live.
+
+TRACE_VERSION = 1
+RECORD_FLUSH = 60           # seconds between flushes of the trace file
+REPLAY_SETTLE = 10.0        # seconds to wait for the workers after every step
+
+
+def _i2cKey(bus, addr, cmd, length):
+    return '{0}:0x{1:02x}:0x{2:02x}:{3}'.format(bus, addr, cmd, length)
+
+
+def _httpKey(url):
+    # The API key is not written to the trace, and a replay needs none.
+    import weatherinfo
+    if weatherinfo.API_KEY:
+        url = url.replace(weatherinfo.API_KEY, '{key}')
+    return re.sub(r'([?&]appid=)[^&]*', r'\1{key}', url, flags=re.IGNORECASE)
+
+
+class Recorder:
+    def __init__(self, path, clock=time.time):
+        # clock stamps the records, a made up trace passes a virtual one (benchmark/bench_replay.py).
+        self._clock = clock
+        self._fs = gzip.open(path, 'wt', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._last = {}
+        self._lastFlush = time.monotonic()
+        self.records = 0
+        self.skipped = 0
+        self.__write({'trace': TRACE_VERSION, 'created': time.time(), 'host': platform.node()})
+
+    def __write(self, item):
+        self._fs.write(json.dumps(item, separators=(',', ':')) + '\n')
+
+    def record(self, kind, key, value):
+        with self._lock:
+            if self._fs is None:
+                return
+            if self._last.get((kind, key)) == value:
+                self.skipped += 1
+                return
+            self._last[(kind, key)] = value
+            self.__write([round(self._clock(), 3), kind, key, value])
+            self.records += 1
+            if time.monotonic() - self._lastFlush >= RECORD_FLUSH:
+                self._fs.flush()
+                self._lastFlush = time.monotonic()
+
+    def install(self):
+        # Wraps smbus, the forecast session and external commands.
+        import bme280
+        import cpuinfo
+        import weatherinfo
+        live = sys.modules.get('smbus') or bme280.smbus
+        if live is not None:
+            module = types.ModuleType('smbus')
+            module.SMBus = lambda bus=1, *args, **kwargs: RecordingSMBus(live.SMBus(bus, *args, **kwargs), bus, self)
+            sys.modules['smbus'] = module
+            bme280.smbus = module
+        weatherinfo.setSession(RecordingSession(weatherinfo._session, self))
+        cpuinfo.setCommandHook(self.__command)
+
+    def __command(self, cmd, run):
+        try:
+            lines = run(cmd)
+        except OSError as e:
+            self.record('cmd', cmd, {'error': str(e)})
+            raise
+        self.record('cmd', cmd, lines)
+        return lines
+
+    def close(self):
+        with self._lock:
+            if self._fs is not None:
+                self._fs.close()
+                self._fs = None
+
+
+class RecordingSMBus:
+    # Passes every transfer to the live bus and records the reads.
+    def __init__(self, bus, busNumber, recorder):
+        self._bus = bus
+        self._busNumber = busNumber
+        self._recorder = recorder
+
+    def read_byte_data(self, addr, cmd):
+        value = self._bus.read_byte_data(addr, cmd)
+        self._recorder.record('i2c', _i2cKey(self._busNumber, addr, cmd, 1), '{0:02x}'.format(value))
+        return value
+
+    def read_i2c_block_data(self, addr, cmd, length=32):
+        data = self._bus.read_i2c_block_data(addr, cmd, length)
+        self._recorder.record('i2c', _i2cKey(self._busNumber, addr, cmd, length), bytes(data).hex())
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._bus, name)
+
+
+class RecordingSession:
+    # Passes requests to the live session and records the answers. A 304
+    # is not recorded, the newest recorded payload is still the valid one.
+    def __init__(self, session, recorder):
+        self._session = session
+        self._recorder = recorder
+
+    def get(self, url, **kwargs):
+        try:
+            response = self._session.get(url, **kwargs)
+        except Exception as e:
+            self._recorder.record('http', _httpKey(url), {'error': str(e)})
+            raise
+        if response.status_code != 304:
+            headers = dict([(k, v) for k, v in response.headers.items() if k in ('ETag', 'Last-Modified')])
+            self._recorder.record('http', _httpKey(url), {
+                'status': response.status_code, 'headers': headers, 'body': response.text})
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+class Trace:
+    def __init__(self, path):
+        self.header = {}
+        self._series = {}       # (kind, key): ([times], [values])
+        self.start = None
+        self.end = None
+        with gzip.open(path, 'rt', encoding='utf-8') as fs:
+            try:
+                for line in fs:
+                    self.__add(json.loads(line))
+            except (EOFError, ValueError):
+                # A trace whose recorder was killed ends in the middle of a line.
+                pass
+        if self.start is None:
+            raise ValueError('{0} holds no records'.format(path))
+
+    def __add(self, item):
+        if isinstance(item, dict):
+            self.header = item
+            return
+        t, kind, key, value = item
+        times, values = self._series.setdefault((kind, key), ([], []))
+        times.append(t)
+        values.append(value)
+        if self.start is None or t < self.start:
+            self.start = t
+        if self.end is None or t > self.end:
+            self.end = t
+
+    def __len__(self):
+        return sum([len(times) for times, values in self._series.values()])
+
+    def lookup(self, kind, key, t):
+        # Newest value recorded at or before t (the first one before that), None when never recorded.
+        series = self._series.get((kind, key))
+        if series is None:
+            return None
+        times, values = series
+        i = bisect.bisect_right(times, t)
+        return values[max(0, i - 1)]
+
+    def buses(self):
+        return sorted(set([int(key.split(':')[0]) for kind, key in self._series if kind == 'i2c']))
+
+    def addresses(self):
+        return sorted(set([int(key.split(':')[1], 0) for kind, key in self._series if kind == 'i2c']))
+
+
+class ReplaySMBus:
+    # Register reads answered from the trace at the virtual time, writes are dropped.
+    def __init__(self, bus, trace, clock):
+        self.bus = bus
+        self._trace = trace
+        self._clock = clock
+
+    def __read(self, addr, cmd, length):
+        value = self._trace.lookup('i2c', _i2cKey(self.bus, addr, cmd, length), self._clock())
+        if value is None:
+            # Same errno the kernel driver reports for a missing device.
+            raise OSError(121, 'Remote I/O error')
+        return bytes.fromhex(value)
+
+    def read_byte_data(self, addr, cmd):
+        return self.__read(addr, cmd, 1)[0]
+
+    def read_i2c_block_data(self, addr, cmd, length=32):
+        return list(self.__read(addr, cmd, length))
+
+    def write_byte_data(self, addr, cmd, val):
+        pass
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplaySession:
+    # Forecast requests answered from the trace, recorded failures are raised again.
+    def __init__(self, trace, clock):
+        self._trace = trace
+        self._clock = clock
+
+    def get(self, url, headers=None, timeout=None, **kwargs):
+        import requests
+        recorded = self._trace.lookup('http', _httpKey(url), self._clock())
+        if recorded is None:
+            raise requests.ConnectionError('{0} is not in the trace'.format(_httpKey(url)))
+        if 'error' in recorded:
+            raise requests.ConnectionError(recorded['error'])
+        response = requests.Response()
+        response.status_code = recorded['status']
+        response.headers.update(recorded['headers'])
+        response.encoding = 'utf-8'
+        response.url = url
+        response._content = recorded['body'].encode('utf-8')
+        return response
+
+
+class VirtualClock:
+    # Callable like time.time. advanceTo() waits for the app to settle first,
+    # and with speed > 0 sleeps the virtual interval divided by speed.
+    def __init__(self, start, speed=0.0):
+        self.now = start
+        self.speed = speed
+        self.settle = None
+
+    def __call__(self):
+        return self.now
+
+    def advanceTo(self, t):
+        if self.settle is not None:
+            self.settle()
+        if t <= self.now:
+            return
+        if self.speed > 0:
+            time.sleep((t - self.now) / self.speed)
+        self.now = t
+
+
+def installReplay(trace, clock):
+    # Puts the stand-ins in place of smbus, the forecast session and external commands.
+    import bme280
+    import cpuinfo
+    import weatherinfo
+    module = types.ModuleType('smbus')
+    module.SMBus = lambda bus=1: ReplaySMBus(bus, trace, clock)
+    sys.modules['smbus'] = module
+    bme280.smbus = module
+    weatherinfo.setSession(ReplaySession(trace, clock))
+
+    def command(cmd, run):
+        lines = trace.lookup('cmd', cmd, clock())
+        if lines is None or isinstance(lines, dict):
+            raise OSError(2, 'Not in the trace: {0}'.format(cmd))
+        return lines
+    cpuinfo.setCommandHook(command)
+
+
+def replayEnvironment(trace, directory):
+    # Keeps the replay away from live files and ports; set before the app modules are imported.
+    os.environ['HISTORY_PATH'] = os.path.join(directory, 'roominfo.ring')
+    os.environ['HISTORYDB_PATH'] = os.path.join(directory, 'history.sqlite3')
+    os.environ['SNAPSHOT_PATH'] = os.path.join(directory, 'snapshot.json')
+    os.environ['FORECAST_CACHE'] = os.path.join(directory, 'forecast.json')
+    # Every forecast fetch goes to the trace, the virtual clock decides when.
+    os.environ['FORECAST_TTL'] = '0'
+    os.environ['FORECAST_RATE_LIMIT'] = '0'
+    os.environ['DASHBOARD_PORT'] = '0'
+    os.environ['PUBSUB_LISTEN'] = ''
+    os.environ['PUBSUB_CONNECT'] = ''
+    # Power save follows POWER_SAVE_HOURS on the virtual clock, not this machine's screen.
+    os.environ['POWER_SAVE_BLANK'] = '0'
+    # The speedtest command is recorded, a direct NetTest run is not.
+    os.environ['SPEEDTEST_URL'] = ''
+    os.environ['SENSOR_BUSES'] = ','.join([str(bus) for bus in trace.buses()])
+    os.environ['SENSOR_ADDRESSES'] = ','.join(['0x{0:02x}'.format(a) for a in trace.addresses()])
+
+
+def playHeadless(trace, clock, until):
+    # Returns (scheduler, collector) after running the collector up to until.
+    import collector
+    from scheduler import Scheduler
+    from telemetry import TelemetryBus
+    collector.CSV_PATH = os.path.join(os.path.dirname(os.environ['HISTORY_PATH']), 'roominfo.csv')
+    bus = TelemetryBus(clock)
+    scheduler = Scheduler(collector.TIMEZONE, clock)
+    app = collector.Collector(bus, clock)
+    app.schedule(scheduler, weather=True, power=True)
+    clock.settle = app.settle
+    while True:
+        scheduler.runDue()
+        deadline = scheduler.nextDeadline()
+        if deadline is None or deadline > until:
+            break
+        clock.advanceTo(deadline)
+    clock.settle = None
+    app.close()
+    return scheduler, app
+
+
+def playDisplay(trace, clock, until):
+    # Same with the whole display; QT_QPA_PLATFORM=offscreen runs it without a screen.
+    from PyQt5.QtWidgets import QApplication, QGridLayout, QWidget
+    import collector
+    import ClockWithWeatherForecast as gui
+    collector.CSV_PATH = os.path.join(os.path.dirname(os.environ['HISTORY_PATH']), 'roominfo.csv')
+    app = QApplication(sys.argv[:1])
+    window = QWidget()
+    gui.layout = QGridLayout()
+    display = gui.ClockDisplay(app, window, clock)
+    window.setLayout(gui.layout)
+    window.resize(480, 320)
+    display.start()
+    window.show()
+    deadline = time.monotonic() + REPLAY_SETTLE
+    while display.collector is None and time.monotonic() < deadline:
+        app.processEvents()
+        time.sleep(0.01)
+    if display.collector is not None:
+        clock.settle = display.collector.settle
+    scheduler = display.scheduler
+    while True:
+        deadline = scheduler.nextDeadline()
+        if deadline is None or deadline > until:
+            break
+        # A little past the boundary, like the timer of the display.
+        clock.advanceTo(deadline + 0.002)
+        display.onTimer()
+        app.processEvents()
+    clock.settle = None
+    if display.collector is not None:
+        display.collector.close()
+    return scheduler, display.collector
+
+
+def record(path, script):
+    recorder = Recorder(path)
+    recorder.install()
+    print('Recording to {0}'.format(path))
+    sys.argv = [script]
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recorder.close()
+        print('{0} records, {1} repeated reads not written'.format(recorder.records, recorder.skipped))
+
+
+def play(path, display=False, hours=None, speed=0.0, directory=None):
+    trace = Trace(path)
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='replay')
+    replayEnvironment(trace, directory)
+    clock = VirtualClock(trace.start, speed)
+    installReplay(trace, clock)
+    until = trace.end if hours is None else trace.start + hours * 3600
+    print('Replaying {0} records, {1:.1f} hours, into {2}'.format(len(trace), (until - trace.start) / 3600, directory))
+
+    start = time.perf_counter()
+    if display == True:
+        scheduler, app = playDisplay(trace, clock, until)
+    else:
+        scheduler, app = playHeadless(trace, clock, until)
+    wall = time.perf_counter() - start
+
+    span = clock.now - trace.start
+    print('{0:.1f} hours in {1:.1f}s ({2:.0f}x), {3} wake-ups'.format(
+        span / 3600, wall, span / max(wall, 1e-9), scheduler.wakeups))
+    for name, stats in scheduler.stats().items():
+        print('{0}: runs:{1} took:{2:.3f}s missed:{3} overruns:{4}'.format(
+            name, stats['runs'], stats['duration'], stats['missed'], stats['overruns']))
+    return span, wall
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Record the live sources, or replay a trace on a virtual clock')
+    commands = parser.add_subparsers(dest='command')
+    recordParser = commands.add_parser('record')
+    recordParser.add_argument('trace')
+    recordParser.add_argument('script', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'collector.py'))
+    playParser = commands.add_parser('play')
+    playParser.add_argument('trace')
+    playParser.add_argument('--display', action='store_true', help='replay through the whole display')
+    playParser.add_argument('--hours', type=float, help='replay only the first hours of the trace')
+    playParser.add_argument('--speed', type=float, default=0.0, help='virtual seconds per second, 0 runs flat out')
+    playParser.add_argument('--dir', help='directory for the history files (default: a new temporary one)')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.trace, args.script)
+    elif args.command == 'play':
+        play(args.trace, args.display, args.hours, args.speed, args.dir)
+    else:
+        parser.print_help()
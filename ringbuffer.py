@@ -0,0 +1,66 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from array import array
+
+# ***************************
+# Fixed-size in-memory ring of (time, value) samples
+# Two preallocated array columns and a write position; appending never
+# allocates, so the memory of a rolling window stays constant however
+# long the display runs. Used by the sparklines of the clock face.
+
+
+class RingBuffer:
+    def __init__(self, capacity):
+        self._capacity = max(1, int(capacity))
+        self._times = array('d', bytes(8 * self._capacity))
+        self._values = array('d', bytes(8 * self._capacity))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def append(self, t, value):
+        self._times[self._next] = t
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self._capacity
+        if self._count < self._capacity:
+            self._count += 1
+
+    def last(self):
+        # (time, value) of the newest sample, None when empty.
+        if self._count == 0:
+            return None
+        i = (self._next - 1) % self._capacity
+        return self._times[i], self._values[i]
+
+    def items(self, since=None):
+        # (time, value) oldest first; with since only the samples newer than that.
+        first = (self._next - self._count) % self._capacity
+        for n in range(self._count):
+            i = (first + n) % self._capacity
+            if since is not None and self._times[i] <= since:
+                continue
+            yield self._times[i], self._values[i]
+
+    def minMax(self, since=None):
+        # (min, max) of the values, None when there are none.
+        low = None
+        high = None
+        for t, value in self.items(since):
+            if low is None or value < low:
+                low = value
+            if high is None or value > high:
+                high = value
+        if low is None:
+            return None
+        return low, high
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
@@ -0,0 +1,229 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+# ***************************
+# Fixed capacity time series store
+# Records are fixed width and live in a memory mapped ring file, so an
+# append only touches one record and one commit slot whatever the capacity.
+#
+# File layout
+#   0   : static header (magic, version, fields, capacity)
+#   64  : commit slot 0 (seq, start, count, crc32)
+#   96  : commit slot 1
+#   128 : capacity + 1 records (timestamp, utc offset, fields * float64)
+#
+# The commit slots are written alternately and validated by crc32, so a torn
+# header write falls back to the previous commit. One spare record slot is
+# kept so that a new record never overwrites a record the last commit
+# still refers to. The commit does not cover the record bytes, so by default
+# every append flushes its record before the commit that publishes it; a
+# crash can then lose the last record but never expose a torn one. sync=False
+# leaves the write back to the kernel, for bulk loads and benchmarks.
+
+MAGIC = b'RSTR'
+VERSION = 1
+HEADER_FORMAT = '<4sHHQ'
+COMMIT_FORMAT = '<QQQI'
+COMMIT_OFFSETS = (64, 96)
+DATA_OFFSET = 128
+
+
+class RingStore:
+    def __init__(self, path, capacity, fields, sync=True):
+        if int(capacity) < 1:
+            raise ValueError('{0}: capacity must be at least 1, got {1}'.format(path, capacity))
+        self._path = path
+        self._capacity = int(capacity)
+        self._fields = int(fields)
+        self._sync = sync
+        self._lock = threading.Lock()
+        self._record = struct.Struct('<di4x' + 'd' * self._fields)
+        self._slots = self._capacity + 1
+        self._seq = 0
+        self._start = 0
+        self._count = 0
+
+        if os.path.exists(path) == True:
+            self.__open()
+        else:
+            self.__create(path)
+            self.__open()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def __fileSize(self):
+        return DATA_OFFSET + self._slots * self._record.size
+
+    def __create(self, path, rows=()):
+        # Writes a store holding rows next to path and moves it over path, so
+        # after a crash path is either the old file or the complete new one.
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'wb') as fs:
+            fs.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, self._fields, self._capacity))
+            fs.truncate(self.__fileSize())
+            for i, ((epoch, utcOffset), values) in enumerate(rows):
+                fs.seek(DATA_OFFSET + i * self._record.size)
+                fs.write(self._record.pack(epoch, utcOffset, *values))
+            seq = len(rows)
+            fs.seek(COMMIT_OFFSETS[seq % 2])
+            fs.write(self.__packCommit(seq, 0, len(rows)))
+            fs.flush()
+            os.fsync(fs.fileno())
+        os.replace(tmpPath, path)
+        if os.name != 'nt':
+            # Makes the rename itself durable.
+            directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+    def __open(self):
+        self._fd = open(self._path, 'r+b')
+        magic, version, fields, capacity = struct.unpack_from(
+            HEADER_FORMAT, self._fd.read(struct.calcsize(HEADER_FORMAT)))
+        if magic != MAGIC or version != VERSION:
+            self._fd.close()
+            raise ValueError('{0} is not a ring store file'.format(self._path))
+        if fields != self._fields:
+            self._fd.close()
+            raise ValueError('{0} has {1} fields, expected {2}'.format(self._path, fields, self._fields))
+        if capacity != self._capacity:
+            # Retention changed, keep the newest rows that still fit.
+            self._fd.close()
+            self.__resize(capacity)
+            self._fd = open(self._path, 'r+b')
+
+        self._map = mmap.mmap(self._fd.fileno(), self.__fileSize())
+        self.__loadCommit()
+
+    def __resize(self, oldCapacity):
+        newCapacity = self._capacity
+        self._capacity = oldCapacity
+        self._slots = oldCapacity + 1
+        self._fd = open(self._path, 'r+b')
+        self._map = mmap.mmap(self._fd.fileno(), self.__fileSize())
+        self.__loadCommit()
+        rows = self.rows()
+        self.close()
+
+        self._capacity = newCapacity
+        self._slots = newCapacity + 1
+        self.__create(self._path, rows[-newCapacity:])
+
+    def __packCommit(self, seq, start, count):
+        body = struct.pack('<QQQ', seq, start, count)
+        return body + struct.pack('<I', zlib.crc32(body))
+
+    def __loadCommit(self):
+        best = None
+        for offset in COMMIT_OFFSETS:
+            seq, start, count, crc = struct.unpack_from(COMMIT_FORMAT, self._map, offset)
+            body = struct.pack('<QQQ', seq, start, count)
+            if zlib.crc32(body) != crc or start >= self._slots or count > self._capacity:
+                continue
+            if best is None or seq > best[0]:
+                best = (seq, start, count)
+        if best is None:
+            raise ValueError('{0} has no valid commit'.format(self._path))
+        self._seq, self._start, self._count = best
+
+    def __writeCommit(self):
+        offset = COMMIT_OFFSETS[self._seq % 2]
+        self._map[offset:offset + 28] = self.__packCommit(self._seq, self._start, self._count)
+
+    def __appendLocked(self, timestamp, values, sync):
+        if isinstance(timestamp, datetime.datetime):
+            offset = timestamp.utcoffset()
+            utcOffset = int(offset.total_seconds()) if offset is not None else 0
+            epoch = timestamp.timestamp()
+        else:
+            epoch, utcOffset = timestamp
+
+        slot = (self._start + self._count) % self._slots
+        position = DATA_OFFSET + slot * self._record.size
+        self._record.pack_into(self._map, position, epoch, utcOffset, *values)
+        if sync == True:
+            self.__flushRange(position, self._record.size)
+
+        if self._count == self._capacity:
+            self._start = (self._start + 1) % self._slots
+        else:
+            self._count += 1
+        self._seq += 1
+        self.__writeCommit()
+        if sync == True:
+            self.__flushRange(0, DATA_OFFSET)
+
+    def __flushRange(self, offset, size):
+        aligned = offset - offset % mmap.ALLOCATIONGRANULARITY
+        self._map.flush(aligned, offset + size - aligned)
+
+    def append(self, timestamp, values):
+        # timestamp is an aware datetime or an (epoch, utc offset seconds) tuple.
+        if len(values) != self._fields:
+            raise ValueError('expected {0} values, got {1}'.format(self._fields, len(values)))
+        with self._lock:
+            self.__appendLocked(timestamp, values, self._sync)
+
+    def rows(self, last=None):
+        # Oldest first list of ((epoch, utc offset), values).
+        with self._lock:
+            count = self._count
+            skip = 0
+            if last is not None and last < count:
+                skip = count - last
+            result = []
+            for i in range(skip, count):
+                slot = (self._start + i) % self._slots
+                record = self._record.unpack_from(self._map, DATA_OFFSET + slot * self._record.size)
+                result.append(((record[0], record[1]), record[2:]))
+            return result
+
+    def exportCsv(self, path, last=None):
+        # Same line format as the original roominfo.csv writer.
+        lines = []
+        for (epoch, utcOffset), values in self.rows(last):
+            tz = datetime.timezone(datetime.timedelta(seconds=utcOffset))
+            lines.append('{0}, {1}\n'.format(
+                datetime.datetime.fromtimestamp(epoch, tz).strftime("%Y/%m/%d %H:%M:%S %z"),
+                ', '.join(['{:g}'.format(v) for v in values])))
+
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'wt') as fs:
+            fs.writelines(lines)
+        os.replace(tmpPath, path)
+
+    def importCsv(self, path):
+        # Loads rows written by the original roominfo.csv writer.
+        with open(path, 'rt') as fs:
+            for line in fs:
+                items = [s.strip() for s in line.split(',')]
+                if len(items) != self._fields + 1:
+                    continue
+                try:
+                    timestamp = datetime.datetime.strptime(items[0], "%Y/%m/%d %H:%M:%S %z")
+                    values = [float(s) for s in items[1:]]
+                except ValueError:
+                    continue
+                self.append(timestamp, values)
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+                self._map.close()
+                self._map = None
+            self._fd.close()
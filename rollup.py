@@ -0,0 +1,165 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import json
+import math
+import os
+import threading
+
+from ringstore import RingStore
+
+# ***************************
+# Multi resolution rollups of the room info history
+# Each sample is folded into the open hour and day buckets as it arrives.
+# When a bucket closes its min / mean / max are appended to a ring file of
+# that resolution, and every resolution is published as its own compact
+# json file so the web page only downloads the range it is showing.
+
+RESOLUTIONS = [
+    # name, bucket seconds, rows kept, rows published
+    ('hour', 60 * 60, 24 * 365, 24 * 31),
+    ('day', 24 * 60 * 60, 365 * 10, 365 * 2),
+]
+RAW_PUBLISH_ROWS = 24 * 2 * 2
+
+
+def _bucketStart(epoch, utcOffset, seconds):
+    # Buckets are aligned to local time so that days start at midnight.
+    return math.floor((epoch + utcOffset) / seconds) * seconds - utcOffset
+
+
+class _Bucket:
+    __slots__ = ('start', 'utcOffset', 'count', 'minimum', 'maximum', 'total')
+
+    def __init__(self, start, utcOffset, fields):
+        self.start = start
+        self.utcOffset = utcOffset
+        self.count = 0
+        self.minimum = [math.inf] * fields
+        self.maximum = [-math.inf] * fields
+        self.total = [0.0] * fields
+
+    def add(self, values):
+        self.count += 1
+        for i, v in enumerate(values):
+            if v < self.minimum[i]:
+                self.minimum[i] = v
+            if v > self.maximum[i]:
+                self.maximum[i] = v
+            self.total[i] += v
+
+    def record(self):
+        # count, mins, means, maxes
+        means = [t / self.count for t in self.total]
+        return [float(self.count)] + self.minimum + means + self.maximum
+
+
+class Rollup:
+    def __init__(self, history, names, directory, publishDir, prefix='roominfo'):
+        self._history = history
+        self._names = names
+        self._fields = len(names)
+        self._publishDir = publishDir
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._stores = {}
+        self._buckets = {}
+
+        for name, seconds, retention, publishRows in RESOLUTIONS:
+            path = os.path.join(directory, '{0}_{1}.ring'.format(prefix, name))
+            self._stores[name] = RingStore(path, retention, self._fields * 3 + 1)
+            self._buckets[name] = None
+
+        self.__recover()
+
+    def __recover(self):
+        # Rebuild the open buckets from raw rows newer than the last closed bucket.
+        for name, seconds, retention, publishRows in RESOLUTIONS:
+            closed = self._stores[name].rows(1)
+            closedEnd = closed[0][0][0] + seconds if len(closed) > 0 else -math.inf
+            for (epoch, utcOffset), values in self._history.rows():
+                if epoch >= closedEnd:
+                    self.__addTo(name, seconds, epoch, utcOffset, values)
+
+    def __addTo(self, name, seconds, epoch, utcOffset, values):
+        start = _bucketStart(epoch, utcOffset, seconds)
+        bucket = self._buckets[name]
+        if bucket is not None and bucket.start != start:
+            self._stores[name].append((bucket.start, bucket.utcOffset), bucket.record())
+            bucket = None
+        if bucket is None:
+            bucket = self._buckets[name] = _Bucket(start, utcOffset, self._fields)
+        bucket.add(values)
+
+    def add(self, timestamp, values):
+        # Call after the sample has been appended to the raw history.
+        epoch = timestamp.timestamp()
+        offset = timestamp.utcoffset()
+        utcOffset = int(offset.total_seconds()) if offset is not None else 0
+        with self._lock:
+            for name, seconds, retention, publishRows in RESOLUTIONS:
+                self.__addTo(name, seconds, epoch, utcOffset, values)
+            self.__publishAll()
+
+    def publishAll(self):
+        with self._lock:
+            self.__publishAll()
+
+    def __publishAll(self):
+        # Every file is bounded by its publish row count, not by history length.
+        self.__publish('raw')
+        for name, seconds, retention, publishRows in RESOLUTIONS:
+            self.__publish(name)
+
+    def series(self, name, since=None):
+        # Same content as the published file. With since (epoch ms) every kept
+        # row newer than that is returned instead of the publish window.
+        with self._lock:
+            return self.__series(name, since)
+
+    def __series(self, name, since):
+        series = {}
+        times = []
+        if name == 'raw':
+            for n in self._names:
+                series[n] = {'v': []}
+            for (epoch, utcOffset), values in self._history.rows(RAW_PUBLISH_ROWS if since is None else None):
+                if since is not None and int(epoch * 1000) <= since:
+                    continue
+                times.append(int(epoch * 1000))
+                for i, n in enumerate(self._names):
+                    series[n]['v'].append(round(values[i], 2))
+        else:
+            publishRows = [r[3] for r in RESOLUTIONS if r[0] == name][0]
+            for n in self._names:
+                series[n] = {'min': [], 'mean': [], 'max': []}
+            rows = self._stores[name].rows(publishRows if since is None else None)
+            bucket = self._buckets[name]
+            if bucket is not None:
+                # The open bucket is published too, so the latest hour/day is visible.
+                rows.append(((bucket.start, bucket.utcOffset), bucket.record()))
+            f = self._fields
+            for (epoch, utcOffset), values in rows:
+                if since is not None and int(epoch * 1000) <= since:
+                    continue
+                times.append(int(epoch * 1000))
+                for i, n in enumerate(self._names):
+                    series[n]['min'].append(round(values[1 + i], 2))
+                    series[n]['mean'].append(round(values[1 + f + i], 2))
+                    series[n]['max'].append(round(values[1 + 2 * f + i], 2))
+        return {'resolution': name, 't': times, 'series': series}
+
+    def __publish(self, name):
+        data = self.__series(name, None)
+        path = os.path.join(self._publishDir, '{0}_{1}.json'.format(self._prefix, name))
+        tmpPath = path + '.tmp'
+        try:
+            with open(tmpPath, 'wt') as fs:
+                json.dump(data, fs, separators=(',', ':'))
+            os.replace(tmpPath, path)
+        except OSError as e:
+            print('Cannot publish {0}: {1}'.format(path, e))
+
+    def close(self):
+        for store in self._stores.values():
+            store.close()
@@ -0,0 +1,176 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import random
+import time
+
+# ***************************
+# Wall clock aligned task scheduler
+# Tasks run on real deadlines (second boundaries, every N seconds, or at
+# given minutes of the hour) and the owner sleeps until nextDeadline()
+# instead of polling. Missed deadlines are caught up with a single run.
+# No Qt dependency, so the headless collector can use it as well.
+
+
+class Task:
+    __slots__ = ('name', 'fn', 'interval', 'minutes', 'offset', 'jitter', 'enabled',
+                 'nextRun', 'deadline', 'lastRun', 'duration', 'lateness', 'maxLateness',
+                 'runs', 'missed', 'overruns')
+
+    def __init__(self, name, fn, interval=None, minutes=None, offset=0.0, jitter=0.0):
+        self.name = name
+        self.fn = fn
+        self.interval = interval    # seconds, aligned to the epoch (+offset)
+        self.minutes = minutes      # minutes of the hour (local time)
+        self.offset = offset
+        self.jitter = jitter
+        self.enabled = True
+        self.nextRun = 0.0          # deadline plus jitter
+        self.deadline = 0.0         # aligned deadline without jitter
+        self.lastRun = 0.0
+        self.duration = 0.0
+        self.lateness = 0.0
+        self.maxLateness = 0.0
+        self.runs = 0
+        self.missed = 0             # deadlines folded into a catch-up run
+        self.overruns = 0           # runs that took longer than the period
+
+    def period(self):
+        if self.interval is not None:
+            return self.interval
+        return 60.0 * 60 / max(1, len(self.minutes))
+
+    def stats(self):
+        return {
+            'lastRun': self.lastRun,
+            'duration': self.duration,
+            'lateness': self.lateness,
+            'maxLateness': self.maxLateness,
+            'runs': self.runs,
+            'missed': self.missed,
+            'overruns': self.overruns,
+        }
+
+
+class Scheduler:
+    def __init__(self, tz=None, clock=time.time):
+        self._tz = tz
+        self._clock = clock
+        self._tasks = []
+        self.wakeups = 0
+
+    def now(self):
+        return self._clock()
+
+    def every(self, name, interval, fn, offset=0.0, jitter=0.0, runAtStart=True):
+        # Runs fn(now) at every multiple of interval seconds (plus offset).
+        task = Task(name, fn, interval=float(interval), offset=offset, jitter=jitter)
+        return self.__add(task, runAtStart)
+
+    def cron(self, name, minutes, fn, second=0.0, jitter=0.0, runAtStart=True):
+        # Runs fn(now) at the given minutes of every hour in local time.
+        task = Task(name, fn, minutes=sorted(minutes), offset=second, jitter=jitter)
+        return self.__add(task, runAtStart)
+
+    def __add(self, task, runAtStart):
+        now = self.now()
+        if runAtStart == True:
+            task.deadline = task.nextRun = now
+        else:
+            self.__schedule(task, now)
+        self._tasks.append(task)
+        return task
+
+    def task(self, name):
+        for task in self._tasks:
+            if task.name == name:
+                return task
+        return None
+
+    def setInterval(self, name, interval):
+        # Changes the period of an interval task and realigns its next deadline.
+        task = self.task(name)
+        task.interval = float(interval)
+        self.__schedule(task, self.now())
+
+    def setEnabled(self, name, enabled):
+        task = self.task(name)
+        if enabled == True and task.enabled == False:
+            self.__schedule(task, self.now())
+        task.enabled = enabled
+
+    def __utcOffset(self, t):
+        if self._tz is None:
+            return 0
+        return datetime.datetime.fromtimestamp(t, self._tz).utcoffset().total_seconds()
+
+    def __nextAligned(self, task, now):
+        if task.interval is not None:
+            k = (now - task.offset) // task.interval + 1
+            return k * task.interval + task.offset
+
+        utcOffset = self.__utcOffset(now)
+        local = now + utcOffset
+        hourStart = local - local % 3600
+        for hour in (hourStart, hourStart + 3600):
+            for minute in task.minutes:
+                t = hour + minute * 60 + task.offset
+                if t > local:
+                    return t - utcOffset
+        return hourStart + 7200 - utcOffset
+
+    def __schedule(self, task, now):
+        task.deadline = self.__nextAligned(task, now)
+        task.nextRun = task.deadline
+        if task.jitter > 0:
+            task.nextRun += random.uniform(0, task.jitter)
+
+    def nextDeadline(self):
+        enabled = [t.nextRun for t in self._tasks if t.enabled == True]
+        if len(enabled) == 0:
+            return None
+        return min(enabled)
+
+    def runDue(self, now=None):
+        # Runs every task whose deadline passed, each at most once.
+        self.wakeups += 1
+        if now is None:
+            now = self.now()
+        for task in self._tasks:
+            if task.enabled == False or task.nextRun > now:
+                continue
+
+            task.lateness = now - task.nextRun
+            task.maxLateness = max(task.maxLateness, task.lateness)
+            start = time.perf_counter()
+            try:
+                task.fn(now)
+            except Exception as e:
+                print('Task {0} failed: {1}'.format(task.name, e))
+            task.duration = time.perf_counter() - start
+            task.lastRun = now
+            task.runs += 1
+            if task.duration > task.period():
+                task.overruns += 1
+
+            # Skip every deadline that passed meanwhile instead of replaying them.
+            previous = task.deadline
+            self.__schedule(task, max(now, self.now()))
+            if task.runs > 1 and task.deadline - previous > task.period() * 1.5:
+                task.missed += int((task.deadline - previous) / task.period()) - 1
+
+    def runForever(self, sleep=time.sleep):
+        # Blocking loop for owners without an event loop (headless collector).
+        while True:
+            self.runDue()
+            deadline = self.nextDeadline()
+            if deadline is None:
+                return
+            sleep(max(0.0, deadline - self.now()))
+
+    def stats(self):
+        result = {}
+        for task in self._tasks:
+            result[task.name] = task.stats()
+        return result
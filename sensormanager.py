@@ -0,0 +1,230 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+import bme280
+import metrics
+
+# ***************************
+# Polls any number of BME280 sensors spread over several I2C buses.
+# Every bus has its own worker thread, so transfers on one bus are
+# serialized while different buses are read in parallel. A sensor that
+# fails is skipped with an exponential backoff instead of holding up the
+# other sensors of the same bus on every poll.
+
+SENSOR_BUSES = [int(s, 0) for s in os.environ.get('SENSOR_BUSES', str(bme280.I2cBusNumber)).split(',') if s.strip()]
+SENSOR_ADDRESSES = [int(s, 0) for s in os.environ.get('SENSOR_ADDRESSES', '0x76,0x77').split(',') if s.strip()]
+SENSOR_SELECT = os.environ.get('SENSOR_SELECT', 'average')    # 'average' or 'bus:address' (e.g. '1:0x77')
+
+BACKOFF_MIN = 10
+BACKOFF_MAX = 10 * 60
+
+_readProbe = metrics.probe('bme280_read', 'BME280 read')
+
+
+class SensorReading:
+    __slots__ = ('bus', 'address', 'values', 'latency', 'timestamp', 'error', 'failures', 'retryAt')
+
+    def __init__(self, bus, address):
+        self.bus = bus
+        self.address = address
+        self.values = None      # [temperature, humidity, pressure]
+        self.latency = 0.0      # seconds spent in the last read
+        self.timestamp = 0.0    # time.time() of the last good read
+        self.error = None
+        self.failures = 0
+        self.retryAt = 0.0
+
+    @property
+    def key(self):
+        return '{0}:0x{1:02x}'.format(self.bus, self.address)
+
+
+class _BusWorker:
+    def __init__(self, busNumber, bus, sensorOptions):
+        self.busNumber = busNumber
+        self.bus = bus
+        self.sensors = []
+        self.readings = {}
+        self._sensorOptions = sensorOptions
+        self._pending = False
+        self._busy = False
+        self._mode = None       # sensor mode to apply before the next read
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self.__run, name='sensorBus{0}'.format(busNumber), daemon=True)
+
+    def discover(self, addresses):
+        for address in addresses:
+            try:
+                if self.bus.read_byte_data(address, bme280.REG_CHIP_ID) != bme280.BME280_CHIP_ID:
+                    continue
+                sensor = bme280.bme280(bus=self.bus, address=address, **self._sensorOptions)
+            except OSError:
+                continue
+            self.sensors.append(sensor)
+            self.readings[address] = SensorReading(self.busNumber, address)
+
+    def start(self):
+        self._thread.start()
+
+    def request(self):
+        # Coalesces with a poll that has not started yet.
+        with self._cond:
+            self._pending = True
+            self._cond.notify()
+
+    def setMode(self, mode):
+        # Applied on the bus thread, so it never interleaves with a read.
+        with self._cond:
+            self._mode = mode
+            self._pending = True
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def wait(self, deadline):
+        with self._cond:
+            while self._pending == True or self._busy == True:
+                remain = deadline - time.monotonic()
+                if remain <= 0:
+                    return False
+                self._cond.wait(remain)
+        return True
+
+    def __run(self):
+        while True:
+            with self._cond:
+                while self._pending == False and self._stopped == False:
+                    self._cond.wait()
+                if self._stopped == True:
+                    break
+                self._pending = False
+                self._busy = True
+            try:
+                self.readAll()
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def readAll(self):
+        with self._cond:
+            mode, self._mode = self._mode, None
+        for sensor in self.sensors:
+            if mode is not None:
+                try:
+                    sensor.setMode(mode)
+                except OSError as e:
+                    print('BME280 {0} mode change failed: {1}'.format(self.readings[sensor.address].key, e))
+            reading = self.readings[sensor.address]
+            now = time.time()
+            if now < reading.retryAt:
+                continue
+            start = time.perf_counter()
+            try:
+                values = sensor.getValues()
+            except OSError as e:
+                _readProbe.record(start, False)
+                reading.latency = time.perf_counter() - start
+                reading.error = str(e)
+                reading.failures += 1
+                reading.retryAt = now + min(BACKOFF_MAX, BACKOFF_MIN * 2 ** (reading.failures - 1))
+                continue
+            _readProbe.record(start)
+            reading.latency = time.perf_counter() - start
+            reading.values = values
+            reading.timestamp = now
+            reading.error = None
+            reading.failures = 0
+            reading.retryAt = 0.0
+
+
+class SensorManager:
+    def __init__(self, buses=SENSOR_BUSES, addresses=SENSOR_ADDRESSES, openBus=bme280.openBus,
+                 maxAge=60, **sensorOptions):
+        self._maxAge = maxAge
+        self._workers = []
+        for busNumber in buses:
+            try:
+                bus = openBus(busNumber)
+            except (OSError, IOError) as e:
+                print('I2C bus {0} is not available: {1}'.format(busNumber, e))
+                continue
+            worker = _BusWorker(busNumber, bus, sensorOptions)
+            worker.discover(addresses)
+            if len(worker.sensors) == 0:
+                continue
+            # First values are read synchronously so the display has data at once.
+            worker.readAll()
+            worker.start()
+            self._workers.append(worker)
+
+        for reading in self.readings():
+            print('BME280 found at {0}'.format(reading.key))
+
+    def __len__(self):
+        return sum([len(w.sensors) for w in self._workers])
+
+    def poll(self):
+        # Starts a read on every bus and returns at once.
+        for worker in self._workers:
+            worker.request()
+
+    def pollWait(self, timeout=2.0):
+        # Polls and waits until every bus finished or the timeout passed.
+        self.poll()
+        self.wait(timeout)
+        return self.readings()
+
+    def wait(self, timeout=2.0):
+        # Waits for the reads already started; False when one is still running.
+        deadline = time.monotonic() + timeout
+        return all([worker.wait(deadline) for worker in self._workers])
+
+    def setMode(self, mode, maxAge=None):
+        # bme280.MODE_FORCED or MODE_NORMAL for every sensor; takes effect
+        # with a read, which setMode starts at once. maxAge follows a slower
+        # poll interval, so readings are not dropped between two polls.
+        if maxAge is not None:
+            self._maxAge = maxAge
+        for worker in self._workers:
+            worker.setMode(mode)
+
+    def close(self):
+        # Stops the bus threads after the read in progress.
+        for worker in self._workers:
+            worker.stop()
+
+    def readings(self):
+        result = []
+        for worker in self._workers:
+            result.extend(worker.readings.values())
+        return result
+
+    def fresh(self):
+        limit = time.time() - self._maxAge
+        return [r for r in self.readings() if r.values is not None and r.timestamp >= limit]
+
+    def aggregate(self):
+        # Mean of all sensors that answered recently, or None.
+        readings = self.fresh()
+        if len(readings) == 0:
+            return None
+        return [sum([r.values[i] for r in readings]) / len(readings) for i in range(0, 3)]
+
+    def select(self, key=SENSOR_SELECT):
+        # 'average' or a single sensor by 'bus:address'.
+        if key == 'average':
+            return self.aggregate()
+        busNumber, address = [int(s, 0) for s in key.split(':')]
+        for reading in self.fresh():
+            if reading.bus == busNumber and reading.address == address:
+                return reading.values
+        return None
@@ -0,0 +1,48 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+
+from zoneinfo import ZoneInfo
+
+# ***************************
+# Settings shared by every module
+# Standard library only, so importing it costs nothing at startup. This is
+# the one place that reads .env: KEY=VALUE lines, optionally quoted, with
+# '#' comments on their own line or after an unquoted value. A variable
+# already set in the environment wins over the file.
+
+ENV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
+
+
+def loadEnv(path=ENV_PATH):
+    try:
+        with open(path, 'rt', encoding='utf-8') as fs:
+            lines = fs.read().splitlines()
+    except OSError:
+        return
+    for line in lines:
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        if line.startswith('export '):
+            line = line[7:]
+        key, sep, value = line.partition('=')
+        if sep == '':
+            continue
+        value = value.strip()
+        if len(value) > 0 and value[0] in ('"', "'"):
+            end = value.find(value[0], 1)
+            value = value[1:end] if end > 0 else value[1:]
+        else:
+            value = value.split(' #', 1)[0].rstrip()
+        os.environ.setdefault(key.strip(), value)
+
+
+loadEnv()
+
+TIMEZONE = ZoneInfo('Asia/Tokyo')
+# Minutes of the hour to fetch the forecast and run the speedtest.
+HALF_HOUR_MINUTES = [25, 55]
+# Random delay (seconds) added to the half hourly tasks, spreads a fleet of displays.
+SCHEDULE_JITTER = float(os.environ.get('SCHEDULE_JITTER', 0))
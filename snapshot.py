@@ -0,0 +1,94 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import time
+
+from forecastmodel import Forecast
+
+# ***************************
+# Last displayed state, painted in the first frame
+# The display records every value it shows (room readings, network
+# results, the forecast slots) and writes them to a small JSON file. On
+# the next start that file is read before anything else is initialized,
+# so the first frame shows the last known state instead of blank labels.
+# Writes are atomic and limited to one per SNAPSHOT_INTERVAL seconds;
+# forecast changes and shutdown flush right away.
+
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.display_snapshot.json'))
+SNAPSHOT_INTERVAL = float(os.environ.get('SNAPSHOT_INTERVAL', 60))
+# Forecast slots kept in the snapshot (the display shows 7).
+SNAPSHOT_FORECASTS = 7
+
+
+class Snapshot:
+    def __init__(self, path=SNAPSHOT_PATH, interval=SNAPSHOT_INTERVAL):
+        self._path = path
+        self._interval = interval
+        self._values = {}
+        self._forecast = []
+        self._time = 0.0
+        self._dirty = False
+        self._lastWrite = 0.0
+
+    def load(self):
+        # Returns the saved time (epoch) or None when there is no usable snapshot.
+        try:
+            with open(self._path, 'rt', encoding='utf-8') as fs:
+                state = json.load(fs)
+            self._values = dict(state['values'])
+            self._forecast = [list(item) for item in state['forecast']]
+            self._time = float(state['time'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return self._time
+
+    @property
+    def time(self):
+        return self._time
+
+    def values(self):
+        return dict(self._values)
+
+    def forecast(self, tz):
+        # A forecastmodel.Forecast, like weatherinfo.getWeatherForecast().
+        return Forecast.fromRows(self._forecast, tz)
+
+    def update(self, metric, value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return
+        if self._values.get(metric) == value:
+            return
+        self._values[metric] = value
+        self._dirty = True
+
+    def setForecast(self, forecast):
+        rows = forecast.rows(SNAPSHOT_FORECASTS)
+        if len(rows) == 0 or rows == self._forecast:
+            return
+        self._forecast = rows
+        self._dirty = True
+        self.flush(force=True)
+
+    def flush(self, force=False):
+        # Returns True when the file was written.
+        if self._dirty == False:
+            return False
+        now = time.time()
+        if force == False and now - self._lastWrite < self._interval:
+            return False
+
+        self._time = now
+        state = {'time': now, 'values': self._values, 'forecast': self._forecast}
+        tmpPath = self._path + '.tmp'
+        try:
+            with open(tmpPath, 'wt', encoding='utf-8') as fs:
+                json.dump(state, fs, separators=(',', ':'))
+            os.replace(tmpPath, self._path)
+        except OSError as e:
+            print('Cannot write display snapshot: {0}'.format(e))
+            return False
+        self._dirty = False
+        self._lastWrite = now
+        return True
@@ -0,0 +1,304 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import datetime
+import os
+
+from collections import deque
+
+import telemetry
+
+# ***************************
+# Streaming statistics of the room readings
+# Every sample updates a few windows (1 minute, 1 hour, 24 hours by
+# default) in amortized O(1): samples are merged into at most
+# WINDOW_BUCKETS time buckets per window, min and max come from monotonic
+# deques over the buckets and the mean from running sums. Memory per window
+# is bounded by the bucket count, however fast the sensor is polled. The
+# median is taken over the bucket means. On top: an EWMA for the displayed
+# value, a median based spike filter against glitchy I2C reads, today's
+# high/low and the barometric tendency over 3 hours. After a restart the
+# collector seeds everything from the raw samples of the history database.
+
+# Window lengths in seconds, ',' separated.
+ROOM_STATS_WINDOWS = [float(s) for s in os.environ.get('ROOM_STATS_WINDOWS', '60,3600,86400').split(',') if s.strip()]
+ROOM_SMOOTHING = float(os.environ.get('ROOM_SMOOTHING', 30))    # EWMA half-life in seconds, 0 shows the raw value
+WINDOW_BUCKETS = 240
+
+# A reading further than this from the median of the last SPIKE_WINDOW
+# accepted ones is dropped; SPIKE_WINDOW drops in a row are taken as a real
+# change. Readings outside the sensor range are always dropped.
+SPIKE_WINDOW = 5
+SPIKE_LIMITS = {
+    telemetry.ROOM_TEMPERATURE: 2.0,    # C
+    telemetry.ROOM_HUMIDITY: 8.0,       # %
+    telemetry.ROOM_PRESSURE: 3.0,       # hPa
+}
+SENSOR_RANGES = {
+    telemetry.ROOM_TEMPERATURE: (-40.0, 85.0),
+    telemetry.ROOM_HUMIDITY: (0.0, 100.0),
+    telemetry.ROOM_PRESSURE: (300.0, 1100.0),
+}
+
+PRESSURE_TREND_SPAN = 3 * 60 * 60
+PRESSURE_TREND_LIMIT = 1.0      # hPa per PRESSURE_TREND_SPAN below which the pressure is steady
+
+
+class RollingWindow:
+    # Count, mean, median, min and max of the samples of the last `span` seconds.
+    def __init__(self, span, buckets=WINDOW_BUCKETS):
+        self.span = float(span)
+        self._resolution = self.span / buckets
+        self._buckets = deque()     # [start, count, sum, min, max], oldest first
+        self._mins = deque()        # buckets with increasing min
+        self._maxs = deque()        # buckets with decreasing max
+        self._means = []            # sorted bucket means
+        self._count = 0
+        self._sum = 0.0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, t, value):
+        self.__evict(t)
+        start = t - t % self._resolution
+        if len(self._buckets) > 0 and self._buckets[-1][0] == start:
+            bucket = self._buckets[-1]
+            self.__removeMean(bucket)
+            bucket[1] += 1
+            bucket[2] += value
+            bucket[3] = min(bucket[3], value)
+            bucket[4] = max(bucket[4], value)
+            # The newest bucket is at the back of the deques if it is in them at all.
+            if len(self._mins) > 0 and self._mins[-1] is bucket:
+                self._mins.pop()
+            if len(self._maxs) > 0 and self._maxs[-1] is bucket:
+                self._maxs.pop()
+        else:
+            bucket = [start, 1, value, value, value]
+            self._buckets.append(bucket)
+        bisect.insort(self._means, bucket[2] / bucket[1])
+        while len(self._mins) > 0 and self._mins[-1][3] >= bucket[3]:
+            self._mins.pop()
+        self._mins.append(bucket)
+        while len(self._maxs) > 0 and self._maxs[-1][4] <= bucket[4]:
+            self._maxs.pop()
+        self._maxs.append(bucket)
+        self._count += 1
+        self._sum += value
+
+    def __removeMean(self, bucket):
+        i = bisect.bisect_left(self._means, bucket[2] / bucket[1])
+        del self._means[i]
+
+    def __evict(self, now):
+        # Keeps the buckets starting after the current bucket's start - span, so
+        # at most `buckets` of them. Starts are multiples of the resolution, half
+        # a resolution absorbs the float error of the comparison.
+        limit = now - now % self._resolution - self.span + self._resolution / 2
+        while len(self._buckets) > 0 and self._buckets[0][0] < limit:
+            bucket = self._buckets.popleft()
+            self.__removeMean(bucket)
+            if self._mins[0] is bucket:
+                self._mins.popleft()
+            if self._maxs[0] is bucket:
+                self._maxs.popleft()
+            self._count -= bucket[1]
+            self._sum -= bucket[2]
+        if len(self._buckets) == 0:
+            # Drops the rounding error of the running sum.
+            self._sum = 0.0
+
+    def mean(self):
+        if self._count == 0:
+            return None
+        return self._sum / self._count
+
+    def median(self):
+        if len(self._means) == 0:
+            return None
+        return self._means[len(self._means) // 2]
+
+    def min(self):
+        if len(self._mins) == 0:
+            return None
+        return self._mins[0][3]
+
+    def max(self):
+        if len(self._maxs) == 0:
+            return None
+        return self._maxs[0][4]
+
+    def oldest(self):
+        # (bucket start, mean) of the oldest bucket, None when empty.
+        if len(self._buckets) == 0:
+            return None
+        bucket = self._buckets[0]
+        return bucket[0], bucket[2] / bucket[1]
+
+    @property
+    def buckets(self):
+        return len(self._buckets)
+
+
+class Ewma:
+    # Exponentially weighted moving average with a half-life in seconds, for uneven sample times.
+    def __init__(self, halfLife):
+        self._halfLife = halfLife
+        self._time = None
+        self.value = None
+
+    def add(self, t, value):
+        if self.value is None or self._halfLife <= 0:
+            self.value = value
+        else:
+            weight = 1.0 - 0.5 ** (max(0.0, t - self._time) / self._halfLife)
+            self.value += weight * (value - self.value)
+        self._time = t
+        return self.value
+
+
+class SpikeFilter:
+    def __init__(self, limit, valid=None, window=SPIKE_WINDOW):
+        self._limit = limit
+        self._valid = valid
+        self._recent = deque(maxlen=window)
+        self._rejected = 0
+        self.dropped = 0
+
+    def accept(self, value):
+        if self._valid is not None and not (self._valid[0] <= value <= self._valid[1]):
+            self.dropped += 1
+            return False
+        if len(self._recent) > 0 and self._limit is not None:
+            median = sorted(self._recent)[len(self._recent) // 2]
+            if abs(value - median) > self._limit and self._rejected < self._recent.maxlen:
+                self._rejected += 1
+                self.dropped += 1
+                return False
+            if self._rejected >= self._recent.maxlen:
+                # The level really moved, start over from here.
+                self._recent.clear()
+        self._rejected = 0
+        self._recent.append(value)
+        return True
+
+    def seed(self, value):
+        # A value accepted in a previous run.
+        self._recent.append(value)
+
+
+class DailyRange:
+    # Lowest and highest value since local midnight.
+    def __init__(self, tz=None):
+        self._tz = tz
+        self._day = None
+        self.low = None
+        self.high = None
+        self.lowTime = None
+        self.highTime = None
+
+    def add(self, t, value):
+        day = datetime.datetime.fromtimestamp(t, self._tz).date()
+        if day != self._day:
+            self._day = day
+            self.low = self.high = None
+        if self.low is None or value < self.low:
+            self.low, self.lowTime = value, t
+        if self.high is None or value > self.high:
+            self.high, self.highTime = value, t
+
+
+class StreamStats:
+    # Everything kept for one metric.
+    def __init__(self, windows=ROOM_STATS_WINDOWS, halfLife=ROOM_SMOOTHING, tz=None, limit=None, valid=None):
+        self.windows = [RollingWindow(span) for span in windows]
+        self.ewma = Ewma(halfLife)
+        self.filter = SpikeFilter(limit, valid)
+        self.daily = DailyRange(tz)
+        self.last = None
+
+    def add(self, t, value):
+        # False when the value was dropped as a spike.
+        if self.filter.accept(value) == False:
+            return False
+        self.last = value
+        self.ewma.add(t, value)
+        self.daily.add(t, value)
+        for window in self.windows:
+            window.add(t, value)
+        return True
+
+    def seed(self, rows):
+        # [(time, value)] oldest first, readings accepted in a previous run.
+        for t, value in rows:
+            self.filter.seed(value)
+            self.last = value
+            self.ewma.add(t, value)
+            self.daily.add(t, value)
+            for window in self.windows:
+                window.add(t, value)
+
+    def summary(self):
+        result = {
+            'value': self.last,
+            'smooth': self.ewma.value,
+            'low': self.daily.low,
+            'high': self.daily.high,
+            'dropped': self.filter.dropped,
+        }
+        for window in self.windows:
+            result['{0:g}s'.format(window.span)] = {
+                'mean': window.mean(), 'median': window.median(), 'min': window.min(), 'max': window.max()}
+        return result
+
+
+class RoomStats:
+    # Statistics of the three room readings and the pressure tendency.
+    def __init__(self, tz=None, windows=ROOM_STATS_WINDOWS, halfLife=ROOM_SMOOTHING):
+        self._tz = tz
+        self.metrics = {}
+        for metric in (telemetry.ROOM_TEMPERATURE, telemetry.ROOM_HUMIDITY, telemetry.ROOM_PRESSURE):
+            self.metrics[metric] = StreamStats(windows, halfLife, tz, SPIKE_LIMITS.get(metric), SENSOR_RANGES.get(metric))
+        self._pressure = RollingWindow(PRESSURE_TREND_SPAN)
+
+    def add(self, metric, t, value):
+        if self.metrics[metric].add(t, value) == False:
+            return False
+        if metric == telemetry.ROOM_PRESSURE:
+            self._pressure.add(t, value)
+        return True
+
+    def seedStart(self, now):
+        # Oldest time seed() needs: local midnight or the longest window back.
+        midnight = datetime.datetime.fromtimestamp(now, self._tz).replace(hour=0, minute=0, second=0, microsecond=0)
+        longest = max([window.span for window in self.metrics[telemetry.ROOM_PRESSURE].windows] + [PRESSURE_TREND_SPAN])
+        return min(midnight.timestamp(), now - longest)
+
+    def seed(self, metric, rows):
+        # Restores the statistics from the history, rows as HistoryDb.query(metric, seedStart(now), now, 'raw').
+        self.metrics[metric].seed(rows)
+        if metric == telemetry.ROOM_PRESSURE:
+            for t, value in rows:
+                self._pressure.add(t, value)
+
+    def pressureTrend(self, now):
+        # (change over PRESSURE_TREND_SPAN in hPa, 'rising' / 'falling' / 'steady'),
+        # (None, None) until the window is nearly full.
+        oldest = self._pressure.oldest()
+        smooth = self.metrics[telemetry.ROOM_PRESSURE].ewma.value
+        if oldest is None or smooth is None or now - oldest[0] < PRESSURE_TREND_SPAN * 0.9:
+            return None, None
+        change = (smooth - oldest[1]) * PRESSURE_TREND_SPAN / (now - oldest[0])
+        if change >= PRESSURE_TREND_LIMIT:
+            return change, 'rising'
+        if change <= -PRESSURE_TREND_LIMIT:
+            return change, 'falling'
+        return change, 'steady'
+
+    def summary(self, now):
+        # Value of telemetry.ROOM_STATS.
+        result = dict([(metric, stats.summary()) for metric, stats in self.metrics.items()])
+        result['pressureChange'], result['pressureTrend'] = self.pressureTrend(now)
+        return result
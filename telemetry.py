@@ -0,0 +1,116 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+# ***************************
+# Telemetry bus between collector threads and the display
+# Collectors publish samples from any thread. Samples are coalesced per
+# metric until the consumer drains them, so the consumer does a bounded
+# amount of work per frame however many samples arrived. The notify
+# callback fires once per drain cycle (the first publish after a drain).
+# Taps see every single sample, e.g. for logging or export.
+
+# Metric names
+ROOM_TEMPERATURE = 'room.temperature'
+ROOM_HUMIDITY = 'room.humidity'
+ROOM_PRESSURE = 'room.pressure'
+# {room metric: summary, 'pressureChange', 'pressureTrend'}, see streamstats.RoomStats.summary.
+ROOM_STATS = 'room.stats'
+CPU_USAGE = 'cpu.usage'
+CPU_TEMPERATURE = 'cpu.temperature'
+CPU_CORES = 'cpu.cores'
+CPU_FREQUENCIES = 'cpu.frequencies'
+NET_UPLOAD = 'net.upload'
+NET_DOWNLOAD = 'net.download'
+NET_PING = 'net.ping'
+NET_RESULT = 'net.result'
+# {location name: forecastmodel.Forecast} in FORECAST_LOCATIONS order.
+WEATHER_FORECAST = 'weather.forecast'
+# (epoch ms, [values in HISTORY_FIELDS order]) after a history row is written.
+HISTORY_ROW = 'history.row'
+
+TELEMETRY_LOG = os.environ.get('TELEMETRY_LOG', '0') == '1'
+
+
+class Sample:
+    __slots__ = ('metric', 'value', 'timestamp', 'source')
+
+    def __init__(self, metric, value, timestamp, source):
+        self.metric = metric
+        self.value = value
+        self.timestamp = timestamp
+        self.source = source
+
+
+class TelemetryBus:
+    def __init__(self, clock=time.time):
+        # clock stamps the samples, a replay passes its virtual one.
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._latest = {}
+        self._notified = False
+        self._notify = None
+        self._taps = []
+        self.published = 0
+        self.coalesced = 0
+
+    def setNotify(self, fn):
+        # fn() is called from the publishing thread, at most once per drain.
+        self._notify = fn
+
+    def addTap(self, fn):
+        self._taps.append(fn)
+
+    def removeTap(self, fn):
+        # A new list, so a publish on another thread keeps iterating the old one.
+        self._taps = [tap for tap in self._taps if tap != fn]
+
+    def publish(self, metric, value, timestamp=None, source=None):
+        if timestamp is None:
+            timestamp = self._clock()
+        sample = Sample(metric, value, timestamp, source)
+        for tap in self._taps:
+            try:
+                tap(sample)
+            except Exception as e:
+                print('Telemetry tap failed: {0}'.format(e))
+
+        with self._lock:
+            self.published += 1
+            if metric in self._pending:
+                self.coalesced += 1
+            self._pending[metric] = sample
+            self._latest[metric] = sample
+            wake = self._notified == False
+            self._notified = True
+        if wake == True and self._notify is not None:
+            self._notify()
+
+    def drain(self):
+        # Returns {metric: newest Sample} published since the last drain.
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._notified = False
+        return pending
+
+    def latest(self, metric, default=None):
+        with self._lock:
+            sample = self._latest.get(metric)
+        if sample is None:
+            return default
+        return sample.value
+
+    def latestSamples(self):
+        # {metric: newest Sample} of every metric published so far.
+        with self._lock:
+            return dict(self._latest)
+
+
+def logTap(sample):
+    if isinstance(sample.value, (int, float)):
+        print('{0:.3f} {1} {2}'.format(sample.timestamp, sample.metric, sample.value))
@@ -6,47 +6,217 @@ import datetime
 import os
 import requests
 import sys
+import threading
+import time
 
-from pytz import timezone
 from os.path import join, dirname
-from dotenv import load_dotenv
-
-load_dotenv(join(dirname(__file__), '.env'))
+from forecastmodel import Forecast
+from settings import TIMEZONE
 
 API_KEY = os.environ.get("API_KEY")
 ZIP = os.environ.get("ZIP")
-API_URL = "https://api.openweathermap.org/data/2.5/forecast?zip={zip}&units=metric&APPID={key}"
+# FORECAST_URL points the client at another server, e.g. the benchmark stand-in.
+API_URL = os.environ.get("FORECAST_URL", "https://api.openweathermap.org/data/2.5/forecast?zip={zip}&units=metric&APPID={key}")
+API_TIMEOUT = (3.05, 10)    # (connect, read) seconds
+
+# Last good forecast is kept on disk and reused until it is CACHE_TTL seconds old.
+CACHE_PATH = os.environ.get("FORECAST_CACHE", join(dirname(__file__), '.forecast_cache.json'))
+CACHE_TTL = int(os.environ.get("FORECAST_TTL", 20 * 60))
+BACKOFF_MIN = 30            # seconds after the first failure
+BACKOFF_MAX = 60 * 60       # upper limit of the exponential backoff
+
+# Requests per minute over all locations (the free plan allows 60).
+RATE_LIMIT = float(os.environ.get("FORECAST_RATE_LIMIT", 60))
+RATE_BURST = int(os.environ.get("FORECAST_RATE_BURST", 10))
+# Connections kept per host, one per location fetched at the same time.
+POOL_SIZE = int(os.environ.get("FORECAST_POOL_SIZE", 4))
+
+# Keep-alive connections are reused between fetches and locations.
+_session = requests.Session()
+_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+
+
+def setSession(session):
+    # Swaps the HTTP session (the record and replay harness wraps it) and returns the old one.
+    global _session
+    previous, _session = _session, session
+    return previous
+
+
+_lock = threading.Lock()
+_saveLock = threading.Lock()
+_cache = None       # {zip: entry}
+_states = {}        # {zip: _LocationState}
+
+
+class _LocationState:
+    __slots__ = ('inflight', 'failures', 'retryAt')
+
+    def __init__(self):
+        self.inflight = None
+        self.failures = 0
+        self.retryAt = 0.0
+
+
+class _RateLimiter:
+    # Token bucket shared by every fetch. Callers reserve a token and sleep
+    # outside the lock until it is due, so they are served in order.
+    def __init__(self, perMinute, burst):
+        self._rate = perMinute / 60.0
+        self._burst = float(burst)
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self._rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+_rateLimiter = _RateLimiter(RATE_LIMIT, RATE_BURST)
+
+
+def _loadCache():
+    global _cache
+    if _cache is None:
+        try:
+            with open(CACHE_PATH, 'rt', encoding='utf-8') as fs:
+                _cache = json.load(fs)
+        except (OSError, ValueError):
+            _cache = {}
+        if 'zip' in _cache:
+            # Single location cache of earlier versions.
+            _cache = {_cache['zip']: _cache}
+    return _cache
 
 
-def getWeatherForecast():
-    url = API_URL.format(zip=ZIP, key=API_KEY)
+def _saveCache():
+    with _lock:
+        cache = dict(_loadCache())
+    tmpPath = CACHE_PATH + '.tmp'
+    with _saveLock:
+        try:
+            with open(tmpPath, 'wt', encoding='utf-8') as fs:
+                json.dump(cache, fs, separators=(',', ':'))
+            os.replace(tmpPath, CACHE_PATH)
+        except OSError as e:
+            print('Cannot write forecast cache: {0}'.format(e))
+
+
+def _fetch(zipCode, cache):
+    # Returns the new cache entry, or None when the request failed.
+    url = API_URL.format(zip=zipCode, key=API_KEY)
+    headers = {}
+    if cache.get('etag'):
+        headers['If-None-Match'] = cache['etag']
+    if cache.get('lastModified'):
+        headers['If-Modified-Since'] = cache['lastModified']
+
+    _rateLimiter.acquire()
     try:
-        response = requests.get(url)
-    except:
-        return []
+        response = _session.get(url, headers=headers, timeout=API_TIMEOUT)
+    except requests.RequestException as e:
+        print('Forecast request for {0} failed: {1}'.format(zipCode, e))
+        return None
 
-    forecastData = json.loads(response.text)
+    if response.status_code == 304 and 'data' in cache:
+        entry = dict(cache)
+        entry['fetched'] = time.time()
+        return entry
+
+    try:
+        forecastData = response.json()
+    except ValueError:
+        forecastData = {}
 
-    result = []
     if not ('list' in forecastData):
-        result.append([datetime.datetime.today(), 800, 40.2, 0.0])
-        print('Error. Please check ZIP code or API_KEY.')
-        return result
-
-    for item in forecastData['list']:
-        forecastDatetime = timezone(
-            'Asia/Tokyo').localize(datetime.datetime.fromtimestamp(item['dt']))
-        weatherId = item['weather'][0]['id']
-        weatherDescription = item['weather'][0]['description']
-        temperature = item['main']['temp']
-        rainfall = 0
-        if 'rain' in item and '3h' in item['rain']:
-            rainfall = item['rain']['3h']
-        result.append(
-            [forecastDatetime, weatherId, temperature, rainfall])
-        print('日時:{0} 天気:({1}){2} 気温(℃):{3} 雨量(mm):{4:.2f}'.format(
-            forecastDatetime, weatherId, weatherDescription, temperature, rainfall))
-
-    return result
+        print('Error. Please check ZIP code {0} or API_KEY. (HTTP {1})'.format(zipCode, response.status_code))
+        return None
+
+    return {
+        'zip': zipCode,
+        'fetched': time.time(),
+        'etag': response.headers.get('ETag'),
+        'lastModified': response.headers.get('Last-Modified'),
+        'data': forecastData,
+    }
+
+
+def _getForecastData(zipCode):
+    with _lock:
+        cache = _loadCache().get(zipCode, {})
+        state = _states.get(zipCode)
+        if state is None:
+            state = _states[zipCode] = _LocationState()
+        now = time.time()
+        if 'data' in cache and now - cache.get('fetched', 0) < CACHE_TTL:
+            return cache['data']
+        if now < state.retryAt:
+            # Backing off, serve whatever we have.
+            return cache.get('data')
+        if state.inflight is not None:
+            event = state.inflight
+            leader = False
+        else:
+            event = state.inflight = threading.Event()
+            leader = True
+
+    if leader == False:
+        # Another caller is already fetching this location, wait for its result.
+        event.wait(sum(API_TIMEOUT) + 1)
+        with _lock:
+            return _loadCache().get(zipCode, {}).get('data')
+
+    entry = None
+    try:
+        entry = _fetch(zipCode, cache)
+    finally:
+        with _lock:
+            if entry is None:
+                state.failures += 1
+                state.retryAt = time.time() + min(BACKOFF_MAX, BACKOFF_MIN * 2 ** (state.failures - 1))
+            else:
+                state.failures = 0
+                state.retryAt = 0.0
+                _loadCache()[zipCode] = entry
+            state.inflight = None
+            event.set()
+
+    if entry is None:
+        return cache.get('data')
+    _saveCache()
+    return entry['data']
+
+
+def _parseForecast(forecastData):
+    return Forecast.fromPayload(forecastData, TIMEZONE)
+
+
+def getWeatherForecast(zipCode=None):
+    # Network is only used when the cache is older than CACHE_TTL.
+    # While the API is unreachable the last good forecast is returned.
+    # Safe to call from several threads, also for different locations.
+    forecastData = _getForecastData(zipCode or ZIP)
+    if forecastData is None:
+        return Forecast()
+    return _parseForecast(forecastData)
+
+
+def getCachedForecast(zipCode=None):
+    # Never touches the network; the fallback when a fetch raised instead of returning.
+    with _lock:
+        forecastData = _loadCache().get(zipCode or ZIP, {}).get('data')
+    if forecastData is None:
+        return Forecast()
+    return _parseForecast(forecastData)
 
 # getWeatherForecast()
@@ -0,0 +1,63 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+
+# ***************************
+# Small pool of long lived worker threads
+# Jobs are submitted with a key (task type). A key that is still queued or
+# running is refused, so a slow speedtest can never pile up behind itself.
+
+
+class WorkerPool:
+    def __init__(self, workers=2, name='worker'):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._active = set()
+        self._idle = threading.Condition(self._lock)
+        self._threads = []
+        for i in range(0, workers):
+            thread = threading.Thread(target=self.__run, name='{0}{1}'.format(name, i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, fn, *args):
+        # Returns False when a job with the same key has not finished yet.
+        with self._lock:
+            if key in self._active:
+                return False
+            self._active.add(key)
+        self._queue.put((key, fn, args))
+        return True
+
+    def busy(self, key):
+        with self._lock:
+            return key in self._active
+
+    def wait(self, timeout=None):
+        # Blocks until no job is queued or running; False on timeout.
+        with self._idle:
+            return self._idle.wait_for(lambda: len(self._active) == 0, timeout)
+
+    def __run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            key, fn, args = job
+            try:
+                fn(*args)
+            except Exception as e:
+                print('Job {0} failed: {1}'.format(key, e))
+            finally:
+                with self._lock:
+                    self._active.discard(key)
+                    self._idle.notify_all()
+
+    def shutdown(self, wait=True):
+        for thread in self._threads:
+            self._queue.put(None)
+        if wait == True:
+            for thread in self._threads:
+                thread.join()